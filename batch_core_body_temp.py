@@ -0,0 +1,123 @@
+# Mouse CBT analysis - batch runner
+#
+# Runs core_body_temp on many experiment folders at once, each in its own worker process. Every
+# folder needs its own user_modify.csv next to its data files (core_body_temp.py does not need to
+# be copied in). Run from the directory core_body_temp.py is in:
+#
+#   python batch_core_body_temp.py "expt 1" "expt 2" "expt 3"
+#   python batch_core_body_temp.py --list archived_experiments.txt --processes 8
+#   python batch_core_body_temp.py --calibration "Calibration Document R41519.csv" expt*
+#
+# Each Calibration Document is only parsed once, and the parsed slopes/intercepts are shared by
+# every experiment that uses the same logger batch (the same document contents). --calibration
+# gives the document to use for folders that don't have one of their own.
+# Everything an experiment prints is saved in batch_log.txt in its folder.
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import traceback
+import multiprocessing
+
+import matplotlib
+matplotlib.use('Agg')   #workers never open windows
+
+import core_body_temp
+
+def find_calibration_document(directory):
+    """Returns the path of the file with "Calibration Document" in its name in the given
+    directory, or None if there isn't one."""
+    for f in sorted(os.listdir(directory)):
+        if "Calibration Document" in f and os.path.isfile(os.path.join(directory, f)):
+            return os.path.join(directory, f)
+    return None
+
+def parse_shared_calibrations(directories, default_document=None):
+    """Given a list of experiment directories (and optionally the Calibration Document to use for
+    directories without one), returns a dictionary of directory mapped to its parsed calibration
+    dictionary (see core_body_temp.calibration_data_dict), or None for csv experiments that have no
+    document. Documents with identical contents (the same logger batch) are only parsed once."""
+    parsed_by_contents = {}
+    calibrations = {}
+    for directory in directories:
+        document = find_calibration_document(directory) or default_document
+        if document is None:
+            calibrations[directory] = None
+            continue
+        contents_key = hashlib.md5(open(document, 'rb').read()).hexdigest()
+        if contents_key not in parsed_by_contents:
+            parsed_by_contents[contents_key] = core_body_temp.calibration_data_dict([document])
+        calibrations[directory] = parsed_by_contents[contents_key]
+    return calibrations
+
+def run_experiment(job):
+    """Runs core_body_temp.main() in the given experiment directory with the shared calibration
+    dictionary. job is a (directory, calibration_dict) tuple. Returns (directory, error message or
+    None, seconds taken). Runs in a worker process, so changing directory is safe."""
+    directory, calibration_dict = job
+    start = time.time()
+    log = open(os.path.join(directory, 'batch_log.txt'), 'w')
+    sys.stdout = log
+    try:
+        os.chdir(directory)
+        core_body_temp.main(calibration_dict)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+        log.write(error)
+    finally:
+        sys.stdout = sys.__stdout__
+        log.close()
+    return directory, error, time.time() - start
+
+def run_batch(directories, processes=None, default_document=None):
+    """Analyses every experiment directory in parallel worker processes (one fresh process per
+    experiment) and returns a list of (directory, error or None, seconds) in the given order."""
+    directories = [os.path.abspath(directory) for directory in directories]
+    calibrations = parse_shared_calibrations(directories, default_document)
+    jobs = [(directory, calibrations[directory]) for directory in directories]
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    results = {}
+    try:
+        for directory, error, seconds in pool.imap_unordered(run_experiment, jobs):
+            results[directory] = (directory, error, seconds)
+            print "%-8s %7.1f s  %s" %('FAILED' if error else 'done', seconds, directory)
+    finally:
+        pool.close()
+        pool.join()
+    return [results[directory] for directory in directories]
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs core_body_temp on many experiment folders in parallel.')
+    parser.add_argument('directories', nargs='*', help='experiment folders')
+    parser.add_argument('--list', help='text file with one experiment folder per line')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--calibration', help='Calibration Document for folders without their own')
+    args = parser.parse_args()
+
+    directories = list(args.directories)
+    if args.list:
+        directories.extend(line.strip() for line in open(args.list) if line.strip())
+    missing = [d for d in directories if not os.path.exists(os.path.join(d, 'user_modify.csv'))]
+    if len(directories) == 0 or len(missing) > 0:
+        for directory in missing:
+            print "No user_modify.csv in", directory
+        parser.print_usage()
+        return 1
+    default_document = os.path.abspath(args.calibration) if args.calibration else None
+
+    start = time.time()
+    results = run_batch(directories, args.processes, default_document)
+    failed = [result for result in results if result[1] is not None]
+    print
+    print "%d experiments analysed in %.1f s, %d failed" %(len(results), time.time() - start, len(failed))
+    for directory, error, seconds in failed:
+        print
+        print directory
+        print error
+    return len(failed)
+
+if __name__ == "__main__":
+    sys.exit(main())
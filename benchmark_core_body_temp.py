@@ -0,0 +1,374 @@
+# Mouse CBT analysis benchmarks
+#
+# Generates synthetic experiments (SubCue .TXT downloads or .csv exports) and times each stage of
+# the core_body_temp pipeline on them. Run from the directory core_body_temp.py is in:
+#
+#   python benchmark_core_body_temp.py                      (times the default scenarios)
+#   python benchmark_core_body_temp.py --save-baseline      (records the times as the new baseline)
+#   python benchmark_core_body_temp.py --mice 24 --days 30 --interval 60 --format txt
+#   python benchmark_core_body_temp.py --mice 64 --processes 8  (per-mouse stages in 8 processes)
+#   python benchmark_core_body_temp.py --mice 36 --groups 6     (dose-response design, 6 groups)
+#
+# Stage times are compared with benchmark_baseline.json (if it exists) and any stage more than
+# --tolerance slower than its baseline is reported as a regression. A fresh import of core_body_temp
+# has to stay under IMPORT_BUDGET_SECS without pulling in matplotlib or scipy.
+
+import os
+import sys
+import csv
+import json
+import math
+import time
+import shutil
+import subprocess
+import tempfile
+import platform
+import argparse
+import datetime
+import numpy as np
+
+from core_body_temp import *
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+#(name, number of mice, number of days, sampling interval in seconds, data format)
+SCENARIOS = [('small', 4, 3, 300, 'txt'),
+             ('small', 4, 3, 300, 'csv'),
+             ('medium', 12, 14, 300, 'txt'),
+             ('medium', 12, 14, 300, 'csv'),
+             ('large', 24, 30, 60, 'txt')]
+
+#a fresh "import core_body_temp" slower than this is reported like a regression
+IMPORT_BUDGET_SECS = 0.25
+IMPORT_SCRIPT = ("import sys, time; start = time.time(); import core_body_temp; "
+                 "print time.time() - start; print ' '.join(m for m in ('matplotlib.pyplot', 'scipy') "
+                 "if m in sys.modules)")
+
+#################
+#### Synthetic data
+#################
+
+def synthetic_cbt(n_samples, interval_secs, start_hour, rng):
+    """Given a number of samples, the sampling interval in seconds, the hour of day the first
+    sample is taken and a numpy RandomState, returns an array of realistic mouse CBTs: a circadian
+    rhythm peaking in the dark cycle, a per-mouse offset, slowly wandering (AR(1)) noise and the
+    occasional single-sample spike the SubCue loggers produce."""
+    hours = start_hour + np.arange(n_samples) * interval_secs / 3600.0
+    mesor = 36.6 + rng.normal(0, 0.2)
+    amplitude = 0.8 + rng.normal(0, 0.1)
+    acrophase = rng.normal(0, 1.0)      #hours after midnight
+    rhythm = mesor + amplitude * np.cos(2 * pi * (hours - acrophase) / 24.0)
+    noise = np.zeros(n_samples)
+    steps = rng.normal(0, 0.08, n_samples)
+    for i in range(1, n_samples):
+        noise[i] = 0.95 * noise[i-1] + steps[i]
+    spikes = np.where(rng.rand(n_samples) < 0.002, rng.normal(0, 0.5, n_samples), 0.0)
+    return rhythm + noise + spikes
+
+def synthetic_gaps(n_samples, interval_secs, rng):
+    """Returns a boolean array that is False for samples lost in a few multi-hour recording gaps."""
+    keep = np.ones(n_samples, dtype=bool)
+    for gap in range(rng.randint(0, 3)):
+        gap_len = int(rng.uniform(1, 8) * 3600 / interval_secs)
+        gap_start = rng.randint(0, max(1, n_samples - gap_len))
+        keep[gap_start:gap_start + gap_len] = False
+    return keep
+
+def synthetic_times(n_days, interval_secs):
+    """Returns a list of datetimes from 06:01 on the first day (first day starts in the light
+    cycle) to 14:01 on the last day (last day ends in the light cycle)."""
+    start = datetime.datetime(2015, 2, 10, 6, 1)
+    n_samples = int((n_days * 24 + 8) * 3600 / interval_secs) + 1
+    return [start + datetime.timedelta(seconds=i*interval_secs) for i in range(n_samples)]
+
+def write_synthetic_user_modify(directory, mouse_nums, n_days, interval_secs, n_groups=2):
+    """Writes a user_modify.csv for a synthetic experiment: the mice split evenly between n_groups
+    treatments, treatment starting half way through the experiment."""
+    tx_start = datetime.date(2015, 2, 10) + datetime.timedelta(days=n_days/2 + 1)
+    writer = csv.writer(open(os.path.join(directory, 'user_modify.csv'), 'wb'))
+    for group in range(n_groups):
+        first, last = group * len(mouse_nums) / n_groups, (group + 1) * len(mouse_nums) / n_groups
+        writer.writerow(['Treatment %d' %(group + 1)] + mouse_nums[first:last])
+    writer.writerow(['Light Cycle', '6:00:00', '17:59:59'])
+    writer.writerow(['Dark Cycle', '18:00:00', '5:59:59'])
+    writer.writerow(['Date treatment started', '%d/%d/%d' %(tx_start.month, tx_start.day, tx_start.year)])
+    writer.writerow(['moving average number of points', '21'])
+    writer.writerow(['moving standard deviation number of points', '21'])
+    writer.writerow(['Analyze last n days pre treatment', '2'])
+    writer.writerow(['Analyze last n days post treatment', '2'])
+    writer.writerow(['Data collection interval (seconds)', str(interval_secs)])
+    writer.writerow(['Plot ranges', 'min', 'max'])
+    writer.writerow(['Avg plot y axis range', '30', '40'])
+    writer.writerow(['Moving stdev plot y axis range', '0', '0.7'])
+
+def make_synthetic_txt_experiment(directory, n_mice, n_days, interval_secs, seed=0, n_groups=2):
+    """Writes one SubCue .TXT download per mouse, a Calibration Document and a user_modify.csv
+    into the given directory. interval_secs must be a whole number of minutes since the .TXT
+    format only records hh:mm. Returns the list of mouse numbers (strings)."""
+    rng = np.random.RandomState(seed)
+    times = synthetic_times(n_days, interval_secs)
+    mouse_nums = [str(i) for i in range(1, n_mice+1)]
+    cal_writer = csv.writer(open(os.path.join(directory, 'Calibration Document for Dataloggers - synthetic.csv'), 'wb'))
+    cal_writer.writerow(['', '', 'Calibration temperatures'])
+    cal_writer.writerow(['Internal serial number', 'SubCue Number', '', '', '', '', '', '', '', '', '', 'Slope', 'intercept', 'correlation'])
+    for mouse in mouse_nums:
+        serial = '%02X4F20000%07X' %(int(mouse), rng.randint(0, 2**27))
+        slope = 1.0 + rng.normal(0, 0.005)
+        intercept = rng.normal(-0.25, 0.15)
+        cal_writer.writerow([serial, 'R41519-%02d' %int(mouse)] + ['']*9 + ['%.4f' %slope, '%.4f' %intercept, '1.0000'])
+        #loggers record the raw (uncalibrated) temperature to the tenth of a degree
+        raw_temps = synthetic_cbt(len(times), interval_secs, 6, rng) / slope + intercept
+        keep = synthetic_gaps(len(times), interval_secs, rng)
+        out = open(os.path.join(directory, 'synthetic_MALE GDX CBT %02d.TXT' %int(mouse)), 'wb')
+        out.write(serial + '\r\nDownload at: 2/17/2015 10:39:18 AM\r\n\r\nLog Data\r\n--------\r\n')
+        for i in range(len(times)):
+            if keep[i]:
+                out.write(' %s  %s %.1f\xb0C\r\n' %(times[i].strftime('%m/%d/%Y'), times[i].strftime('%H:%M'), raw_temps[i]))
+        out.write('\r\nMission State\r\n-------------\r\nMission is in progress\r\n')
+        out.write('Sample rate: %d minute(s)\r\n' %(interval_secs / 60))
+        out.close()
+    write_synthetic_user_modify(directory, mouse_nums, n_days, interval_secs, n_groups)
+    return mouse_nums
+
+def make_synthetic_csv_experiment(directory, n_mice, n_days, interval_secs, seed=0, nan_fraction=0.01,
+                                  n_groups=2):
+    """Writes one .csv export per calendar day (all mice in the columns, missing readings and
+    recording gaps as 'NaN') and a user_modify.csv into the given directory. Returns the list of
+    mouse numbers (strings)."""
+    rng = np.random.RandomState(seed)
+    times = synthetic_times(n_days, interval_secs)
+    mouse_nums = [str(i) for i in range(1, n_mice+1)]
+    temps = []
+    for mouse in mouse_nums:
+        mouse_temps = np.round(synthetic_cbt(len(times), interval_secs, 6, rng), 2)
+        missing = ~synthetic_gaps(len(times), interval_secs, rng) | (rng.rand(len(times)) < nan_fraction)
+        temps.append(np.where(missing, np.nan, mouse_temps))
+    header = ['2 Veh Deg. C Date', '2 Veh Deg. C Time'] + ['%s Veh Deg. C Data' %mouse for mouse in mouse_nums]
+    writer = None
+    day = None
+    for i in range(len(times)):
+        if times[i].date() != day:     #starts a new export file for every calendar day
+            day = times[i].date()
+            writer = csv.writer(open(os.path.join(directory, day.strftime('%m-%d-%Y') + ', CBT export.csv'), 'wb'))
+            writer.writerow(['Synthetic CBT export'])
+            writer.writerow([])
+            writer.writerow(header)
+        row = [times[i].strftime('%m/%d/%Y'), times[i].strftime('%H:%M:%S')]
+        row.extend(['NaN' if np.isnan(t[i]) else '%.2f' %t[i] for t in temps])
+        writer.writerow(row)
+    del writer
+    write_synthetic_user_modify(directory, mouse_nums, n_days, interval_secs, n_groups)
+    return mouse_nums
+
+#################
+#### Timing
+#################
+
+def time_stage(timings, stage, repeat, function, *args):
+    """Runs function(*args) repeat times, stores the best wall time (in seconds) under the stage
+    name in timings, and returns the result of the last run."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    timings[stage] = best
+    return result
+
+def time_module_import(repeat=3):
+    """Imports core_body_temp in repeat fresh interpreters and returns the best import time in
+    seconds and the list of slow optional modules (pyplot, scipy) that the import pulled in."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], cwd=directory)
+        seconds, loaded = (output.split('\n') + [''])[:2]
+        if best is None or float(seconds) < best:
+            best = float(seconds)
+    return best, loaded.split()
+
+def run_scenario(n_mice, n_days, interval_secs, data_format, repeat=1, plots=True, seed=0,
+                 processes=1, n_groups=2):
+    """Generates a synthetic experiment with n_groups treatment groups in a temporary directory
+    and times every pipeline stage on it, running the per-mouse stages over the given number of
+    worker processes. Returns a dictionary of stage name mapped to seconds."""
+    timings = {}
+    directory = tempfile.mkdtemp(prefix='cbt_bench_')
+    start_dir = os.getcwd()
+    try:
+        if data_format == 'txt':
+            mouse_nums = make_synthetic_txt_experiment(directory, n_mice, n_days, interval_secs, seed,
+                                                       n_groups=n_groups)
+        else:
+            mouse_nums = make_synthetic_csv_experiment(directory, n_mice, n_days, interval_secs, seed,
+                                                       n_groups=n_groups)
+        os.chdir(directory)
+        user_input = 'user_modify.csv'
+        times = ["Dark Cycle", "Light Cycle"]
+        filenames = get_data_file_names()
+        n_stdev = extract_ints_in_moving_stdev(user_input)
+        n_ints_in_mavg = extract_ints_in_mavg(user_input)
+
+        if data_format == 'txt':
+            mouse_ids = extract_txt_mouse_ids(filenames)
+            raw_master_tt_dic = time_stage(timings, 'ingest', repeat, make_raw_master_tt_dic_txt,
+                                           filenames, user_input)
+            raw_days_tt_dic = time_stage(timings, 'calibration', repeat, calibrate_data,
+                                         filenames, raw_master_tt_dic)
+        else:
+            clean_all_csv_files(filenames)
+            clean_csv_data_files = get_clean_data_file_names()
+            raw_mouse_ids = get_all_mouse_ids_csv(clean_csv_data_files)
+            raw_days_tt_dic = time_stage(timings, 'ingest', repeat, make_master_tt_dic,
+                                         clean_csv_data_files, raw_mouse_ids)
+            mouse_ids = clean_mouse_ids(raw_mouse_ids)
+        master_tt_dic = time_stage(timings, 'day reassignment', repeat, refit_to_master_tt_dic,
+                                   raw_days_tt_dic, mouse_ids, user_input)
+        day_labels = sort_day_labels_by_date(master_tt_dic.keys())
+
+        sample_arrays = time_stage(timings, 'sample arrays', repeat, make_mouse_sample_arrays,
+                                   day_labels, mouse_nums, times, master_tt_dic,
+                                   extract_light_start_secs(user_input))
+        time_stage(timings, 'outlier filter', repeat, make_outlier_masks, sample_arrays, mouse_nums,
+                   {'range': [30, 42], 'rate': 1.0, 'robust z': [21, 6]})
+        gap_index = time_stage(timings, 'gap index', repeat, make_gap_index, sample_arrays,
+                               interval_secs)
+        time_stage(timings, 'events', repeat, make_event_table, sample_arrays, gap_index, mouse_nums,
+                   [('Low CBT event', {'enter': 36.0, 'leave': 36.3, 'minutes': 30}),
+                    ('High CBT event', {'enter': 37.5, 'leave': 37.2, 'minutes': 30})],
+                   day_labels, times)
+        time_stage(timings, 'aggregate pyramid', repeat, make_aggregate_pyramid, sample_arrays,
+                   [('All mice', mouse_nums)], day_labels, [300, 1800, 3600, 86400])
+        executor = time_stage(timings, 'worker start-up', 1, make_mouse_executor, sample_arrays,
+                              mouse_nums, processes)
+        try:
+            time_stage(timings, 'statistics', repeat, find_all_avgs_ers, day_labels, mouse_nums,
+                       times, master_tt_dic, executor)
+            time_stage(timings, 'gap-aware moving averages', repeat, make_gap_aware_stat_master_dic,
+                       day_labels, mouse_nums, times, sample_arrays, gap_index, n_ints_in_mavg,
+                       'mean', executor)
+            time_stage(timings, 'last 2 cycles moving stdev', repeat,
+                       get_all_last_2_cycles_moving_stdev, master_tt_dic,
+                       extract_treatment_groups(user_input), n_stdev,
+                       day_labels[-3:], executor, day_labels, times)
+        finally:
+            close_mouse_executor(executor)
+        time_stage(timings, 'cosinor', repeat, write_cosinor_table, sample_arrays, mouse_nums,
+                   day_labels, get_treatment_windows(day_labels, user_input),
+                   make_mouse_treatments(extract_treatment_groups(user_input)),
+                   'cosinor_parameters.csv')
+        time_stage(timings, 'treatment tests', repeat, run_treatment_tests, sample_arrays, day_labels,
+                   times, extract_treatment_groups(user_input),
+                   get_treatment_windows(day_labels, user_input),
+                   extract_slot_start_secs(user_input, times), interval_secs, 0.05)
+        time_stage(timings, 'phase shifts', repeat, make_phase_shift_table, sample_arrays,
+                   extract_treatment_groups(user_input), day_labels,
+                   get_treatment_windows(day_labels, user_input),
+                   extract_slot_start_secs(user_input, times), interval_secs, 60)
+        time_stage(timings, 'bootstrap bands', repeat, make_bootstrap_bands, sample_arrays,
+                   extract_treatment_groups(user_input), day_labels, day_labels,
+                   extract_slot_start_secs(user_input, times), interval_secs,
+                   {'resamples': 1000, 'confidence': 95.0, 'seed': 0})
+        time_stage(timings, 'periodogram', repeat, write_periodogram_table, sample_arrays,
+                   mouse_nums, day_labels, {}, user_input, 'periodogram_periods.csv')
+        time_stage(timings, 'group statistics', repeat, make_group_window_stats, master_tt_dic,
+                   [('entire experiment', day_labels)] + get_treatment_windows(day_labels, user_input),
+                   times, extract_treatment_groups(user_input))
+        time_stage(timings, 'rolling windows', repeat, make_mav_master_dic, day_labels, mouse_nums,
+                   times, master_tt_dic, n_ints_in_mavg)
+        time_stage(timings, 'moving median', repeat, make_moving_stat_master_dic, day_labels,
+                   mouse_nums, times, master_tt_dic, n_ints_in_mavg, 'median')
+        if plots:
+            make_a_directory('avg_plot graphs')
+            make_a_directory(str(n_stdev)+'_moving stdv graphs')
+            time_stage(timings, 'avg plots', repeat, all_avg_plots, master_tt_dic, user_input)
+            time_stage(timings, 'moving stdev plots', repeat, plot_n_moving_stdv, day_labels,
+                       mouse_nums, times, master_tt_dic, n_stdev, user_input)
+    finally:
+        os.chdir(start_dir)
+        shutil.rmtree(directory)
+    return timings
+
+def scenario_key(name, n_mice, n_days, interval_secs, data_format):
+    """Returns the string used to identify a scenario in the baseline file."""
+    return '%s %s: %d mice, %d days, %ds' %(name, data_format, n_mice, n_days, interval_secs)
+
+def load_baseline(path):
+    """Returns the scenario timings stored in the baseline file, or an empty dict if there is none."""
+    if not os.path.exists(path):
+        return {}
+    return json.load(open(path))['scenarios']
+
+def save_baseline(path, results):
+    """Writes the scenario timings and a description of the machine to the baseline file."""
+    baseline = {'created': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'scenarios': results}
+    json.dump(baseline, open(path, 'w'), indent=2, sort_keys=True)
+
+def find_regressions(results, baseline, tolerance):
+    """Returns a list of (scenario, stage, seconds, baseline seconds) for every stage that was
+    more than tolerance (a fraction, ie 0.25) slower than in the baseline."""
+    regressions = []
+    for key in sorted(results):
+        for stage in sorted(results[key]):
+            if key in baseline and stage in baseline[key]:
+                if results[key][stage] > baseline[key][stage] * (1 + tolerance):
+                    regressions.append((key, stage, results[key][stage], baseline[key][stage]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Times every stage of core_body_temp on synthetic experiments.')
+    parser.add_argument('--mice', type=int, help='number of mice (runs one custom scenario)')
+    parser.add_argument('--days', type=int, default=7, help='number of days in the custom scenario')
+    parser.add_argument('--interval', type=int, default=300, help='sampling interval in seconds (custom scenario)')
+    parser.add_argument('--format', choices=['txt', 'csv'], default='txt', help='data format (custom scenario)')
+    parser.add_argument('--repeat', type=int, default=1, help='times each stage is run, the best is kept')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes for the per-mouse stages')
+    parser.add_argument('--groups', type=int, default=2, help='treatment groups the mice are split into')
+    parser.add_argument('--no-plots', action='store_true', help='skip the plotting stages')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown counted as a regression')
+    args = parser.parse_args()
+
+    if args.mice:
+        scenarios = [('custom', args.mice, args.days, args.interval, args.format)]
+    else:
+        scenarios = SCENARIOS
+
+    import_secs, import_loaded = time_module_import()
+    print "module import %.3f s (budget %.3f s)" %(import_secs, IMPORT_BUDGET_SECS)
+    over_budget = import_secs > IMPORT_BUDGET_SECS or len(import_loaded) > 0
+    if over_budget:
+        print "IMPORT OVER BUDGET, also imported:", ', '.join(import_loaded) or 'nothing extra'
+
+    results = {}
+    for name, n_mice, n_days, interval_secs, data_format in scenarios:
+        key = scenario_key(name, n_mice, n_days, interval_secs, data_format)
+        print key
+        results[key] = run_scenario(n_mice, n_days, interval_secs, data_format, args.repeat,
+                                    not args.no_plots, processes=args.processes,
+                                    n_groups=args.groups)
+        for stage in sorted(results[key], key=results[key].get, reverse=True):
+            print "    %-30s %8.3f s" %(stage, results[key][stage])
+
+    baseline = load_baseline(BASELINE_FILE)
+    regressions = find_regressions(results, baseline, args.tolerance)
+    print
+    if len(baseline) == 0:
+        print "No baseline found at", BASELINE_FILE
+    elif len(regressions) == 0:
+        print "No regressions against the baseline."
+    for key, stage, seconds, baseline_seconds in regressions:
+        print "REGRESSION %s, %s: %.3f s (baseline %.3f s)" %(key, stage, seconds, baseline_seconds)
+    if args.save_baseline:
+        save_baseline(BASELINE_FILE, results)
+        print "Baseline saved to", BASELINE_FILE
+    return len(regressions) + over_budget
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,9 +5,6 @@
 #
 #
 
-##import cProfile, pstats, StringIO
-##pr = cProfile.Profile()
-##pr.enable()
 ##import matplotlib.ticker as plticker
 ##import matplotlib.dates as md
 ##import dateutil
@@ -18,21 +15,53 @@
 import os
 import csv
 import re
+import sys
+import time
+import json
+import hashlib
+import datetime
+import mmap
+import sqlite3
+import cProfile
+import threading
+import multiprocessing
+import multiprocessing.sharedctypes
 import numpy as np
-import matplotlib.pyplot as plt
 import math
 pi = math.pi
-import scipy
-from scipy import stats
 import collections
+import bisect
+import heapq
+import warnings
+
+#### DEFERRED IMPORTS
+# matplotlib and scipy take most of the time it takes to import this module, so they are only
+# imported by the functions that plot or use scipy.stats (numeric-only uses and the tests never
+# load them).
+
+def load_pyplot():
+    """Returns matplotlib.pyplot, importing it the first time it's needed. On Linux machines
+    without a display (no DISPLAY or WAYLAND_DISPLAY, ie servers and cron jobs) the non-interactive
+    Agg backend is selected first, unless MPLBACKEND says otherwise, so plots can still be saved."""
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        headless = not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+        if sys.platform.startswith('linux') and headless and not os.environ.get('MPLBACKEND'):
+            matplotlib.use('Agg')
+    import matplotlib.pyplot
+    return matplotlib.pyplot
 
 def clean_all_csv_files(all_csv_data_files):
     """Given a csv file, creates a new .csv file with "clean_" preceding the old .csv filename.
     Newly created file is identical to the original, but all rows before the occurence of the phrase
-    "Deg. C Date" are deleted. This function is necessary for later uses of dictreader."""
+    "Deg. C Date" are deleted. This function is necessary for later uses of dictreader.
+    A clean file at least as new as its original is left as it is."""
     for filename in all_csv_data_files:
         if "clean" in filename:
             pass
+        elif (os.path.exists("clean_" + filename) and
+              os.path.getmtime("clean_" + filename) >= os.path.getmtime(filename)):
+            pass
         else:
             count = 0
             f = csv.reader(open(filename, "rU")) #opens the original file given
@@ -74,25 +103,105 @@ def get_clean_data_file_names():
             clean_data_files.append(f)
     return clean_data_files
 
+####################################################
+#### File discovery
+#### Classifies each candidate file by reading only its first and last few KB, so finding out
+#### what is in a folder costs the same however many samples the files hold.
+####################################################
+
+SNIFF_BYTES = 4096
+TXT_LOG_LINE = re.compile(r'^\s(\d\d/\d\d/\d\d\d\d)\s+(\d\d:\d\d)\s', re.M)
+LOGGER_SERIAL = re.compile(r'^([0-9A-F]{16})\s*$', re.M)
+
+def read_head_and_tail(filename, n_bytes=SNIFF_BYTES):
+    """Returns the first and the last n_bytes of a file as two strings (the same string twice for
+    files shorter than n_bytes)."""
+    f = open(filename, 'rb')
+    head = f.read(n_bytes)
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size <= n_bytes:
+        f.close()
+        return head, head
+    f.seek(size - n_bytes)
+    tail = f.read()
+    f.close()
+    return head, tail
+
+def slash_date_to_label(date):
+    """Given a date like '02/10/2015', returns the day label format used everywhere ('02-10-2015')."""
+    return date.replace('/', '-')
+
+def sniff_data_file(filename, n_bytes=SNIFF_BYTES):
+    """Given a filename, reads only its first and last n_bytes and returns a dictionary describing
+    it: 'format' ('subcue txt', 'csv export', 'calibration' or None if unrecognised), 'mouse_ids'
+    (a list), 'serials' (logger serial numbers), 'first_date' and 'last_date' (day labels, or None)
+    and 'sample_rate' (the string from the mission metadata, or None)."""
+    info = {'filename': filename, 'format': None, 'mouse_ids': [], 'serials': [],
+            'first_date': None, 'last_date': None, 'sample_rate': None}
+    head, tail = read_head_and_tail(filename, n_bytes)
+    if "Calibration Document" in filename or 'Calibration temperatures' in head:
+        info['format'] = 'calibration'
+        for line in csv.reader(head.splitlines()):
+            if len(line) > 1 and LOGGER_SERIAL.match(line[0]):
+                info['serials'].append(line[0])
+    elif 'Deg. C Date' in head:
+        info['format'] = 'csv export'
+        rows = list(csv.reader(head.splitlines()))
+        for i in range(len(rows)):
+            if any("Deg. C Date" in cell for cell in rows[i]):
+                for cell in rows[i]:
+                    if re.search('[0-9]{1} [a-zA-Z]+ Deg. C Data', cell):
+                        info['mouse_ids'].append(cell)
+                if i + 1 < len(rows) and len(rows[i+1]) > 0:
+                    info['first_date'] = slash_date_to_label(rows[i+1][0])
+                break
+        tail_rows = [row for row in csv.reader(tail.splitlines()[1:]) if len(row) > 0]
+        if len(tail_rows) > 0 and re.match(r'\d+/\d+/\d+', tail_rows[-1][0]):
+            info['last_date'] = slash_date_to_label(tail_rows[-1][0])
+        elif info['first_date'] is not None:
+            info['last_date'] = info['first_date']
+    elif TXT_LOG_LINE.search(head):
+        info['format'] = 'subcue txt'
+        serial = LOGGER_SERIAL.search(head[:200])
+        if serial:
+            info['serials'].append(serial.group(1))
+        if 'CBT ' in filename:
+            info['mouse_ids'].append(extract_one_txt_mouse_id(filename))
+        info['first_date'] = slash_date_to_label(TXT_LOG_LINE.search(head).group(1))
+        last_dates = TXT_LOG_LINE.findall(tail)
+        if len(last_dates) > 0:
+            info['last_date'] = slash_date_to_label(last_dates[-1][0])
+        sample_rate = re.search(r'Sample rate:\s*(.+?)\s*$', tail, re.M)
+        if sample_rate:
+            info['sample_rate'] = sample_rate.group(1)
+    return info
+
+def discover_data_files(filenames):
+    """Given a list of candidate filenames (see get_data_file_names), sniffs each one and returns
+    a dictionary of format ('subcue txt', 'csv export', 'calibration') mapped to the list of
+    sniff_data_file dictionaries of that format. Unrecognised files are left out."""
+    discovered = {'subcue txt': [], 'csv export': [], 'calibration': []}
+    for f in sorted(filenames):
+        info = sniff_data_file(f)
+        if info['format'] is not None:
+            discovered[info['format']].append(info)
+    return discovered
+
 def get_all_mouse_ids_csv(filenames):
     """Given a list of csv files in which the first row of each file contains the mouse ids in the
     format "# Deg. C Data", returns a set of mouse ids as they appear in the file."""
     mouse_ids = set() #type is set() to ensure each id only appears once
     for f in filenames:
-        count = 0   #counts ensure no time wasted iterating thru whole file, only 1st row analyzed
         data = csv.reader(open(f, 'rU'), quotechar='"', delimiter = ',')
-        for line in data:
-            count += 1
-            if count == 1:
-                for string in line:
-                    m = re.search('[0-9]{1} [a-zA-Z]+ Deg. C Data', string)
-                    found = ""
-                    if m:
-                        #string is originally in format like "10 Veh Deg. C Data"
-                        #.split() splits on space and makes list of string, takes 1st item
-                        mouse_ids.add(string)
-            elif count <1:
-                break   #exits this for loop and goes to first for loop
+        for line in data:   #only the 1st row is analyzed, so no time is wasted on the whole file
+            for string in line:
+                m = re.search('[0-9]{1} [a-zA-Z]+ Deg. C Data', string)
+                if m:
+                    #string is originally in format like "10 Veh Deg. C Data"
+                    #.split() splits on space and makes list of string, takes 1st item
+                    mouse_ids.add(string)
+            break   #exits this for loop and goes to first for loop
     #doesn't truly sort, puts '10 nnn' before '2 nnn' for example, but doesn't need to be sorted
     return sorted(mouse_ids)    #note: type is now list
 
@@ -104,21 +213,6 @@ def clean_mouse_ids(mouse_ids):
         first_items.add(mouse.split()[0])
     return sorted(first_items) #returns sorted list (not truly sorted, as '10' is before '2'
         
-def get_csv_day_labels(lst_clean_csv_files):
-    """Given a list of strings that are the names of the cleaned csv data files, returns a sorted
-    list of each date in the experiment (found by looking at the left-most column cells in each
-    file given. There are no repeated days in the list: each only occurs once."""
-    day_labels = set()   #type is set() to ensure each label only appears once
-    for f in lst_clean_csv_files:
-        count = 0
-        data = csv.reader(open(f, 'rU'), quotechar='"', delimiter = ',')
-        for line in data:
-            count += 1
-            if count > 1:
-                day_labels.add(line[0])
-    return sorted(day_labels)   #note: type is now list
-    
-
 def day_label(day):
     """Given a string that is the filename, isolates the date and returns date in string format.
     NOTE: this assumes the date is before the first comma, after the phrase "clean_"  """
@@ -136,6 +230,48 @@ def sort_day_labels(unsorted_day_labels):
     first_sort.insert(1, template[0]) #inserts first full day into 2nd position; Light Only is 1st
     return first_sort
 
+####################################################
+#### Calendar index
+#### Day labels ('mm-dd-yyyy') as real dates. Sorting and window selection go by date, so an
+#### experiment that runs over new year stays in order.
+####################################################
+
+def label_to_date(day):
+    """Given a day label ('mm-dd-yyyy'), returns it as a datetime.date."""
+    return datetime.datetime.strptime(day, '%m-%d-%Y').date()
+
+def sort_day_labels_by_date(day_labels):
+    """Given a list of day labels ('mm-dd-yyyy'), returns them sorted by date."""
+    return sorted(day_labels, key=label_to_date)
+
+def make_calendar_index(day_labels):
+    """Given a list of day labels, returns a dictionary with the 'labels' sorted by date, their
+    'dates' (datetime.dates, same order) and 'ordinals': each label mapped to its circadian day
+    number, the days since the first day (so missing days leave a hole in the numbering)."""
+    labels = sort_day_labels_by_date(day_labels)
+    dates = [label_to_date(day) for day in labels]
+    ordinals = dict((day, (date - dates[0]).days) for day, date in zip(labels, dates))
+    return {'labels': labels, 'dates': dates, 'ordinals': ordinals}
+
+def find_day_range(calendar, first_date=None, last_date=None):
+    """Given a calendar index and the first and last dates wanted (datetime.dates or day labels,
+    either can be None for no limit), returns (start, stop): the indexes into calendar['labels']
+    of the days in that range, found by binary search."""
+    if isinstance(first_date, basestring):
+        first_date = label_to_date(first_date)
+    if isinstance(last_date, basestring):
+        last_date = label_to_date(last_date)
+    start = 0 if first_date is None else bisect.bisect_left(calendar['dates'], first_date)
+    stop = len(calendar['dates']) if last_date is None else bisect.bisect_right(calendar['dates'], last_date)
+    return start, max(start, stop)
+
+def select_day_range(arrays, start, stop):
+    """Given one mouse's sample arrays (see make_mouse_sample_arrays, built from the calendar's
+    labels) and a range of day indexes (see find_day_range), returns the slice of the arrays that
+    holds those days. The arrays are in time order, so this is a binary search on 'day_index'."""
+    first, last = np.searchsorted(arrays['day_index'], [start, stop])
+    return slice(first, last)
+
 def mouse_label(mouse):
     """Given a string that is the mouse ID in the csv file, isolates the mouse number while
     disregarding the treatment"""
@@ -180,7 +316,7 @@ def extract_treatment_start_date(filename):
             if len(date_pieces[0]) < 2:
                 month = '0'+date_pieces[0]
             if len(date_pieces[1]) < 2:
-                day = '0'+date_pieces[0]
+                day = '0'+date_pieces[1]
             if len(date_pieces[2]) == 2:
                 yr = '20'+date_pieces[2]
                 
@@ -237,41 +373,31 @@ def extract_mouse_nums_to_use(filename):
     #sorts mouse nums (assumes mouse num is ONLY digits)
     return sorted(mouse_nums, key=lambda x:float(x))
 
-def extract_tx1_mice(filename):
-    """Given a .csv file where the first cell in one of the rows contains the phrase
-    'Treatment 1' (NOTE the space after the word 'Treatment'), returns a sorted list of strings of
-    all mouse numbers given in that row. Assumes mouse numbers have no other characters."""
-    mouse_nums = []
+def extract_treatment_groups(filename):
+    """Given a .csv file where the first cell in one or more rows contains the phrase 'Treatment '
+    (NOTE the space after the word 'Treatment'), returns a list of (group name, sorted list of
+    strings of mouse numbers) of those rows, in the order of the rows. The group name is the first
+    cell ('Treatment 1', 'Treatment 2', 'Treatment 3 high dose'...). Rows without mice are left out.
+    Assumes mouse numbers have no other characters."""
+    groups = []
     data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
     for line in data:
-        if 'Treatment 1' in line[0]:
-            for string in line:
-                match = re.search('^\d+', string)
-                #matches strings that begin with a digit
-                found =""
-                if match:
-                    found = match.group()
-                    mouse_nums.append(string)
-    #sorts mouse nums (assumes mouse num is ONLY digits)
-    return sorted(mouse_nums, key=lambda x:float(x))
+        if len(line) > 0 and 'Treatment ' in line[0]:
+            mice = [string for string in line[1:] if re.search('^\d+', string)]
+            if len(mice) > 0:
+                #sorts mouse nums (assumes mouse num is ONLY digits)
+                groups.append((line[0].strip(), sorted(mice, key=lambda x:float(x))))
+    return groups
 
-def extract_tx2_mice(filename):
-    """Given a .csv file where the first cell in one of the rows contains the phrase
-    'Treatment 1' (NOTE the space after the word 'Treatment'), returns a sorted list of strings of
-    all mouse numbers given in that row. Assumes mouse numbers have no other characters."""
-    mouse_nums = []
-    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
-    for line in data:
-        if 'Treatment 2' in line[0]:
-            for string in line:
-                match = re.search('^\d+', string)
-                #matches strings that begin with a digit
-                found =""
-                if match:
-                    found = match.group()
-                    mouse_nums.append(string)
-    #sorts mouse nums (assumes mouse num is ONLY digits)
-    return sorted(mouse_nums, key=lambda x:float(x))
+def group_mice(groups):
+    """Given a list of (group name, list of mice), returns a list of every mouse in any group, in
+    group order, each mouse once."""
+    mice = []
+    for group, group_mouse_nums in groups:
+        for mouse in group_mouse_nums:
+            if mouse not in mice:
+                mice.append(mouse)
+    return mice
 
 def separate_light_dark(data_dict, mouse):
     """Given data_dict and a given mouse, will return a dictionary of two lists of (time, temp)
@@ -372,6 +498,20 @@ def make_all_times_dic(filenames, mouse_ids):
 
 
 
+def make_all_times_dic_for_experiment(txt_tt_dic, clean_csv_data_files, csv_mouse_ids, user_input):
+    """Returns the all_times_dic of the whole experiment: the 'NaN' keeping all_times_dic of the
+    clean .csv files, with their samples moved into circadian days like master_tt_dic, merged with
+    the .TXT data (see merge_tt_dics), which has no 'NaN' readings to keep."""
+    all_times_dic = {}
+    if len(clean_csv_data_files) > 0:
+        csv_all_times_dic = make_all_times_dic(clean_csv_data_files, csv_mouse_ids)
+        all_times_dic = refit_to_master_tt_dic(csv_all_times_dic, clean_mouse_ids(csv_mouse_ids),
+                                               user_input)
+    return merge_tt_dics(all_times_dic, txt_tt_dic)
+
+
+
+
 #delete below
 ##def make_master_tt_dic(filenames, mouse_ids):
 ##    """Makes a dictionary of each day label mapped to each mouse mapped to a dictionary where
@@ -437,30 +577,42 @@ def extract_one_txt_mouse_id(filename):
     else:
         return split_mouse_id[3][0:2] ##NOT flexible, this is temporary
 
+#one logged sample of a SubCue download, e.g. " 02/10/2015  06:01 34.6\xb0C". The temperature is
+#its first four characters, like the original line.split(' ') parser
+TXT_SAMPLE = re.compile(r'^[ \t](\d\d)/(\d\d)/(\d\d\d\d)[ \t]+(\d\d:\d\d)[ \t]+(\S{1,4})', re.M)
+
+def map_data_file(filename):
+    """Given a filename, returns a read-only memory map of the file (or an empty string for an
+    empty file, which can't be mapped). Regular expressions can search the map directly, so
+    the file is paged in by the OS as it is parsed rather than read into Python strings."""
+    opened_file = open(filename, 'rb')
+    try:
+        if os.fstat(opened_file.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(opened_file.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        opened_file.close()     #the map stays valid after the file is closed
+
 def extract_raw_data_txt(files):
+    """Given a list of filenames, returns a dictionary of day ('mm-dd-yyyy') mapped to a dictionary
+    of mouse id mapped to the list of (time 'hh:mm:00', raw temp) tuples logged that day, for
+    every SubCue .TXT download ('CBT ' in the name). Files are memory mapped and only the matched
+    samples are copied out."""
     raw_tt_dict = {}
     for data_file in files:
         if 'CBT ' in data_file:
             mouse_id = extract_one_txt_mouse_id(data_file)
-            opened_file = open(data_file, 'r')        
-            data = opened_file.readlines()
+            mapped_file = map_data_file(data_file)
             one_mouse_dict = {}
-            for line in data:
-                match = re.search(r'^\s\d\d\/\d\d\/\d\d\d\d\s', line)
-                # ^ is new line
-                # \s is white space
-                # \d is any number 0-9
-                if match:
-                    splt_ln = line.split(' ')
-                    raw_date = str(line.split(' ')[1])
-                    date_pieces = raw_date.split('/')
-                    date = date_pieces[0]+'-'+date_pieces[1]+'-'+date_pieces[2]
-                    #date reformatting needed to prevent errors in plotting code interpreting
-                    # / as making new directory
-                    time = splt_ln[3]+':00' #needed because original code needs seconds
-                    temp = float(splt_ln[4][0:4])
-                    tt_tuple = (time, temp ) #time, float(temp)
-                    one_mouse_dict.setdefault(date, []).append(tt_tuple)
+            for match in TXT_SAMPLE.finditer(mapped_file):
+                month, day, year, hh_mm, temp = match.groups()
+                #date reformatting needed to prevent errors in plotting code interpreting
+                # / as making new directory
+                date = month+'-'+day+'-'+year
+                time = hh_mm+':00' #needed because original code needs seconds
+                one_mouse_dict.setdefault(date, []).append((time, float(temp)))
+            if len(mapped_file) > 0:
+                mapped_file.close()
             for day in one_mouse_dict:
                 raw_tt_dict.setdefault(day, {})[mouse_id] = one_mouse_dict[day]
     return raw_tt_dict
@@ -488,46 +640,30 @@ def get_cycle_bounds_txt(user_input):
     cycle_bounds = cycle_bounds_txt(raw_cycle_bounds)
     return cycle_bounds
 
-def get_last_n_pre_days(treatment_start_date, day_labels, filename):
-    """Given a list of strings that are the days (day_labels), and a string that is the date the
-    treatments began (according to tt_dic, NOT actual days since tt_dic days start on the given
-    day's dark cycle and end on the end of the next day's light cycyle, making everything slightly
-    off), and the name of the .csv file that the user modifies, returns a list of strings that are
-    the last n day of the pre treatment. See the file, "read_me_for_user_modify" under the section
-    "Analyze last n days" for more information """
+def get_last_n_pre_days(treatment_start_date, calendar, filename):
+    """Given a string that is the date the treatments began (according to tt_dic, NOT actual days
+    since tt_dic days start on the given day's light cycle and end at the end of the next day's
+    dark cycle, making everything slightly off), the calendar index of the days (see
+    make_calendar_index), and the name of the .csv file that the user modifies, returns a list of
+    strings that are the last n days before the treatment start date. See the file,
+    "read_me_for_user_modify" under the section "Analyze last n days" for more information """
     n_days_to_analyze = extract_last_n_day_pre(filename) #this is an int
-    print
-    print n_days_to_analyze
-    print type(n_days_to_analyze)
-    count = 0
-    for day in day_labels: #makes list of all days between expt. start and treatment start date
-        count +=1
-        if day == treatment_start_date:
-            all_pre_days = day_labels[0:count-1]
-            n_pre_days = all_pre_days[-n_days_to_analyze:len(all_pre_days)]
-            #makes new list of days counting back from treatment day that's n_days_to_analyze long
-            #list does not include treatment_start_date
-            return n_pre_days
-
-def get_last_n_post_days(treatment_start_date, day_labels, filename):
-    """Given a list of strings that are the days (day_labels), and a string that is the date the
-    treatments began (according to tt_dic, NOT actual days since tt_dic days start on the given
-    day's dark cycle and end on the end of the next day's light cycyle, making everything slightly
-    off), and the name of the .csv file that the user modifies, returns a list of strings that are
-    the last n day of the post treatment. See the file, "read_me_for_user_modify" under the section
-    "Analyze last n days" for more information """
+    tx_start, stop = find_day_range(calendar, treatment_start_date)
+    #list does not include treatment_start_date
+    return calendar['labels'][max(0, tx_start-n_days_to_analyze):tx_start]
+
+def get_last_n_post_days(treatment_start_date, calendar, filename):
+    """Given a string that is the date the treatments began (see get_last_n_pre_days), the
+    calendar index of the days (see make_calendar_index), and the name of the .csv file that the
+    user modifies, returns a list of strings that are the last n days of the post treatment. See
+    the file, "read_me_for_user_modify" under the section "Analyze last n days" for more
+    information """
     n_days_to_analyze = extract_last_n_day_post(filename) #this is an int
-    all_post_days = list(day_labels)
-    for day in day_labels: #makes list of all days btw expt. start and treatment start date
-        if day != treatment_start_date:
-            all_post_days.remove(day)
-        elif day == treatment_start_date:
-            #keep in mind treatments usually start mid-light cycle on the treatment start date
-            n_post_days = all_post_days[-n_days_to_analyze-1:len(all_post_days)-1]
-            #makes new list of days counting back n_days_to_analyze long from end of expt, NOT
-            #including the last day in the expt, since this is only about half a cycle typically,
-            #or at least only the light cycle, not the dark cycle
-            return n_post_days
+    tx_start, stop = find_day_range(calendar, treatment_start_date)
+    #keep in mind treatments usually start mid-light cycle on the treatment start date
+    #counts back n_days_to_analyze from the end of expt, NOT including the last day in the expt,
+    #since this is only about half a cycle typically, or at least only the light cycle
+    return calendar['labels'][max(tx_start, stop-n_days_to_analyze-1):stop-1]
 
 def separate_light_dark_txt(data_dict, mouse, user_input):
     """Given data_dict (a dict where keys are mouse IDs mapped to a list of tt tuples), and a
@@ -586,15 +722,18 @@ def calibration_data_dict(data_files):
                  #line[12] is intercept
     return calibration_dict
 
-def calibrate_data(data_files, master_tt_dic):
+def calibrate_data(data_files, master_tt_dic, calibration_dict=None):
     """Given a list of files in the directory, finds the Calibration Document and uses that
     information to convert each data logger's temperature using the given constants. Returns a
     dictionary identical to given master_tt_dic (day: {mouse: {cycle: [tt, tt...]}}} but the
     temperature has now been computed with the following equation: (raw_temp - intercept) * slope
     and a new dictionary has been made so the temperature is this new calibrated temperature (the
-    float is rounded to the nearest hundredth, though the technology is only accurate to the tenth."""
+    float is rounded to the nearest hundredth, though the technology is only accurate to the tenth.
+    An already parsed calibration_dict (see calibration_data_dict) can be given instead, for example
+    when one Calibration Document is shared by many experiments."""
     calibrated_raw_tt_dict = {}
-    calibration_dict = calibration_data_dict(data_files)
+    if calibration_dict is None:
+        calibration_dict = calibration_data_dict(data_files)
     for day in master_tt_dic:
         calibrated_raw_tt_dict[day] = {}
         for mouse in master_tt_dic[day]:
@@ -627,7 +766,7 @@ def calibrate_data(data_files, master_tt_dic):
 ##    latest_light = cycle_bounds['Light Cycle'][1]
 ##    
 ##    #determines what days the raw data recorded, and makes new list of days for master_tt_dic to use
-##    all_days = sorted(calibrated_tt_dic.keys())
+##    all_days = sort_day_labels_by_date(calibrated_tt_dic.keys())
 ##    
 ##    #building master_tt_dic structure
 ##    #this is preferable to setdefault due to different day keys btw the two dictionaries
@@ -670,7 +809,7 @@ def refit_to_master_tt_dic(calibrated_tt_dic, mouse_ids, user_input):
     latest_light = cycle_bounds['Light Cycle'][1]
     
     #determines what days the raw data recorded, and makes new list of days for master_tt_dic to use
-    all_days = sorted(calibrated_tt_dic.keys())
+    all_days = sort_day_labels_by_date(calibrated_tt_dic.keys())
     
     #building master_tt_dic structure
     #this is preferable to setdefault due to different day keys btw the two dictionaries
@@ -711,6 +850,20 @@ def refit_to_master_tt_dic(calibrated_tt_dic, mouse_ids, user_input):
 ##                            master_tt_dic[all_days[count-1]][mouse]['Dark Cycle'].append(tt)
     return master_tt_dic     
 
+def merge_tt_dics(tt_dic, other_tt_dic):
+    """Given two day: {mouse: {cycle: [tt, tt...]}} dictionaries (for example one from .TXT files
+    and one from .csv files), adds the second into the first and returns it. A mouse with no data
+    in one of them (an empty placeholder from refit_to_master_tt_dic) takes the other's data."""
+    for day in other_tt_dic:
+        for mouse in other_tt_dic[day]:
+            day_dic = tt_dic.setdefault(day, {})
+            if mouse not in day_dic:
+                day_dic[mouse] = other_tt_dic[day][mouse]
+            else:
+                for cycle in other_tt_dic[day][mouse]:
+                    day_dic[mouse].setdefault(cycle, []).extend(other_tt_dic[day][mouse][cycle])
+    return tt_dic
+
 def list_CBT(day, mouse, cycle, master_tt_dic):
     """Returns a list of CBTs for the given day, mouse and light cycle"""
     CBT_list = []
@@ -736,10 +889,15 @@ def stdev(CBT_list):
     stdev_temp = np.std(CBT_list)
     return stdev_temp
 
-def find_all_avgs_ers(day_labels, mouse_nums, times, master_tt_dic): #Ultimately into excel, not print
+def find_all_avgs_ers(day_labels, mouse_nums, times, master_tt_dic, executor=None): #Ultimately into excel, not print
     """Prints the mean, standard error and standard deviation for each mouse for each day's light
     cycle. If there is no data for the given day and cycle, the function prints 'There is no data
-    for this cycle' """
+    for this cycle'. If an executor is given (see make_mouse_executor, made from the same
+    day_labels and times), the statistics are calculated from the sample arrays, split by mouse."""
+    if executor is not None:
+        write_avgs_ers(day_labels, mouse_nums, times,
+                       map_mice(executor, mouse_cycle_stats, mouse_nums, (len(day_labels), len(times))))
+        return
     file = open("mean_stder_stdev.txt", "w")
     for day in day_labels:
         file.write("\n")
@@ -761,6 +919,26 @@ def find_all_avgs_ers(day_labels, mouse_nums, times, master_tt_dic): #Ultimately
                     file.write("There is no data for this cycle\n")
     file.close()
 
+def write_avgs_ers(day_labels, mouse_nums, times, all_cycle_stats):
+    """Writes mean_stder_stdev.txt just like find_all_avgs_ers, from each mouse's (n, mean, stdev)
+    arrays (see mouse_cycle_stats), given in mouse_nums order."""
+    file = open("mean_stder_stdev.txt", "w")
+    for i, day in enumerate(day_labels):
+        file.write("\n")
+        file.write(day + "\n")
+        for mouse, (n, mean, std_dev) in zip(mouse_nums, all_cycle_stats):
+            file.write("\n")
+            file.write("Mouse" + mouse + "\n")
+            for j, cycle in enumerate(times):
+                file.write(cycle + "\n")
+                if n[i, j] > 0: #needed for files w/o a cycle
+                    file.write("Mean:" + str(mean[i, j]) + "\n")
+                    file.write("Population STD error:" + str(std_dev[i, j] / math.sqrt(n[i, j])) + "\n")
+                    file.write("Population STD deviation:"+ str(std_dev[i, j]) + "\n")
+                else:
+                    file.write("There is no data for this cycle\n")
+    file.close()
+
 def n_pt_mavg(CBT_list, n_ints_in_mavg):
     """Given a list of CBTs (floats) and an integer, returns a new list of averaged pts (n point
     moving averages). First and last edge points simply have fewer points averaged.
@@ -784,6 +962,7 @@ def n_moving_stdev(CBT_list, n_stdev):
     """Given a list of CBTs (floats) and an integer, returns a new list of standard deviation of
     selected pts (number of points used is n_stdev). First and last edge points simply have fewer points averaged.
     NOTE- even numbered n_stdev will take (n_stdev/2) pts before and after the selected point."""
+    from scipy import stats
     left_norm = n_stdev/2 + 1
     right_norm = n_stdev/2
     new_list = []
@@ -791,13 +970,457 @@ def n_moving_stdev(CBT_list, n_stdev):
     for temp in CBT_list:
         count += 1
         if count <= n_stdev/2:
-            new_list.append(scipy.stats.tstd(CBT_list[count-count:count+right_norm]))
+            new_list.append(stats.tstd(CBT_list[count-count:count+right_norm]))
         elif count >= len(CBT_list)-right_norm:
-            new_list.append(scipy.stats.tstd(CBT_list[count-left_norm:len(CBT_list)]))
+            new_list.append(stats.tstd(CBT_list[count-left_norm:len(CBT_list)]))
         else:
-            new_list.append(scipy.stats.tstd(CBT_list[count-left_norm:count+right_norm]))
+            new_list.append(stats.tstd(CBT_list[count-left_norm:count+right_norm]))
     return new_list
 
+def window_bounds(n_points, n_window):
+    """Given the number of points and the number of points in a moving window, returns a list of
+    (start, end) slice bounds of the window around each point, using the same convention as
+    n_pt_mavg and n_moving_stdev: n_window/2 pts before and after the point, edge points simply
+    have fewer."""
+    half = n_window/2
+    return [(max(0, i-half), min(n_points, i+half+1)) for i in range(n_points)]
+
+def n_moving_extreme(CBT_list, n_points, keep_first):
+    """Given a list of CBTs, the number of points in the window and a function of (older CBT,
+    newer CBT) that is True when the older one should stay in front (ie <= for a minimum),
+    returns the moving minimum/maximum using a monotonic deque of indexes. Every CBT is
+    added and removed once, so this is O(n) whatever the window size."""
+    extremes = []
+    candidates = collections.deque()
+    added = 0
+    for start, end in window_bounds(len(CBT_list), n_points):
+        while added < end:
+            while candidates and not keep_first(CBT_list[candidates[-1]], CBT_list[added]):
+                candidates.pop()
+            candidates.append(added)
+            added += 1
+        while candidates[0] < start:
+            candidates.popleft()
+        extremes.append(CBT_list[candidates[0]])
+    return extremes
+
+def n_moving_min(CBT_list, n_points):
+    """Given a list of CBTs (floats) and an integer, returns the n point moving minimum (see
+    window_bounds for the window around each point)."""
+    return n_moving_extreme(CBT_list, n_points, lambda older, newer: older <= newer)
+
+def n_moving_max(CBT_list, n_points):
+    """Given a list of CBTs (floats) and an integer, returns the n point moving maximum (see
+    window_bounds for the window around each point)."""
+    return n_moving_extreme(CBT_list, n_points, lambda older, newer: older >= newer)
+
+def prune_heap(heap, start, n_live):
+    """Pops the entries of a moving window heap (see n_moving_percentile) whose index has left the
+    window (is before start) off its top. Once the heap holds more than twice its n_live entries
+    still in the window, it is rebuilt without the others, so it never grows much past the window."""
+    if len(heap) > 2 * n_live + 32:
+        heap[:] = [entry for entry in heap if abs(entry[1]) >= start]
+        heapq.heapify(heap)
+    while heap and abs(heap[0][1]) < start:
+        heapq.heappop(heap)
+
+def heap_window_percentile(CBT_list, n_points, percentile):
+    """n_moving_percentile for long windows. The window is split into two heaps: the lowest CBTs up
+    to the lower of the two order statistics the percentile falls between (a max heap) and the rest
+    (a min heap). CBTs leaving the window are only marked as gone (their index is before the
+    window) and dropped when they reach the top, so each step is O(log n_points)."""
+    percentiles = []
+    low = []        #(-CBT, -index), the max heap of the lowest CBTs
+    high = []       #(CBT, index), the min heap of the rest
+    in_low = []     #whether each CBT added went into low
+    n_low = 0       #CBTs of the window in each heap
+    n_high = 0
+    added = 0
+    removed = 0
+    for start, end in window_bounds(len(CBT_list), n_points):
+        while added < end:
+            prune_heap(low, removed, n_low)
+            if low and (CBT_list[added], added) < (-low[0][0], -low[0][1]):
+                heapq.heappush(low, (-CBT_list[added], -added))
+                in_low.append(True)
+                n_low += 1
+            else:
+                heapq.heappush(high, (CBT_list[added], added))
+                in_low.append(False)
+                n_high += 1
+            added += 1
+        while removed < start:
+            if in_low[removed]:
+                n_low -= 1
+            else:
+                n_high -= 1
+            removed += 1
+        position = percentile / 100.0 * (n_low + n_high - 1)
+        lower = int(position)
+        while n_low > lower + 1:
+            prune_heap(low, removed, n_low)
+            value, index = heapq.heappop(low)
+            heapq.heappush(high, (-value, -index))
+            in_low[-index] = False
+            n_low -= 1
+            n_high += 1
+        while n_low < lower + 1:
+            prune_heap(high, removed, n_high)
+            value, index = heapq.heappop(high)
+            heapq.heappush(low, (-value, -index))
+            in_low[index] = True
+            n_low += 1
+            n_high -= 1
+        prune_heap(low, removed, n_low)
+        lower_value = -low[0][0]
+        if n_high > 0 and position > lower:
+            prune_heap(high, removed, n_high)
+            percentiles.append(lower_value + (high[0][0] - lower_value) * (position - lower))
+        else:
+            percentiles.append(lower_value)
+    return percentiles
+
+def sorted_window_percentile(CBT_list, n_points, percentile):
+    """n_moving_percentile for short windows. The window is kept as a sorted list; each step only
+    inserts and removes the CBTs entering and leaving it (bisect). Moving the list's items is
+    O(n_points) per step, but it is a memmove, which is faster than the heaps' Python-level work
+    until windows of about 10000 points."""
+    percentiles = []
+    window = []
+    added = 0
+    removed = 0
+    for start, end in window_bounds(len(CBT_list), n_points):
+        while added < end:
+            bisect.insort(window, CBT_list[added])
+            added += 1
+        while removed < start:
+            del window[bisect.bisect_left(window, CBT_list[removed])]
+            removed += 1
+        position = percentile / 100.0 * (len(window) - 1)
+        lower = int(position)
+        upper = min(lower + 1, len(window) - 1)
+        percentiles.append(window[lower] + (window[upper] - window[lower]) * (position - lower))
+    return percentiles
+
+#windows longer than this use the heaps (see sorted_window_percentile)
+HEAP_PERCENTILE_POINTS = 4096
+
+def n_moving_percentile(CBT_list, n_points, percentile):
+    """Given a list of CBTs (floats), an integer and a percentile (0 to 100), returns the n point
+    moving percentile, linearly interpolated like np.percentile (see window_bounds for the window
+    around each point). Each step only updates the window with the CBTs entering and leaving it,
+    instead of sorting every window: O(n log n_points) with heaps for long windows."""
+    if n_points > HEAP_PERCENTILE_POINTS:
+        return heap_window_percentile(CBT_list, n_points, percentile)
+    return sorted_window_percentile(CBT_list, n_points, percentile)
+
+def n_moving_median(CBT_list, n_points):
+    """Given a list of CBTs (floats) and an integer, returns the n point moving median (see
+    window_bounds for the window around each point). Removes single sample spikes that a moving
+    average would smear into their neighbours."""
+    return n_moving_percentile(CBT_list, n_points, 50)
+
+#moving statistics by name, all called as function(CBT_list, n_points)
+MOVING_STATISTICS = {'mean': n_pt_mavg, 'stdev': n_moving_stdev, 'median': n_moving_median,
+                     'min': n_moving_min, 'max': n_moving_max}
+
+def make_moving_stat_master_dic(day_labels, mouse_nums, times, master_tt_dic, n_points, statistic):
+    """Just like make_mav_master_dic, but for any of the MOVING_STATISTICS (ie 'median')."""
+    moving_stat = MOVING_STATISTICS[statistic]
+    stat_master_dic = {}
+    for day in day_labels:
+        stat_master_dic[day] = {}
+        for mouse in mouse_nums:
+            stat_master_dic[day][mouse] = {}
+            for cycle in times:
+                stat_master_dic[day][mouse][cycle] = moving_stat(list_CBT(day, mouse, cycle, master_tt_dic), n_points)
+    return stat_master_dic
+
+####################################################
+#### Plot templates
+#### Each plot family (daily avgs, moving stdev, pre/post per mouse) builds its figure, axes,
+#### labels, limits, ticks and grid once. Only the data and titles are swapped for each png.
+####################################################
+
+def setup_avg_plot_axes(ax, ylims):
+    """Given a matplotlib axes and a list of [min, max] CBTs, sets the labels, limits, ticks and
+    grid shared by every daily average plot. Returns the empty scatter artist that later holds
+    each day's data."""
+    artist = ax.scatter([], [])
+    ax.set_ylabel("CBT in deg. C")
+    ax.set_xlabel("Time of day in hours")
+    ax.set_xlim(0, 24)
+    ax.set_ylim(ylims[0], ylims[1])
+    ax.set_xticks(np.arange(0,24,1))
+    ax.set_yticks(np.arange(ylims[0], ylims[1], 0.5))
+    ax.grid()
+    return artist
+
+def setup_n_moving_stdv_axes(ax, n_stdev, ylims):
+    """Given a matplotlib axes, the number of points in the moving standard deviation and a list
+    of [min, max] stdevs, sets the labels, limits, ticks and grid shared by every moving stdev
+    plot. Returns the empty line artist that later holds each day's and mouse's data."""
+    artist, = ax.plot([], [], 'b.-')
+    ax.set_ylabel("%s point sample std. deviation" %(str(n_stdev)))
+    ax.set_xlabel("Time of Day (hrs)")
+    ax.set_xlim(0, 24)
+    ax.set_ylim(ylims[0], ylims[1])
+    ax.set_xticks(np.arange(0,24,1))
+    ax.set_yticks(np.arange(ylims[0], ylims[1], 0.1))
+    ax.grid()
+    return artist
+
+def setup_pre_post_axes(ax, pre_post):
+    """Given a matplotlib axes and either "Pre" or "Post", sets the labels and limits of one half
+    of a pre/post plot of a single mouse. Returns the empty scatter artist."""
+    artist = ax.scatter([], [])
+    if pre_post == "Pre":
+        ax.set_ylabel('CBT in deg. C')
+    else:
+        ax.set_xlabel('Time of Day in seconds')
+    ax.set_title(pre_post)
+    ax.set_xlim(0, 86400)
+    ax.set_ylim(34.5, 39)
+    return artist
+
+def make_plot_template(setup_axes, setup_args):
+    """Given a function that sets up one axes (such as setup_avg_plot_axes) and a list of the other
+    arguments it takes, returns a dictionary holding the figure, the artist(s) that are refilled
+    with data (the setup function returns one artist or a list of them), and the title.
+    setup_axes and setup_args are kept so the same axes can be rebuilt later."""
+    plt = load_pyplot()
+    fig = plt.figure()
+    ax = fig.gca()
+    artists = setup_axes(ax, *setup_args)
+    if not isinstance(artists, list):   #most plots have a single artist
+        artists = [artists]
+    title = ax.set_title("")
+    return {'fig': fig, 'artists': artists, 'titles': [title],
+            'setup_axes': setup_axes, 'setup_args': setup_args}
+
+def make_avg_plot_template(ylims):
+    """Returns a plot template (see make_plot_template) for the daily average plots."""
+    return make_plot_template(setup_avg_plot_axes, [ylims])
+
+def make_n_moving_stdv_template(n_stdev, ylims):
+    """Returns a plot template (see make_plot_template) for the moving standard deviation plots."""
+    return make_plot_template(setup_n_moving_stdv_axes, [n_stdev, ylims])
+
+def make_pre_post_template():
+    """Returns a plot template for the two-panel (pre above post) plots of a single mouse. Its
+    title is the figure's suptitle rather than an axes title."""
+    plt = load_pyplot()
+    fig = plt.figure()
+    pre_artist = setup_pre_post_axes(fig.add_subplot(211), "Pre")
+    post_artist = setup_pre_post_axes(fig.add_subplot(212), "Post")
+    title = fig.suptitle("")
+    return {'fig': fig, 'artists': [pre_artist, post_artist], 'titles': [title],
+            'setup_axes': None, 'setup_args': []}
+
+def update_plot_template(template, data, titles):
+    """Given a plot template, a list of (x data, y data) pairs (one per artist in the template) and
+    a list of title strings, swaps the new data and titles into the existing figure."""
+    for artist, xy in zip(template['artists'], data):
+        if hasattr(artist, 'set_data'):     #lines
+            artist.set_data(xy[0], xy[1])
+        else:                               #scatter plots
+            artist.set_offsets(np.column_stack((xy[0], xy[1])))
+    for text, title in zip(template['titles'], titles):
+        text.set_text(title)
+
+def save_plot_template(template, path):
+    """Saves the current contents of a plot template to the given path."""
+    template['fig'].savefig(path)
+
+####################################################
+#### Figure cache
+#### Each png records a hash of everything it was drawn from (data, titles, axes settings) in a
+#### manifest in its folder. A figure whose file exists and whose hash hasn't changed since the last
+#### run is not drawn again, so a small data or config change only redraws the figures it touches.
+####################################################
+
+FIGURE_MANIFEST = 'figure_manifest.json'
+FIGURE_CACHE_VERSION = 1     #bump when the drawing code changes so every figure is redrawn once
+
+def hash_figure_input(digest, value):
+    """Given a hashlib digest and a plot input (numbers, strings, arrays, or lists, tuples and
+    dictionaries of them), adds the input to the digest. Long lists of numbers are hashed as one
+    float array, which is much faster than hashing each number."""
+    if isinstance(value, dict):
+        digest.update('{%d' %len(value))
+        for key in sorted(value):
+            hash_figure_input(digest, key)
+            hash_figure_input(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        if len(value) > 0 and all(isinstance(v, (int, long, float, np.number)) for v in value[:1]):
+            try:
+                value = np.asarray(value, dtype=float)
+            except (TypeError, ValueError):
+                pass
+        if isinstance(value, np.ndarray):
+            hash_figure_input(digest, value)
+            return
+        digest.update('[%d' %len(value))
+        for v in value:
+            hash_figure_input(digest, v)
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        digest.update('%s%s' %(value.dtype.str, value.shape))
+        digest.update(value.tobytes())
+    elif callable(value):
+        digest.update(value.__name__)
+    else:
+        digest.update(repr(value))
+
+def figure_key(*inputs):
+    """Given everything a figure is drawn from, returns a hex string that changes whenever any of
+    the inputs (or the drawing code version, or matplotlib's version) changes."""
+    import matplotlib
+    digest = hashlib.sha1()
+    hash_figure_input(digest, [FIGURE_CACHE_VERSION, matplotlib.__version__])
+    for value in inputs:
+        hash_figure_input(digest, value)
+    return digest.hexdigest()
+
+def template_figure_key(template, data, titles):
+    """Given a plot template and the data and titles it is about to be filled with (see
+    update_plot_template), returns the figure key (see figure_key) of the resulting plot."""
+    return figure_key(template['setup_axes'] or 'pre post', template['setup_args'], data, titles)
+
+def load_figure_manifest(directory):
+    """Given a directory, returns its figure manifest: a dictionary of png file name mapped to the
+    key of the figure it holds. Returns an empty dictionary if there is no (readable) manifest."""
+    path = os.path.join(directory, FIGURE_MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except ValueError:      #half-written by an interrupted run; every figure is redrawn
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+def save_figure_manifest(directory, manifest):
+    """Given a directory and its figure manifest, saves the manifest in the directory."""
+    path = os.path.join(directory, FIGURE_MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    if os.path.exists(path):
+        os.remove(path)     #os.rename doesn't replace files on Windows
+    os.rename(path + '.tmp', path)
+
+def figure_is_current(manifest, path, key):
+    """Given a figure manifest, the path of a figure and the figure's key, returns True if the
+    figure file exists and was drawn from the same inputs."""
+    return manifest.get(os.path.basename(path)) == key and os.path.exists(path)
+
+def unchanged_figure(path, key):
+    """Given the path of a figure that is drawn on its own (not from a plot template) and its key,
+    returns True if the existing file is already current, so drawing it can be skipped."""
+    return figure_is_current(load_figure_manifest(os.path.dirname(path) or '.'), path, key)
+
+def record_figure(path, key):
+    """Given the path of a figure that was just saved and its key, records it in its folder's
+    figure manifest."""
+    directory = os.path.dirname(path) or '.'
+    manifest = load_figure_manifest(directory)
+    manifest[os.path.basename(path)] = key
+    save_figure_manifest(directory, manifest)
+
+####################################################
+#### Plot output formats
+#### "png" saves one file per plot (the original behaviour), "pdf" saves each plot family as one
+#### multi-page pdf, and "contact sheet" tiles each plot family into a single png.
+####################################################
+
+GRAPH_OUTPUT_FORMATS = ['png', 'pdf', 'contact sheet']
+
+def extract_graph_output_format(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Graph output format', returns the lower case string in the cell to the right (one of
+    GRAPH_OUTPUT_FORMATS). Returns 'png' if the row is missing or the cell is empty, and raises
+    ValueError for anything else, so a mistyped format isn't quietly drawn as png."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Graph output format' in line[0]:
+            if line[1].strip():
+                output_format = ' '.join(line[1].lower().split())
+                if output_format not in GRAPH_OUTPUT_FORMATS:
+                    raise ValueError('Graph output format %r is not one of %s'
+                                     %(line[1].strip(), ', '.join(GRAPH_OUTPUT_FORMATS)))
+                return output_format
+    return 'png'
+
+def open_plot_output(output_format, path):
+    """Given an output format and the path of the combined file ('.pdf' or '.png' is added to it),
+    returns a dictionary that collects the plots of one plot family until close_plot_output is
+    called. The path is not used for 'png' output, where every plot is its own file."""
+    output = {'format': output_format, 'path': path, 'panels': [], 'manifests': {}, 'skipped': 0}
+    if output_format == 'pdf':
+        from matplotlib.backends.backend_pdf import PdfPages
+        output['path'] = path + '.pdf'
+        output['pdf'] = PdfPages(output['path'])
+    elif output_format == 'contact sheet':
+        output['path'] = path + '.png'
+    return output
+
+def write_plot(output, template, data, titles, png_path):
+    """Given a plot output (from open_plot_output), a plot template, the template's data and titles
+    (see update_plot_template) and the path the plot would have as its own png, adds the plot to
+    the output: a png file, a pdf page, or a panel of the contact sheet. A png that is already
+    current (see figure_is_current) is left as it is."""
+    if output['format'] == 'contact sheet':
+        output['panels'].append((data, titles))     #drawn all at once in close_plot_output
+        return
+    if output['format'] == 'pdf':
+        update_plot_template(template, data, titles)
+        output['pdf'].savefig(template['fig'])
+        return
+    directory = os.path.dirname(png_path) or '.'
+    if directory not in output['manifests']:
+        output['manifests'][directory] = load_figure_manifest(directory)
+    manifest = output['manifests'][directory]
+    key = template_figure_key(template, data, titles)
+    if figure_is_current(manifest, png_path, key):
+        output['skipped'] += 1
+        return
+    update_plot_template(template, data, titles)
+    save_plot_template(template, png_path)
+    manifest[os.path.basename(png_path)] = key
+
+def close_plot_output(output, template):
+    """Finishes a plot output: closes the pdf, draws and saves the contact sheet (unless none of
+    its panels changed), or saves the figure manifests of the pngs."""
+    if output['format'] == 'pdf':
+        output['pdf'].close()
+    elif output['format'] == 'contact sheet' and len(output['panels']) > 0:
+        key = figure_key(template['setup_axes'] or 'pre post', template['setup_args'],
+                         output['panels'])
+        if not unchanged_figure(output['path'], key):
+            save_contact_sheet(template, output['panels'], output['path'])
+            record_figure(output['path'], key)
+    for directory, manifest in output['manifests'].items():
+        save_figure_manifest(directory, manifest)
+
+def save_contact_sheet(template, panels, path):
+    """Given a plot template, a list of (data, titles) panels and a path, saves a single png where
+    each panel is a tile whose axes are set up exactly like the template's axes."""
+    plt = load_pyplot()
+    n_cols = int(math.ceil(math.sqrt(len(panels))))
+    n_rows = int(math.ceil(len(panels) / float(n_cols)))
+    fig = plt.figure(figsize=(4*n_cols, 3*n_rows))
+    for i in range(len(panels)):
+        ax = fig.add_subplot(n_rows, n_cols, i+1)
+        artists = template['setup_axes'](ax, *template['setup_args'])
+        if not isinstance(artists, list):
+            artists = [artists]
+        ax.tick_params(labelsize='x-small')
+        tile = {'artists': artists, 'titles': [ax.set_title("", fontsize='small')]}
+        update_plot_template(tile, panels[i][0], panels[i][1])
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
 def extract_n_moving_stdv_axis(filename):
     """Given a .csv file where the first cell in one of the rows contains the phrase
     'Analyze last n days pre treatment", returns the integer to the right of that cell."""
@@ -808,14 +1431,26 @@ def extract_n_moving_stdv_axis(filename):
             max_bound = float(line[2])
             return [min_bound, max_bound]
         
-def plot_n_moving_stdv(day_list, mouse_list, cycle_list, master_tt_dic, n_stdev, filename):
+def plot_n_moving_stdv(day_list, mouse_list, cycle_list, master_tt_dic, n_stdev, filename,
+                       stdev_master_dic=None, hours_master_dic=None):
     """Given a list of days (strings), mouse numbers (strings), cycles (strings), the master_tt_dic,
     and the number of points to be used in calculating the standard deviation, saves a plot
     of time of day vs.standard deviation of range given to analyze around that time. Saves one plot
-    per day per mouse."""
+    per day per mouse, or one pdf/contact sheet per mouse (see 'Graph output format').
+    If a stdev_master_dic (see make_gap_aware_stat_master_dic) and the hours_master_dic of its
+    times (see make_gap_aware_hours_master_dic) are given, its moving standard deviations are
+    plotted instead of ones calculated over each whole day. Their windows stop at recording gaps
+    and at the end of each cycle, so the first and last few points of each cycle differ from
+    whole-day windows even without gaps."""
+    plt = load_pyplot()
     ylims = extract_n_moving_stdv_axis(filename)
-    for day in day_list:
-        for mouse in mouse_list:
+    output_format = extract_graph_output_format(filename)
+    template = make_n_moving_stdv_template(n_stdev, ylims) #axes are only built once
+    directory = str(n_stdev)+"_moving stdv graphs"
+    for mouse in mouse_list:
+        output = open_plot_output(output_format,
+                                  os.path.join(directory, "%s_pt_stdv_plots_mouse_%s" %(str(n_stdev), mouse)))
+        for day in day_list:
             CBT_list = []
             time_list = []
             for cycle in cycle_list:
@@ -824,27 +1459,88 @@ def plot_n_moving_stdv(day_list, mouse_list, cycle_list, master_tt_dic, n_stdev,
                 #this combines dark and light cycle for each day
                 CBT_list.extend(CBT_list_first)
                 time_list.extend(time_list_first)
-            stdev_lst = n_moving_stdev(CBT_list, n_stdev)
-                
+            if stdev_master_dic is None:
+                stdev_lst = n_moving_stdev(CBT_list, n_stdev)
+            else:
+                stdev_lst = []
+                time_list = []      #the sample arrays' times, in the same order as the stdevs
+                for cycle in cycle_list:
+                    stdev_lst.extend(stdev_master_dic[day][mouse][cycle])
+                    time_list.extend(hours_master_dic[day][mouse][cycle])
+
             #assert len(stdev_lst) == len(CBT_list)
             #assert len(stdev_lst) == len(time_list)
-            
-            fig = plt.figure()
-            ax = fig.gca()
-            
-            plt.figure()
-            plt.plot(time_list, stdev_lst, 'b.-')
-            plt.title("%s pt. Moving Standard Deviation %s, mouse %s" %(str(n_stdev),day, mouse))
-            plt.ylabel("%s point sample std. deviation" %(str(n_stdev))) 
-            plt.xlabel("Time of Day (hrs)")
-            plt.xlim(0, 24)
-            plt.ylim(0, 0.6, 0.1)
-            ax.set_xticks(np.arange(0,24,1)) 
-            ax.set_yticks(np.arange(0,0.6, 0.1))  
-            plt.grid()
-            plt.savefig(str(n_stdev)+"_moving stdv graphs/%s_pt_stdv_plot_%s_mouse_%s.png" %(str(n_stdev),day, mouse))
-            plt.close()
+
+            write_plot(output, template, [(time_list, stdev_lst)],
+                       ["%s pt. Moving Standard Deviation %s, mouse %s" %(str(n_stdev),day, mouse)],
+                       os.path.join(directory, "%s_pt_stdv_plot_%s_mouse_%s.png" %(str(n_stdev),day, mouse)))
+        close_plot_output(output, template)
+    plt.close(template['fig'])
     
+def extract_moving_envelope_points(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Moving median and envelope number of points', returns the integer to the right of that cell,
+    or None (no envelope plots) if it is empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Moving median and envelope number of points' in line[0]:
+            if line[1].strip():
+                return int(line[1])
+    return None
+
+def setup_moving_envelope_axes(ax, n_points, ylims, light_start_hours):
+    """Given a matplotlib axes, the number of points in the moving window, a list of [min, max]
+    CBTs and the start of the light cycle in hours, sets up a circadian day (light start to light
+    start) of CBTs with their moving median and min/max envelope. Returns the list of artists:
+    CBTs, median, min and max."""
+    artists = [ax.plot([], [], 'k.', markersize=3)[0],
+               ax.plot([], [], 'r-', label="%s pt. moving median" %str(n_points))[0],
+               ax.plot([], [], 'b:', label="%s pt. moving min/max" %str(n_points))[0],
+               ax.plot([], [], 'b:')[0]]
+    ax.set_ylabel("CBT in deg. C")
+    ax.set_xlabel("Time of day in hours")
+    ax.set_xlim(light_start_hours, light_start_hours + 24)
+    ax.set_ylim(ylims[0], ylims[1])
+    ax.set_xticks(np.arange(int(light_start_hours), light_start_hours + 25, 2))
+    ax.set_xticklabels([str(hour % 24) for hour in range(int(light_start_hours), int(light_start_hours) + 25, 2)])
+    ax.legend(loc='lower right', fontsize='small')
+    ax.grid()
+    return artists
+
+def plot_moving_envelopes(day_list, mouse_list, master_tt_dic, filename):
+    """Given a list of days (strings), mouse numbers (strings), the master_tt_dic and the
+    user_modify file, plots each day of each mouse (light cycle then dark cycle) with the moving
+    median and moving min/max envelope of its CBTs, if 'Moving median and envelope number of
+    points' is set. Saves one plot per day per mouse, or one pdf/contact sheet per mouse."""
+    plt = load_pyplot()
+    n_points = extract_moving_envelope_points(filename)
+    if n_points is None:
+        return
+    light_start_hours = extract_light_start_secs(filename) / 3600.0
+    template = make_plot_template(setup_moving_envelope_axes,
+                                  [n_points, extract_avg_plot_axis(filename), light_start_hours])
+    output_format = extract_graph_output_format(filename)
+    directory = str(n_points)+"_moving envelope graphs"
+    make_a_directory(directory)
+    for mouse in mouse_list:
+        output = open_plot_output(output_format,
+                                  os.path.join(directory, "%s_pt_envelope_plots_mouse_%s" %(str(n_points), mouse)))
+        for day in day_list:
+            CBT_list = []
+            hours = []
+            for cycle in ["Light Cycle", "Dark Cycle"]:     #in time order
+                CBT_list.extend(list_CBT(day, mouse, cycle, master_tt_dic))
+                hours.extend(list_times(day, mouse, cycle, master_tt_dic))
+            #hours after midnight continue past 24 so the day plots as one continuous line
+            hours = [hour + 24 if hour < light_start_hours else hour for hour in hours]
+            write_plot(output, template,
+                       [(hours, CBT_list), (hours, n_moving_median(CBT_list, n_points)),
+                        (hours, n_moving_min(CBT_list, n_points)), (hours, n_moving_max(CBT_list, n_points))],
+                       ["%s pt. Moving Median and Envelope %s, mouse %s" %(str(n_points), day, mouse)],
+                       os.path.join(directory, "%s_pt_envelope_plot_%s_mouse_%s.png" %(str(n_points), day, mouse)))
+        close_plot_output(output, template)
+    plt.close(template['fig'])
+
 def make_mav_master_dic(day_labels, mouse_nums, times, master_tt_dic, n_ints_in_mavg):
     mav_master_dic = {}
     for day in day_labels:
@@ -874,26 +1570,17 @@ def get_y_axis(tt_dic, mouse, pre_post):
         y_data.append(tt[1])
     return y_data
         
-def plot_mouse(x_pre, y_pre, x_post, y_post, tx1_tx2, mouse):
-    """Saves a plot of CBT vs. time for given mouse in given day and cycle"""
-    plt.figure()
-    
-    plt.subplot(211)
-    plt.scatter(x_pre, y_pre)
-    plt.ylabel('CBT in deg. C')
-    plt.title("Pre")
-    plt.xlim(0, 86400)
-    plt.ylim(34.5, 39)
-    
-    plt.subplot(212)
-    plt.scatter(x_post, y_post)
-    plt.xlabel('Time of Day in seconds')
-    plt.title("Post")
-    plt.xlim(0, 86400)
-    plt.ylim(34.5, 39)
-    
-    plt.suptitle("Mouse "+ mouse)
-    plt.savefig("2_day_pre_post_" + mouse + ".png")
+def plot_mouse(x_pre, y_pre, x_post, y_post, tx1_tx2, mouse, template=None):
+    """Saves a plot of CBT vs. time for given mouse in given day and cycle. Pass the same template
+    (from make_pre_post_template) when plotting many mice so the axes are only built once."""
+    plt = load_pyplot()
+    own_template = template is None
+    if own_template:
+        template = make_pre_post_template()
+    update_plot_template(template, [(x_pre, y_pre), (x_post, y_post)], ["Mouse "+ mouse])
+    save_plot_template(template, "2_day_pre_post_" + mouse + ".png")
+    if own_template:
+        plt.close(template['fig'])
 
 
 def daily_temps_dic(master_tt_dic):
@@ -938,28 +1625,27 @@ def extract_avg_plot_axis(filename):
             max_bound = int(line[2])
             return [min_bound, max_bound]
         
-def avg_plot(daily_avgs, day, ylims):
-    """Given master_tt_dic and a day, plots an average of all mice CBTs for that day"""
-    plt.figure()
+def avg_plot(daily_avgs, day, ylims, template=None, output=None):
+    """Given master_tt_dic and a day, plots an average of all mice CBTs for that day. Pass the
+    same template (from make_avg_plot_template) for every day so the axes are only built once,
+    and an output (from open_plot_output) to collect the day as a pdf page or contact sheet tile."""
+    plt = load_pyplot()
+    own_template = template is None
+    if own_template:
+        template = make_avg_plot_template(ylims)
+    own_output = output is None
+    if own_output:
+        output = open_plot_output('png', None)
     x_data = x_times(daily_avgs, day)
     y_data = y_avgs(daily_avgs, day)
 
-    fig = plt.figure()
-    ax = fig.gca()
-        
-    plt.scatter(x_data, y_data)
-    plt.ylabel("CBT in deg. C")
-    plt.xlabel("Time of day in hours")
-    plt.title("Mouse CBT averaged for " + day)
-    plt.xlim(0, 24)
-    plt.ylim(ylims[0], ylims[1])
-    
-    ax.set_xticks(np.arange(0,24,1))
-    ax.set_yticks(np.arange(ylims[0], ylims[1], 0.5))
-    plt.grid()
     #saves to directory 'avg_plot graphs'
-    plt.savefig(os.path.join('avg_plot graphs', day + '_mouse_avgs.png'))
-    plt.close()
+    write_plot(output, template, [(x_data, y_data)], ["Mouse CBT averaged for " + day],
+               os.path.join('avg_plot graphs', day + '_mouse_avgs.png'))
+    if own_output:
+        close_plot_output(output, template)
+    if own_template:
+        plt.close(template['fig'])
 
 def make_a_directory(directory_name):
     """Given a string that you want to be the directory name, makes a directory with that name in
@@ -969,10 +1655,16 @@ def make_a_directory(directory_name):
     
 def all_avg_plots(master_tt_dic, filename):
     """Saves all averaged daily plots"""
+    plt = load_pyplot()
     daily_avgs = daily_temps_dic(master_tt_dic)
     ylims = extract_avg_plot_axis(filename)
-    for day in daily_avgs:
-        avg_plot(daily_avgs, day, ylims)
+    template = make_avg_plot_template(ylims)
+    output = open_plot_output(extract_graph_output_format(filename),
+                              os.path.join('avg_plot graphs', 'all_days_mouse_avgs'))
+    for day in sort_day_labels_by_date(daily_avgs):
+        avg_plot(daily_avgs, day, ylims, template, output)
+    close_plot_output(output, template)
+    plt.close(template['fig'])
         
 ####################################################
 
@@ -988,26 +1680,31 @@ def get_last_two_cycles_moving_stdev(master_tt_dic, mouse, n_stdev, last_two_cyc
     light_cycle.extend(n_moving_stdev(list_CBT(last_two_cycles[1], mouse, 'Dark Cycle', master_tt_dic), n_stdev)) 
     return [str(np.mean(dark_cycle)), str(np.mean(light_cycle))]
 
-def get_all_last_2_cycles_moving_stdev(master_tt_dic, tx1_mice, tx2_mice, n_stdev, last_two_cycles):
+def get_all_last_2_cycles_moving_stdev(master_tt_dic, groups, n_stdev, last_two_cycles,
+                                       executor=None, day_labels=None, times=None):
     """Prints each cycle's average moving standard deviation for all mice, also prints the
-    treatment group the mouse belonged to"""
+    treatment group the mouse belonged to (groups is a list of (group name, list of mice)). If an
+    executor is given (see make_mouse_executor, made from the given day_labels and times), the
+    mice are split over its worker processes."""
+    mean_lsts = {}
+    if executor is not None:
+        day_indexes = [day_labels.index(day) for day in last_two_cycles]
+        mice = group_mice(groups)
+        results = map_mice(executor, mouse_last_two_cycles_moving_stdev, mice,
+                           (day_indexes, times.index('Dark Cycle'), n_stdev))
+        mean_lsts = dict(zip(mice, results))
     file = open("all_last_2_cycles_moving_stdev.txt", "w")
     
-    file.write("Treatment 1 Mice-Avg of last two full days' %s pt. moving stdev" %(str(n_stdev)) + '\n')
-    for mouse in tx1_mice:
-        file.write("Mouse "+ mouse + '\n')
-        mean_lst = get_last_two_cycles_moving_stdev(master_tt_dic, mouse, n_stdev, last_two_cycles)
-        file.write("Dark Cycle: " + mean_lst[0] + '\n')
-        file.write("Light Cycle: " + mean_lst[1] + '\n')
-        file.write('\n')
-    file.write('\n')
-    file.write("Treatment 2 Mice-Avg of last two full days' %s pt. moving stdev" %str((n_stdev)) + '\n')
-    for mouse in tx2_mice:
-        file.write("Mouse" + mouse + '\n')
-        tx2_mean_lst = get_last_two_cycles_moving_stdev(master_tt_dic, mouse, n_stdev, last_two_cycles)
-        file.write("Dark Cycle: " + tx2_mean_lst[0] + '\n')
-        file.write("Light Cycle: " + tx2_mean_lst[1] + '\n')
-        file.write('\n') 
+    for i, (group, mice) in enumerate(groups):
+        if i > 0:
+            file.write('\n')
+        file.write("%s Mice-Avg of last two full days' %s pt. moving stdev" %(group, str(n_stdev)) + '\n')
+        for mouse in mice:
+            file.write("Mouse "+ mouse + '\n')
+            mean_lst = mean_lsts.get(mouse) or get_last_two_cycles_moving_stdev(master_tt_dic, mouse, n_stdev, last_two_cycles)
+            file.write("Dark Cycle: " + mean_lst[0] + '\n')
+            file.write("Light Cycle: " + mean_lst[1] + '\n')
+            file.write('\n')
         
 def make_organized_time_temp_list(last_four_days, times, mouse_list, all_times_dic):
     """Given a list of days, cycles, mice, and master/all_times dict, returns a list of
@@ -1035,6 +1732,8 @@ def make_time_to_temps_dict(last_four_days, times, mouse_list, all_times_dic):
                 count = 0
             if day_tally > 1:
                 count = saved_count
+            if mouse not in all_times_dic[day]:
+                continue    #no recordings of this mouse on this day
             for cycle in times:
 ##                if day=='8-14-14' and cycle=='Light Cycle':
 ##                    #8-14 light is first treatment cycle
@@ -1061,6 +1760,144 @@ def avg_each_time_CBT(pre_time_temps_d, day_list):
             avg_tt_lst.append( (t[0], np.mean(t[1])) )
     return avg_tt_lst
 
+#################
+#### GROUP TIME POINTS
+#### The group plots' mean and stdev of every treatment group at every time point, for any number
+#### of groups. Each mouse's readings of a day are made into one array, shared by every group and
+#### window the mouse is in, then every group's time points are reduced together: the readings are
+#### labelled with their group and time point, sorted once, and summed with reduceat.
+#################
+
+GROUP_COLORS = ['r', 'b', 'g', 'm', 'c', 'y', 'k']     #treatment 1 red, treatment 2 blue, ...
+
+def group_colors(groups):
+    """Given a list of (group name, list of mice), returns a dictionary of group name mapped to the
+    color of its lines and bands in the group plots."""
+    return dict((group, GROUP_COLORS[i % len(GROUP_COLORS)]) for i, (group, mice) in enumerate(groups))
+
+def make_day_mouse_temps(all_times_dic, days, times, mice):
+    """Given the all_times or master_tt dictionary, a list of days, the cycles and a list of mice,
+    returns a dictionary of (day, mouse) mapped to a (list of clock times, array of CBTs) tuple of
+    the mouse's readings that day, cycles in times order. Mice with no recordings on a day are left
+    out."""
+    day_mouse_temps = {}
+    for day in days:
+        for mouse in mice:
+            if mouse in all_times_dic[day]:
+                readings = [reading for cycle in times for reading in all_times_dic[day][mouse][cycle]]
+                day_mouse_temps[(day, mouse)] = ([key for key, value in readings],
+                                                 np.array([value for key, value in readings], dtype=float))
+    return day_mouse_temps
+
+def group_time_point_stats(day_mouse_temps, days, groups):
+    """Given the arrays of make_day_mouse_temps, the days of a window and a list of (group name,
+    list of mice), returns a dictionary of group name mapped to a dictionary of arrays 'time points',
+    'mean' and 'stdev' (population) over the group's mice at every time point of the window. Time
+    point k of a day is each mouse's k-th reading that day, numbered on from the previous day's
+    time points exactly as make_time_to_temps_dict numbers them (a time point with a NaN reading
+    has a NaN mean). 'day' (index into days) and 'clock' (seconds after midnight, of the first of
+    the group's mice with the reading) place each time point in time, in 'time points' order.
+    Every group is reduced in the same pass."""
+    labels = []
+    points = []
+    day_numbers = []
+    values = []
+    keys = []
+    offsets = [0] * len(groups)
+    for d, day in enumerate(days):
+        for g, (group, mice) in enumerate(groups):
+            n = 0
+            for mouse in mice:
+                n = 0
+                if (day, mouse) in day_mouse_temps:
+                    clocks, temps = day_mouse_temps[(day, mouse)]
+                    n = len(temps)
+                    keys.extend(clocks)
+                    labels.append(np.full(n, g, dtype=int))
+                    points.append(offsets[g] + np.arange(1, n + 1))
+                    day_numbers.append(np.full(n, d, dtype=int))
+                    values.append(temps)
+            offsets[g] += n     #the next day carries on from the group's last mouse's readings
+    stats = dict((group, {'time points': np.array([], dtype=int), 'mean': np.array([]),
+                          'stdev': np.array([]), 'day': np.array([], dtype=int),
+                          'clock': np.array([], dtype=int)}) for group, mice in groups)
+    if len(values) == 0:
+        return stats
+    labels = np.concatenate(labels)
+    points = np.concatenate(points)
+    day_numbers = np.concatenate(day_numbers)
+    values = np.concatenate(values)
+    order = np.lexsort((day_numbers, points, labels))   #stable, so mice stay in group order
+    labels, points, day_numbers, values = labels[order], points[order], day_numbers[order], values[order]
+    changes = (np.diff(labels) != 0) | (np.diff(points) != 0) | (np.diff(day_numbers) != 0)
+    starts = np.flatnonzero(np.concatenate([[True], changes]))
+    counts = np.diff(np.append(starts, len(values)))
+    mean = np.add.reduceat(values, starts) / counts
+    deviations = values - np.repeat(mean, counts)
+    stdev = np.sqrt(np.add.reduceat(deviations * deviations, starts) / counts)
+    group_of = labels[starts]
+    points = points[starts]
+    day_numbers = day_numbers[starts]
+    clock = np.array([hms_to_secs(keys[i]) for i in order[starts]], dtype=int)   #one per time point
+    for g, (group, mice) in enumerate(groups):
+        lo, hi = np.searchsorted(group_of, [g, g + 1])
+        #a day can repeat the last time points of the day before (when the group's last mouse has
+        #no recordings that day); those are kept apart and sorted by value, as the lists are
+        by_mean = np.lexsort((mean[lo:hi], points[lo:hi])) + lo
+        by_stdev = np.lexsort((stdev[lo:hi], points[lo:hi])) + lo
+        stats[group] = {'time points': points[by_mean], 'mean': mean[by_mean],
+                        'stdev': stdev[by_stdev], 'day': day_numbers[by_mean], 'clock': clock[by_mean]}
+    return stats
+
+def make_group_window_stats(all_times_dic, windows, times, groups):
+    """Given the all_times or master_tt dictionary, a list of (window name, list of days), the
+    cycles and a list of (group name, list of mice), returns a dictionary of window name mapped to
+    the group_time_point_stats of its days. Each mouse's readings are only made into arrays once,
+    however many windows and groups they are in."""
+    days = []
+    for name, window_days in windows:
+        days.extend(day for day in window_days if day not in days)
+    day_mouse_temps = make_day_mouse_temps(all_times_dic, days, times, group_mice(groups))
+    return dict((name, group_time_point_stats(day_mouse_temps, window_days, groups))
+                for name, window_days in windows)
+
+def plot_group_lines(path, window_stats, groups, statistic, sample_frequency, ylims, tick_step,
+                     title, xlabel, ylabel, shading=None, bands=None, rotation=None):
+    """Given the path of the png, one window's group statistics (see group_time_point_stats), the
+    groups, the statistic to plot ('mean' or 'stdev'), how often to plot the data points, the
+    [min, max] of the y axis, the spacing of the x ticks (in time points), and the title and axis
+    labels, saves a plot with one line per group. shading can be the window's significant time
+    points (see shading_at_time_points) and bands the window's bootstrap bands (see
+    bands_at_time_points) to draw behind the lines. Plots that haven't changed aren't drawn again
+    (see figure_is_current)."""
+    plt = load_pyplot()
+    colors = group_colors(groups)
+    lines = [(group, parse_list(window_stats[group]['time points'], sample_frequency),
+              parse_list(window_stats[group][statistic], sample_frequency))
+             for group, mice in groups if len(window_stats[group]['time points']) > 0]
+    key = figure_key(lines, colors, ylims, tick_step, title, xlabel, ylabel, shading, bands, rotation)
+    if len(lines) == 0 or unchanged_figure(path, key):
+        return
+    fig = plt.figure()
+    ax = fig.gca()
+    for group, x, y in lines:
+        ax.plot(x, y, '-', color=colors[group], label=group)
+    shade_slots(ax, shading)
+    draw_bands(ax, bands, colors)
+    ax.legend()
+    x_min = min(x.min() for group, x, y in lines)
+    x_max = max(x.max() for group, x, y in lines)
+    ax.set_xticks(np.arange(x_min, x_max + 120, tick_step))
+    if rotation is not None:
+        plt.setp(ax.get_xticklabels(), rotation=rotation)
+    ax.set_ylim(ylims)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    fig.savefig(path)
+    plt.close(fig)
+    record_figure(path, key)
+
 def parse_list(any_list, sample_frequency):
     """Given a list, returns a new list where every nth tuple from the initial list is included.
     N is determined by the given sample_frequency integer."""
@@ -1069,52 +1906,22 @@ def parse_list(any_list, sample_frequency):
     parsed_list = any_list[::sample_frequency]
     return parsed_list
 
-def plot_each_treatment_last_days(last_four_days_pre, last_four_days_post, times, tx2_mice,
-                                  tx1_mice, sample_frequency, all_times_dic):
-    """Given lists of pre and post treatment days, a list of light cycles, lists of treatment 1 and
-    treatment 2 mice, and all_time or master_tt dictionary, saves two plots. One of pre-treatment
-    temperature averages every sample_frequency, and one of post-treatment temperature averages every
-    sample_frequency. Each plot has two lines-one of treatment 1 and treatment 2 averages."""
-    pre_tx2_lst =  make_organized_time_temp_list(last_four_days_pre, times, tx2_mice, all_times_dic)
-    pre_tx1_lst =  make_organized_time_temp_list(last_four_days_pre, times,tx1_mice, all_times_dic)
-    post_tx2_lst =  make_organized_time_temp_list(last_four_days_post, times, tx2_mice, all_times_dic)
-    post_tx1_lst =  make_organized_time_temp_list(last_four_days_post, times, tx1_mice,all_times_dic)
-    #necessary for controling axis
-    fig = plt.figure()
-    ax = fig.gca()
-        
-    x_times = parse_list( make_last_days_x_list(pre_tx2_lst), sample_frequency)
-    y_tx2 = parse_list( make_last_days_y_list(pre_tx2_lst), sample_frequency)
-    y_tx1 = parse_list( make_last_days_y_list(pre_tx1_lst), sample_frequency)
-    #blue is tx2, red is tx1
-    plt.figure()
-    plt.plot(x_times, y_tx2, 'b-', label='Treatment 2')
-    plt.plot(x_times, y_tx1, 'r-', label='Treatment 1')
-    plt.legend()
-    plt.ylim(35, 38.5, .5)
-    plt.xticks(np.arange(min(x_times), max(x_times)+120, 1440))
-    plt.title('Avg. across treatment every time point-pre')
-    plt.xlabel('Time in data points')
-    plt.ylabel('Average CBT in deg C')
-    plt.savefig('last_pre_days_avg.png')
-    #plt.show()
-
-    plt.figure()
-    x_times = parse_list( make_last_days_x_list(post_tx2_lst), sample_frequency)
-    y_tx2 = parse_list( make_last_days_y_list(post_tx2_lst), sample_frequency)
-    y_tx1 = parse_list( make_last_days_y_list(post_tx1_lst), sample_frequency)
-    #blue is tx2, red is tx1
-    plt.figure()
-    plt.plot(x_times, y_tx2, 'b-',label = 'Treatment 2')
-    plt.plot(x_times, y_tx1, 'r-', label = 'Treatment 1')
-    plt.legend()
-    plt.xticks(np.arange(min(x_times), max(x_times)+120, 1440))
-    plt.ylim(35, 38.5, 0.5)
-    plt.title('Avg. across treatment every 30 seconds-post')
-    plt.xlabel('Time (every 1440 is 12 hrs)')
-    plt.ylabel('Average CBT in deg C')
-    plt.savefig('last_post_days_avg.png')
-    #plt.show()
+def plot_each_treatment_last_days(window_stats, groups, sample_frequency, shading=None, bands=None):
+    """Given the group statistics of the last n days pre and post treatment windows (a [pre, post]
+    list, see make_group_window_stats) and the treatment groups, saves two plots. One of
+    pre-treatment temperature averages every sample_frequency, and one of post-treatment temperature
+    averages every sample_frequency. Each plot has one line per treatment group.
+    shading can be a [pre, post] list of arrays of significant time points (see
+    shading_at_time_points) to shade behind the lines, and bands a [pre, post] list of bootstrap
+    confidence bands of each treatment's mean (see bands_at_time_points) to draw behind them."""
+    plot_group_lines('last_pre_days_avg.png', window_stats[0], groups, 'mean', sample_frequency,
+                     [35, 38.5], 1440, 'Avg. across treatment every time point-pre',
+                     'Time in data points', 'Average CBT in deg C',
+                     None if shading is None else shading[0], None if bands is None else bands[0])
+    plot_group_lines('last_post_days_avg.png', window_stats[1], groups, 'mean', sample_frequency,
+                     [35, 38.5], 1440, 'Avg. across treatment every 30 seconds-post',
+                     'Time (every 1440 is 12 hrs)', 'Average CBT in deg C',
+                     None if shading is None else shading[1], None if bands is None else bands[1])
 #####################################################################################################
 
 def stdev_each_time_CBT(pre_time_temps_d, day_list):
@@ -1135,52 +1942,17 @@ def make_stdev_organized_time_temp_list(days, times, mouse_list, pre_time_temps_
     organized_tts_list = sorted(time_pt_tuples_list)
     return organized_tts_list
 
-def plot_stdev_each_treatment_last_days(last_four_days_pre, last_four_days_post, times, tx2_mice,
-                                  tx1_mice, sample_frequency, all_times_dic):
-    """Given lists of pre and post treatment days, a list of light cycles, lists of tx1 and
-    tx2 mice, and all_time or master_tt dictionary, saves two plots. One of pre-treatment
-    temperature averages every sample_frequency, and one of post-treatment temperature averages every
-    sample_frequency. Each plot has two lines-one of tx1 and tx2 averages."""
-    pre_tx2_lst =  make_stdev_organized_time_temp_list(last_four_days_pre, times, tx2_mice, all_times_dic)
-    pre_tx1_lst =  make_stdev_organized_time_temp_list(last_four_days_pre, times, tx1_mice, all_times_dic)
-    post_tx2_lst =  make_stdev_organized_time_temp_list(last_four_days_post, times, tx2_mice, all_times_dic)
-    post_tx1_lst =  make_stdev_organized_time_temp_list(last_four_days_post, times,tx1_mice,all_times_dic)
-    #necessary for controling axis
-    fig = plt.figure()
-    ax = fig.gca()
-        
-    x_times = parse_list( make_last_days_x_list(pre_tx2_lst), sample_frequency)
-    y_tx2 = parse_list( make_last_days_y_list(pre_tx2_lst), sample_frequency)
-    y_tx1 = parse_list( make_last_days_y_list(pre_tx1_lst), sample_frequency)
-    #blue is tx2, red is tx1
-    plt.figure()
-    plt.plot(x_times, y_tx2, 'b-', label='Treatment 2')
-    plt.plot(x_times, y_tx1, 'r-', label='Treatment 1')
-    plt.legend()
-    plt.ylim(0, 3, .25)
-    plt.xticks(np.arange(min(x_times), max(x_times)+120, 1440))
-    plt.title('Stdev across treatment every 30 seconds-pre')
-    plt.xlabel('Time (every 1440 is 12 hrs)')
-    plt.ylabel('Stdev of CBT in deg C')
-    plt.savefig('last_pre_days_stdev.png')
-    #plt.show()
-
-    plt.figure()
-    x_times = parse_list( make_last_days_x_list(post_tx2_lst), sample_frequency)
-    y_tx2 = parse_list( make_last_days_y_list(post_tx2_lst), sample_frequency)
-    y_tx1 = parse_list( make_last_days_y_list(post_tx1_lst), sample_frequency)
-    #blue is tx2, red is tx1
-    plt.figure()
-    plt.plot(x_times, y_tx2, 'b-',label = 'Treatment 2')
-    plt.plot(x_times, y_tx1, 'r-', label = 'Treatment 1')
-    plt.legend()
-    plt.xticks(np.arange(min(x_times), max(x_times)+120, 1440))
-    plt.ylim(0, 3, 0.25)
-    plt.title('Stdev across treatment every 30 seconds-post')
-    plt.xlabel('Time (every 1440 is 12 hrs)')
-    plt.ylabel('Stdev CBT in deg C')
-    plt.savefig('last_post_days_stdev.png')
-    #plt.show()
+def plot_stdev_each_treatment_last_days(window_stats, groups, sample_frequency):
+    """Given the group statistics of the last n days pre and post treatment windows (a [pre, post]
+    list, see make_group_window_stats) and the treatment groups, saves two plots. One of
+    pre-treatment temperature stdevs every sample_frequency, and one of post-treatment temperature
+    stdevs every sample_frequency. Each plot has one line per treatment group."""
+    plot_group_lines('last_pre_days_stdev.png', window_stats[0], groups, 'stdev', sample_frequency,
+                     [0, 3], 1440, 'Stdev across treatment every 30 seconds-pre',
+                     'Time (every 1440 is 12 hrs)', 'Stdev of CBT in deg C')
+    plot_group_lines('last_post_days_stdev.png', window_stats[1], groups, 'stdev', sample_frequency,
+                     [0, 3], 1440, 'Stdev across treatment every 30 seconds-post',
+                     'Time (every 1440 is 12 hrs)', 'Stdev CBT in deg C')
     
 ####################################################################################################       
 def make_last_days_x_list(time_tuple_lst):
@@ -1197,60 +1969,1974 @@ def make_last_days_y_list(time_tuple_lst):
         temp_list.append(tpl[1])  #do not use "extend"...says "numpy.float64 object is not iterable" 
     return temp_list
 
-def overall_expt_plot(day_labels, times, tx2_mice, tx1_mice, sample_frequency, all_times_dic):
-    """Given lists of all the days, all the times, all tx1 mice, all tx2 mice, an integer of
-    how often to plot the data points, and the all_times_dic, plots the average CBT of each
-    treatment at each time point for the entire experiment."""
-    tx2_lst =  make_organized_time_temp_list(day_labels, times, tx2_mice, all_times_dic)
-    tx1_lst =  make_organized_time_temp_list(day_labels, times,tx1_mice,all_times_dic) 
-    plt.figure()
-    x_times = parse_list( make_last_days_x_list(tx2_lst), sample_frequency)
-    y_tx2 = parse_list( make_last_days_y_list(tx2_lst), sample_frequency)
-    y_tx1 = parse_list( make_last_days_y_list(tx1_lst), sample_frequency)
-    #blue is tx2, red is tx1
-    plt.figure()
-    plt.plot(x_times, y_tx2, 'b-',label = 'Treatment 2')
-    plt.plot(x_times, y_tx1, 'r-', label = 'Treatment 1')
-    plt.legend()
-    plt.xticks(np.arange(min(x_times), max(x_times)+120, 2880), rotation=45)
-    plt.ylim(35, 38.5, 0.5)
-    plt.title('Avg. across treatment every 30 seconds-entire experiment')
-    plt.xlabel('Time (every 2880 is 24 hrs)')
-    plt.ylabel('Average CBT in deg C')
-    plt.savefig('avg_temp_per_pt_entire_expt.png')
-
-def overall_expt_plot_stdev(day_labels, times, tx2_mice, tx1_mice, sample_frequency, all_times_dic):
-    """Given lists of all the days, all the times, all treatment 2 mice, all treatment 1 mice, an integer of
-    how often to plot the data points, and the all_times_dic, plots the stdev of the CBT of each
-    treatment at each time point for the entire experiment."""
-    tx2_lst =  make_stdev_organized_time_temp_list(day_labels, times, tx2_mice, all_times_dic)
-    tx1_lst =  make_stdev_organized_time_temp_list(day_labels, times,tx1_mice,all_times_dic) 
-    plt.figure()
-    x_times = parse_list( make_last_days_x_list(tx2_lst), sample_frequency)
-    y_tx2 = parse_list( make_last_days_y_list(tx2_lst), sample_frequency)
-    y_tx1 = parse_list( make_last_days_y_list(tx1_lst), sample_frequency)
-    #blue is tx2, red is tx1
-    plt.figure()
-    plt.plot(x_times, y_tx2, 'b-',label = 'Treatment 2')
-    plt.plot(x_times, y_tx1, 'r-', label = 'Treatment 1')
-    plt.legend()
-    plt.xticks(np.arange(min(x_times), max(x_times)+120, 2880), rotation=45)
-    plt.ylim(0, 2.5, 0.25)
-    plt.title('Stdev across treatment every 30 seconds-entire experiment')
-    plt.xlabel('Time (every 2880 is 24 hrs)')
-    plt.ylabel('Stdev CBT in deg C')
-    plt.savefig('stdev_temp_per_pt_entire_expt.png')
+def overall_expt_plot(window_stats, groups, sample_frequency, bands=None):
+    """Given the group statistics of every day of the experiment (see make_group_window_stats), the
+    treatment groups and an integer of how often to plot the data points, plots the average CBT of
+    each treatment at each time point for the entire experiment. bands can be the bootstrap
+    confidence bands of each treatment's mean (see bands_at_time_points) to draw behind the lines."""
+    plot_group_lines('avg_temp_per_pt_entire_expt.png', window_stats, groups, 'mean',
+                     sample_frequency, [35, 38.5], 2880,
+                     'Avg. across treatment every 30 seconds-entire experiment',
+                     'Time (every 2880 is 24 hrs)', 'Average CBT in deg C', bands=bands, rotation=45)
+
+def overall_expt_plot_stdev(window_stats, groups, sample_frequency):
+    """Given the group statistics of every day of the experiment (see make_group_window_stats), the
+    treatment groups and an integer of how often to plot the data points, plots the stdev of the
+    CBT of each treatment at each time point for the entire experiment."""
+    plot_group_lines('stdev_temp_per_pt_entire_expt.png', window_stats, groups, 'stdev',
+                     sample_frequency, [0, 2.5], 2880,
+                     'Stdev across treatment every 30 seconds-entire experiment',
+                     'Time (every 2880 is 24 hrs)', 'Stdev CBT in deg C', rotation=45)
     
+#################
+#### SAMPLE ARRAYS
+#### master_tt_dic flattened into one set of numpy arrays per mouse, for the stages that work on
+#### whole recordings at once instead of day by day.
+#################
+
+def extract_light_start_secs(filename):
+    """Given the user_modify file, returns the start of the light cycle in seconds after
+    midnight. Circadian days (the days of master_tt_dic) begin at this time."""
+    return hms_to_secs(extract_light_cycle_times(filename)['Light Cycle'][0])
+
+def make_mouse_sample_arrays(day_labels, mouse_nums, times, master_tt_dic, light_start_secs):
+    """Given the day labels, mouse numbers, cycles, master_tt_dic and the start of the light cycle
+    (seconds after midnight), returns a dictionary of mouse mapped to a dictionary of numpy arrays
+    of all of that mouse's samples in time order:
+    'elapsed' (seconds since midnight of the first day in day_labels), 'clock' (seconds after
+    midnight), 'day_index' (index into day_labels of the circadian day the sample belongs to),
+    'cycle_index' (index into times) and 'temps'. Samples before light_start_secs are after midnight, so on the next calendar day."""
+    first_date = label_to_date(day_labels[0])
+    sample_arrays = {}
+    for mouse in mouse_nums:
+        clock = []
+        day_index = []
+        cycle_index = []
+        temps = []
+        for i, day in enumerate(day_labels):
+            for j, cycle in enumerate(times):
+                if mouse in master_tt_dic[day]:
+                    for clock_time, temp in master_tt_dic[day][mouse][cycle]:
+                        clock.append(hms_to_secs(clock_time))
+                        day_index.append(i)
+                        cycle_index.append(j)
+                        temps.append(temp)
+        clock = np.array(clock, dtype=float)
+        day_index = np.array(day_index, dtype=int)
+        day_offsets = np.array([(label_to_date(day) - first_date).days for day in day_labels])
+        elapsed = day_offsets[day_index] * 86400.0 + clock
+        elapsed[clock < light_start_secs] += 86400
+        order = np.argsort(elapsed, kind='mergesort')
+        sample_arrays[mouse] = {'elapsed': elapsed[order], 'clock': clock[order],
+                                'day_index': day_index[order],
+                                'cycle_index': np.array(cycle_index, dtype=int)[order],
+                                'temps': np.array(temps, dtype=float)[order]}
+    return sample_arrays
+
+#################
+#### GAP INDEX
+#### The contiguous runs of samples (segments) of each mouse, found once from the sample arrays.
+#### Moving windows are kept inside a segment so they never average across a recording gap.
+#################
+
+GAP_FACTOR = 1.5    #a step longer than this many sampling intervals is a gap
+
+def extract_data_collection_interval(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Data collection interval', returns the integer (seconds between samples) to the right of that
+    cell, or None if it is empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Data collection interval' in line[0] and line[1].strip():
+            return int(line[1])
+    return None
+
+def typical_interval(sample_arrays):
+    """Returns the median step (seconds) between consecutive samples over every mouse, for when
+    the data collection interval isn't given."""
+    steps = [np.diff(arrays['elapsed']) for arrays in sample_arrays.values() if len(arrays['elapsed']) > 1]
+    if len(steps) == 0:
+        return 0
+    return float(np.median(np.concatenate(steps)))
+
+def find_segments(elapsed, temps, max_step):
+    """Given sample times (seconds, in order), temps and the longest step (seconds) allowed inside
+    a segment, returns (starts, stops): arrays of the first index and one past the last index of
+    every run of finite temps with no step longer than max_step."""
+    valid = np.flatnonzero(np.isfinite(temps))
+    if len(valid) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    breaks = np.flatnonzero((np.diff(elapsed[valid]) > max_step) | (np.diff(valid) > 1))
+    starts = valid[np.concatenate([[0], breaks + 1])]
+    stops = valid[np.concatenate([breaks, [len(valid) - 1]])] + 1
+    return starts, stops
+
+def make_gap_index(sample_arrays, interval_secs):
+    """Given the mouse sample arrays and the sampling interval (seconds), returns a dictionary of
+    mouse mapped to {'starts': array, 'stops': array, 'interval': interval_secs}, the segments of
+    that mouse's samples (see find_segments)."""
+    gap_index = {}
+    for mouse in sample_arrays:
+        arrays = sample_arrays[mouse]
+        starts, stops = find_segments(arrays['elapsed'], arrays['temps'], GAP_FACTOR * interval_secs)
+        gap_index[mouse] = {'starts': starts, 'stops': stops, 'interval': interval_secs}
+    return gap_index
+
+def split_segments(starts, stops, labels):
+    """Given segments (starts, stops) and an int array labelling every sample (ie its day index),
+    returns the segments also split wherever the label changes."""
+    if len(starts) == 0:
+        return starts, stops
+    changes = np.flatnonzero(np.diff(labels)) + 1
+    bounds = np.union1d(np.concatenate([starts, stops]), changes)
+    new_starts = bounds[:-1]
+    new_stops = bounds[1:]
+    #keep the pieces that are inside one of the original segments
+    segment = np.searchsorted(starts, new_starts, side='right') - 1
+    inside = (segment >= 0) & (new_stops <= stops[np.maximum(segment, 0)])
+    return new_starts[inside], new_stops[inside]
+
+def moving_stat_by_segment(values, starts, stops, n_points, statistic):
+    """Given an array of values, segments (starts, stops) and a number of points, returns an array
+    of the n point moving statistic (one of MOVING_STATISTICS) computed inside each segment
+    separately, so no window reaches across a segment boundary. Values outside every segment
+    are NaN."""
+    moving_stat = MOVING_STATISTICS[statistic]
+    result = np.empty(len(values))
+    result.fill(np.nan)
+    for start, stop in zip(starts, stops):
+        if stop - start == 1 and statistic == 'stdev':
+            continue    #the stdev of a single point is undefined
+        result[start:stop] = moving_stat(list(values[start:stop]), n_points)
+    return result
+
+def make_gap_aware_stat_master_dic(day_labels, mouse_nums, times, sample_arrays, gap_index,
+                                   n_points, statistic, executor=None):
+    """Just like make_moving_stat_master_dic, but windows stop at recording gaps (see
+    make_gap_index) as well as at the ends of each cycle. Each list is in time order. The mice
+    are split over the executor's worker processes if one is given (see make_mouse_executor)."""
+    if executor is None:
+        executor = make_mouse_executor(sample_arrays, mouse_nums, 1)
+    mouse_args = dict((mouse, (gap_index[mouse]['starts'], gap_index[mouse]['stops']))
+                      for mouse in mouse_nums)
+    all_stat_lists = map_mice(executor, mouse_moving_stat_lists, mouse_nums,
+                              (len(times), n_points, statistic), mouse_args)
+    stat_master_dic = dict((day, {}) for day in day_labels)
+    for mouse, stat_lists in zip(mouse_nums, all_stat_lists):
+        for i, day in enumerate(day_labels):
+            stat_master_dic[day][mouse] = dict((cycle, stat_lists.get((i, j), []))
+                                               for j, cycle in enumerate(times))
+    return stat_master_dic
+
+def make_gap_aware_hours_master_dic(day_labels, mouse_nums, times, sample_arrays, gap_index):
+    """Returns a dictionary laid out like make_gap_aware_stat_master_dic's of the clock time (hours
+    after midnight) of every value in it, taken from the same sample arrays, so each moving
+    statistic can be plotted at its own time."""
+    hours_master_dic = dict((day, {}) for day in day_labels)
+    for mouse in mouse_nums:
+        hours = mouse_segment_hours(sample_arrays[mouse], gap_index[mouse]['starts'],
+                                    gap_index[mouse]['stops'], len(times))
+        for i, day in enumerate(day_labels):
+            hours_master_dic[day][mouse] = dict((cycle, hours.get((i, j), []))
+                                                for j, cycle in enumerate(times))
+    return hours_master_dic
+
+def sample_label(arrays, day_labels, i):
+    """Returns 'day label hh:mm:ss' of sample i of a mouse's sample arrays."""
+    secs = int(arrays['clock'][i])
+    return '%s %02d:%02d:%02d' %(day_labels[arrays['day_index'][i]], secs/3600, secs/60 % 60, secs % 60)
+
+def write_completeness_report(sample_arrays, gap_index, day_labels, mouse_nums, mouse_treatments,
+                              filename):
+    """Writes a .csv file with one row per mouse: its first and last sample, the number of samples
+    expected at the sampling interval, the number recorded, the percent complete, and the number,
+    total length and longest of its recording gaps. Returns the rows."""
+    rows = []
+    for mouse in mouse_nums:
+        arrays = sample_arrays[mouse]
+        starts, stops = gap_index[mouse]['starts'], gap_index[mouse]['stops']
+        interval = gap_index[mouse]['interval']
+        if len(starts) == 0 or interval <= 0:
+            rows.append([mouse, mouse_treatments.get(mouse, ''), '', '', 0, 0, 0.0, 0, 0.0, 0.0])
+            continue
+        first = arrays['elapsed'][starts[0]]
+        last = arrays['elapsed'][stops[-1] - 1]
+        expected = int(round((last - first) / interval)) + 1
+        recorded = int(np.sum(stops - starts))
+        gaps = arrays['elapsed'][starts[1:]] - arrays['elapsed'][stops[:-1] - 1] - interval
+        rows.append([mouse, mouse_treatments.get(mouse, ''), sample_label(arrays, day_labels, starts[0]),
+                     sample_label(arrays, day_labels, stops[-1] - 1), expected, recorded,
+                     '%.1f' %(100.0 * min(recorded, expected) / expected), len(gaps),
+                     '%.2f' %(np.sum(gaps) / 3600.0), '%.2f' %(np.max(gaps) / 3600.0 if len(gaps) else 0.0)])
+    writer = csv.writer(open(filename, 'wb'))
+    writer.writerow(['Mouse', 'Treatment', 'First sample', 'Last sample', 'Expected samples',
+                     'Recorded samples', 'Percent complete', 'Gaps', 'Total gap (h)', 'Longest gap (h)'])
+    writer.writerows(rows)
+    return rows
+
+#################
+#### OUTLIER FILTER
+#### Flags physiologically impossible samples (logger out of the mouse, handling, sensor
+#### artifacts) by absolute range, rate of change between consecutive samples and a rolling
+#### robust z-score (median/MAD), as array operations over each mouse's sample arrays. Flagged
+#### samples are dropped before the statistics, so they leave a gap in the gap index.
+#################
+
+OUTLIER_CHECKS = ['range', 'rate', 'robust z']
+MAD_FLOOR = 0.05        #deg C, so flat stretches (MAD of 0) don't flag every small wiggle
+ROBUST_CHUNK = 2**16    #windows sorted at a time by rolling_median_mad, bounds memory use
+
+def extract_outlier_range(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Outlier filter CBT range', returns [lowest, highest] plausible CBT (floats) from the two cells
+    to the right, or None (no range check) if the row is missing or empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 2 and 'Outlier filter CBT range' in line[0] and line[1].strip():
+            return [float(line[1]), float(line[2])]
+    return None
+
+def extract_outlier_max_rate(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Outlier filter max change per minute', returns the float to the right of that cell (deg C
+    per minute), or None (no rate check) if the row is missing or empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Outlier filter max change per minute' in line[0] and line[1].strip():
+            return float(line[1])
+    return None
+
+def extract_outlier_robust_z(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Outlier filter robust z-score', returns [number of points in the rolling window (integer),
+    largest allowed robust z-score (float)] from the two cells to the right, or None (no robust
+    z-score check) if the row is missing or empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 2 and 'Outlier filter robust z-score' in line[0] and line[1].strip():
+            return [int(line[1]), float(line[2])]
+    return None
+
+def extract_outlier_settings(filename):
+    """Returns a dictionary of the three outlier checks' settings from the user_modify file:
+    'range', 'rate' and 'robust z' (see the extract_outlier_* functions). A None setting turns
+    that check off."""
+    return {'range': extract_outlier_range(filename),
+            'rate': extract_outlier_max_rate(filename),
+            'robust z': extract_outlier_robust_z(filename)}
+
+def rolling_median_mad(temps, n_points):
+    """Given an array of CBTs and the number of points in the window (centred, like n_pt_mavg),
+    returns (medians, mads): arrays of the median of each sample's window and the median absolute
+    deviation from it. Windows at the ends are padded with NaN and use only the real samples."""
+    n = len(temps)
+    half = n_points / 2
+    width = 2 * half + 1
+    padded = np.concatenate([np.full(half, np.nan), temps, np.full(half, np.nan)])
+    windows = np.lib.stride_tricks.as_strided(padded, (n, width), (padded.strides[0],) * 2)
+    medians = np.empty(n)
+    mads = np.empty(n)
+    interior = np.arange(n)[half:n - half] if n > 2 * half else np.array([], dtype=int)
+    for start in range(0, len(interior), ROBUST_CHUNK):
+        rows = interior[start:start + ROBUST_CHUNK]
+        chunk = windows[rows[0]:rows[-1] + 1]
+        medians[rows] = np.median(chunk, axis=1)
+        mads[rows] = np.median(np.abs(chunk - medians[rows, None]), axis=1)
+    edges = np.setdiff1d(np.arange(n), interior)
+    for i in edges:
+        window = windows[i][np.isfinite(windows[i])]
+        medians[i] = np.median(window)
+        mads[i] = np.median(np.abs(window - medians[i]))
+    return medians, mads
+
+def flag_outliers(elapsed, temps, settings):
+    """Given one mouse's sample times (seconds, in order), CBTs and the outlier settings (see
+    extract_outlier_settings), returns a dictionary of each check in OUTLIER_CHECKS mapped to a
+    boolean array that is True for the samples it flags, plus 'keep', True for samples no check
+    flagged. The rate check flags a sample only if it is reached and left by a change faster than
+    the limit (a spike), or at either end of the recording, by one such change; a sample is
+    checked against its neighbours after the range check has removed impossible values."""
+    n = len(temps)
+    flags = dict((check, np.zeros(n, dtype=bool)) for check in OUTLIER_CHECKS)
+    if settings['range'] is not None:
+        low, high = settings['range']
+        flags['range'] = (temps < low) | (temps > high)
+    valid = np.flatnonzero(~flags['range'])
+    if settings['rate'] is not None and len(valid) > 1:
+        minutes = np.diff(elapsed[valid]) / 60.0
+        fast = np.abs(np.diff(temps[valid])) > settings['rate'] * np.maximum(minutes, 1e-9)
+        into = np.concatenate([[True], fast])
+        out_of = np.concatenate([fast, [True]])
+        flags['rate'][valid] = into & out_of
+    if settings['robust z'] is not None and len(valid) > 0:
+        n_points, max_z = settings['robust z']
+        medians, mads = rolling_median_mad(temps[valid], n_points)
+        z = 0.6745 * np.abs(temps[valid] - medians) / np.maximum(mads, MAD_FLOOR)
+        flags['robust z'][valid] = z > max_z
+    flags['keep'] = ~(flags['range'] | flags['rate'] | flags['robust z'])
+    return flags
+
+def make_outlier_masks(sample_arrays, mouse_nums, settings):
+    """Returns a dictionary of mouse mapped to its flag_outliers dictionary."""
+    return dict((mouse, flag_outliers(sample_arrays[mouse]['elapsed'], sample_arrays[mouse]['temps'],
+                                      settings))
+                for mouse in mouse_nums)
+
+def find_outlier_rejections(sample_arrays, outlier_masks, day_labels, times):
+    """Given the sample arrays, the outlier masks (see make_outlier_masks), the day labels and the
+    cycles, returns a dictionary of (day, mouse, cycle) mapped to the set of clock times (seconds
+    after midnight) of the samples the masks reject there."""
+    rejected = collections.defaultdict(set)
+    for mouse, arrays in sample_arrays.items():
+        if mouse not in outlier_masks:
+            continue
+        for i in np.flatnonzero(~outlier_masks[mouse]['keep']):
+            day = day_labels[arrays['day_index'][i]]
+            rejected[(day, mouse, times[arrays['cycle_index'][i]])].add(arrays['clock'][i])
+    return dict(rejected)
+
+def drop_rejected_samples(tt_dic, rejected, keep_positions=False):
+    """Given a master_tt or all_times dictionary and the rejections of find_outlier_rejections,
+    returns a copy without the rejected samples; with keep_positions, each rejected sample's CBT is
+    replaced with NaN instead, so every mouse keeps the same time points (as the all_times
+    dictionary needs). Only the day/mouse/cycle lists with a rejected sample are rebuilt, and the
+    dictionary given is not changed."""
+    if len(rejected) == 0:
+        return tt_dic
+    filtered_tt_dic = dict((day, dict(mice)) for day, mice in tt_dic.items())
+    for (day, mouse, cycle), clocks in rejected.items():
+        if day not in filtered_tt_dic or mouse not in filtered_tt_dic[day]:
+            continue
+        cycles = dict(filtered_tt_dic[day][mouse])
+        if keep_positions:
+            cycles[cycle] = [(t, float('nan') if hms_to_secs(t) in clocks else temp)
+                             for t, temp in cycles[cycle]]
+        else:
+            cycles[cycle] = [(t, temp) for t, temp in cycles[cycle] if hms_to_secs(t) not in clocks]
+        filtered_tt_dic[day][mouse] = cycles
+    return filtered_tt_dic
+
+def apply_outlier_masks(sample_arrays, master_tt_dic, outlier_masks, day_labels, times):
+    """Drops every sample flagged in outlier_masks (see make_outlier_masks) from the sample arrays
+    and from master_tt_dic. Returns the filtered (sample_arrays, master_tt_dic); the ones given
+    are not changed (see drop_rejected_samples)."""
+    filtered_arrays = {}
+    for mouse, arrays in sample_arrays.items():
+        keep = outlier_masks[mouse]['keep'] if mouse in outlier_masks else np.ones(len(arrays['temps']), dtype=bool)
+        filtered_arrays[mouse] = dict((field, values[keep]) for field, values in arrays.items())
+    rejected = find_outlier_rejections(sample_arrays, outlier_masks, day_labels, times)
+    return filtered_arrays, drop_rejected_samples(master_tt_dic, rejected)
+
+def write_outlier_report(outlier_masks, mouse_nums, mouse_treatments, filename):
+    """Writes a .csv file with one row per mouse: its number of samples, the number flagged by
+    each check (a sample can be flagged by more than one), the number rejected and the percent
+    rejected. Returns the rows."""
+    rows = []
+    for mouse in mouse_nums:
+        flags = outlier_masks[mouse]
+        n = len(flags['keep'])
+        rejected = n - int(np.sum(flags['keep']))
+        rows.append([mouse, mouse_treatments.get(mouse, ''), n] +
+                    [int(np.sum(flags[check])) for check in OUTLIER_CHECKS] +
+                    [rejected, '%.2f' %(100.0 * rejected / n if n else 0.0)])
+    writer = csv.writer(open(filename, 'wb'))
+    writer.writerow(['Mouse', 'Treatment', 'Samples', 'Out of range', 'Too fast', 'Robust z',
+                     'Rejected', 'Percent rejected'])
+    writer.writerows(rows)
+    return rows
+
+#################
+#### EVENT DETECTION
+#### Bouts where a mouse's CBT stays below (torpor, hypothermia) or above (fever) a threshold for
+#### a minimum time. Uses hysteresis: a bout starts when CBT crosses the 'enter' threshold and
+#### only ends when CBT crosses back past the 'leave' threshold, so noise around a single
+#### threshold doesn't split one bout into many. Bouts never span a recording gap.
+#################
+
+EVENT_KINDS = [('Low CBT event', 'nadir'), ('High CBT event', 'peak')]
+
+def extract_event_rule(filename, phrase):
+    """Given a .csv file and the phrase in the first cell of an event row (see EVENT_KINDS),
+    returns a dictionary of 'enter' and 'leave' thresholds (deg C) and 'minutes' (shortest bout)
+    from the three cells to the right, or None (no detection) if the row is missing or empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 3 and phrase in line[0] and line[1].strip():
+            return {'enter': float(line[1]), 'leave': float(line[2]), 'minutes': float(line[3])}
+    return None
+
+def extract_event_rules(filename):
+    """Returns a list of (event name, rule) for every event kind with a rule in the user_modify
+    file (see extract_event_rule)."""
+    rules = []
+    for name, extreme in EVENT_KINDS:
+        rule = extract_event_rule(filename, name)
+        if rule is not None:
+            rules.append((name, rule))
+    return rules
+
+def find_bouts(elapsed, temps, starts, stops, enter, leave, min_secs, interval):
+    """Given one mouse's sample times and CBTs, its segments (see find_segments) and the enter
+    and leave thresholds of a low CBT bout (enter <= leave), returns (firsts, lasts): arrays of the
+    first and last sample index of every bout lasting at least min_secs. A bout lasts from its
+    first sample to one sampling interval after its last. Call with negated temps and thresholds
+    for high CBT bouts."""
+    n = len(temps)
+    if len(starts) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    segment_start = np.zeros(n, dtype=bool)
+    segment_start[starts] = True
+    #the state is only set where CBT is past a threshold (or a segment starts), and carried forward
+    decided = (temps < enter) | (temps > leave) | segment_start
+    last_decided = np.maximum.accumulate(np.where(decided, np.arange(n), 0))
+    inside = (temps < enter)[last_decided]
+    in_segment = np.zeros(n + 1, dtype=int)
+    np.add.at(in_segment, starts, 1)
+    np.add.at(in_segment, stops, -1)
+    inside &= np.cumsum(in_segment[:-1]) > 0
+    previous = np.concatenate([[False], inside[:-1]]) & ~segment_start
+    following = np.concatenate([inside[1:], [False]]) & ~np.concatenate([segment_start[1:], [True]])
+    firsts = np.flatnonzero(inside & ~previous)
+    lasts = np.flatnonzero(inside & ~following)
+    long_enough = elapsed[lasts] - elapsed[firsts] + interval >= min_secs
+    return firsts[long_enough], lasts[long_enough]
+
+def make_event_table(sample_arrays, gap_index, mouse_nums, rules, day_labels, times):
+    """Given the sample arrays, gap index, mouse numbers, event rules (see extract_event_rules),
+    day labels and cycles, returns a list of one dictionary per bout, in mouse then time order:
+    'mouse', 'event', 'day', 'cycle' (of the first sample), 'start', 'end' (see sample_label),
+    'minutes', 'extreme' (the nadir of low bouts, the peak of high bouts), 'day_index' and 'first'
+    (index of the first sample in the mouse's sample arrays)."""
+    events = []
+    for mouse in mouse_nums:
+        arrays = sample_arrays[mouse]
+        gaps = gap_index[mouse]
+        mouse_events = []
+        for name, rule in rules:
+            sign = 1 if dict(EVENT_KINDS)[name] == 'nadir' else -1
+            firsts, lasts = find_bouts(arrays['elapsed'], sign * arrays['temps'], gaps['starts'],
+                                       gaps['stops'], sign * rule['enter'], sign * rule['leave'],
+                                       rule['minutes'] * 60, gaps['interval'])
+            if len(firsts) == 0:
+                continue
+            #each bout is reduced from its first sample to one past its last
+            bounds = np.ravel(np.column_stack([firsts, lasts + 1]))
+            extremes = sign * np.minimum.reduceat(np.append(sign * arrays['temps'], 0), bounds)[::2]
+            for first, last, extreme in zip(firsts, lasts, extremes):
+                mouse_events.append({'mouse': mouse, 'event': name,
+                                     'day': day_labels[arrays['day_index'][first]],
+                                     'day_index': arrays['day_index'][first],
+                                     'cycle': times[arrays['cycle_index'][first]],
+                                     'start': sample_label(arrays, day_labels, first),
+                                     'end': sample_label(arrays, day_labels, last),
+                                     'minutes': (arrays['elapsed'][last] - arrays['elapsed'][first] + gaps['interval']) / 60.0,
+                                     'extreme': extreme, 'first': first})
+        mouse_events.sort(key=lambda event: event['first'])
+        events.extend(mouse_events)
+    return events
+
+def write_event_tables(events, rules, day_labels, mouse_nums, mouse_treatments, events_filename,
+                       counts_filename):
+    """Writes the bouts (see make_event_table) to events_filename, one row per bout, and the number
+    of bouts of each event kind each mouse had on each day to counts_filename, one row per mouse
+    and event kind with a column per day."""
+    writer = csv.writer(open(events_filename, 'wb'))
+    writer.writerow(['Mouse', 'Treatment', 'Event', 'Day', 'Cycle', 'Start', 'End',
+                     'Duration (min)', 'Nadir/peak (deg C)'])
+    for event in events:
+        writer.writerow([event['mouse'], mouse_treatments.get(event['mouse'], ''), event['event'],
+                         event['day'], event['cycle'], event['start'], event['end'],
+                         '%.1f' %event['minutes'], '%.2f' %event['extreme']])
+    counts = collections.Counter((event['mouse'], event['event'], event['day_index']) for event in events)
+    writer = csv.writer(open(counts_filename, 'wb'))
+    writer.writerow(['Mouse', 'Treatment', 'Event'] + list(day_labels))
+    for mouse in mouse_nums:
+        for name, rule in rules:
+            writer.writerow([mouse, mouse_treatments.get(mouse, ''), name] +
+                            [counts[(mouse, name, i)] for i in range(len(day_labels))])
+
+#################
+#### PARALLEL PER-MOUSE STAGES
+#### The sample arrays of every mouse are copied once into shared memory (RawArrays) before the
+#### worker processes are forked, so workers read them in place instead of being sent pickled
+#### copies. Per-mouse tasks are mapped over the mice in mouse order, so results (and the
+#### files written from them) don't depend on which worker finished first.
+#################
+
+SHARED_FIELDS = [('elapsed', 'd'), ('clock', 'd'), ('temps', 'd'), ('day_index', 'l'),
+                 ('cycle_index', 'l')]
+WORKER_SHARED_SAMPLES = None    #set in each worker process by init_mouse_worker
+
+def extract_worker_processes(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Worker processes', returns the number of processes to split the per-mouse stages over: the
+    integer to the right of that cell, or one per CPU if it says 'all'. Returns 1 (no extra
+    processes) if the row is missing or empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Worker processes' in line[0] and line[1].strip():
+            if line[1].strip().lower() == 'all':
+                return multiprocessing.cpu_count()
+            return max(1, int(line[1]))
+    return 1
+
+def publish_sample_arrays(sample_arrays, mouse_nums):
+    """Given the mouse sample arrays, returns a dictionary holding every mouse's arrays
+    concatenated into one shared memory RawArray per field, and each mouse's (start, stop) offsets
+    into them."""
+    offsets = {}
+    total = 0
+    for mouse in mouse_nums:
+        n = len(sample_arrays[mouse]['temps'])
+        offsets[mouse] = (total, total + n)
+        total += n
+    shared = {'offsets': offsets, 'arrays': {}}
+    for field, typecode in SHARED_FIELDS:
+        raw = multiprocessing.sharedctypes.RawArray(typecode, max(total, 1))
+        view = np.frombuffer(raw, dtype=np.dtype(typecode))
+        for mouse in mouse_nums:
+            start, stop = offsets[mouse]
+            view[start:stop] = sample_arrays[mouse][field]
+        shared['arrays'][field] = raw
+    return shared
+
+def shared_mouse_arrays(shared, mouse):
+    """Returns one mouse's sample arrays as numpy views of the shared memory (no copying)."""
+    start, stop = shared['offsets'][mouse]
+    return dict((field, np.frombuffer(shared['arrays'][field], dtype=np.dtype(typecode))[start:stop])
+                for field, typecode in SHARED_FIELDS)
+
+def init_mouse_worker(shared):
+    """Pool initializer: keeps the shared sample arrays the worker inherited."""
+    global WORKER_SHARED_SAMPLES
+    WORKER_SHARED_SAMPLES = shared
+
+def run_mouse_task(job):
+    """Runs one (task, mouse, args) job on the shared sample arrays: task(arrays, *args)."""
+    task, mouse, args = job
+    return task(shared_mouse_arrays(WORKER_SHARED_SAMPLES, mouse), *args)
+
+def make_mouse_executor(sample_arrays, mouse_nums, processes):
+    """Publishes the sample arrays to shared memory and, if more than one process is wanted (and
+    this isn't already a worker process, which can't have workers of its own), starts the worker
+    pool. The workers only see the shared memory if they are forked from this process, so where
+    processes can't be forked (Windows) everything runs in this process. Returns the executor
+    dictionary used by map_mice; close it with close_mouse_executor."""
+    executor = {'shared': publish_sample_arrays(sample_arrays, mouse_nums), 'pool': None}
+    processes = min(processes, len(mouse_nums))
+    if processes > 1 and hasattr(os, 'fork') and not multiprocessing.current_process().daemon:
+        executor['pool'] = multiprocessing.Pool(processes, init_mouse_worker, (executor['shared'],))
+    return executor
+
+def close_mouse_executor(executor):
+    """Shuts down the executor's worker pool, if it has one."""
+    if executor['pool'] is not None:
+        executor['pool'].close()
+        executor['pool'].join()
+        executor['pool'] = None
+
+def map_mice(executor, task, mouse_nums, args=(), mouse_args=None):
+    """Runs task(arrays, *(mouse_args[mouse] + args)) for every mouse, in the worker pool if the
+    executor has one, and returns the results in mouse_nums order. task must be a module level
+    function. mouse_args optionally maps each mouse to (small) arguments of its own, which come
+    before the shared args."""
+    jobs = [(task, mouse, tuple(mouse_args[mouse] if mouse_args else ()) + tuple(args))
+            for mouse in mouse_nums]
+    if executor['pool'] is None:
+        return [task(shared_mouse_arrays(executor['shared'], mouse), *job_args)
+                for task, mouse, job_args in jobs]
+    return executor['pool'].map(run_mouse_task, jobs, chunksize=1)
+
+def mouse_cycle_stats(arrays, n_days, n_cycles):
+    """Per-mouse task: returns (n, mean, population stdev) arrays of shape (n_days, n_cycles), one
+    value per day and cycle of the mouse's samples. np.mean and np.std are used on each cycle's
+    samples in time order, so the values are exactly those find_all_avgs_ers gets from lists."""
+    group = arrays['day_index'] * n_cycles + arrays['cycle_index']
+    order = np.argsort(group, kind='mergesort')     #stable, keeps each cycle in time order
+    temps = arrays['temps'][order]
+    bounds = np.searchsorted(group[order], np.arange(n_days*n_cycles + 1))
+    n = np.diff(bounds).astype(float)
+    mean = np.empty(n_days*n_cycles)
+    mean.fill(np.nan)
+    std_dev = mean.copy()
+    for i in np.flatnonzero(n):
+        mean[i] = np.mean(temps[bounds[i]:bounds[i+1]])
+        std_dev[i] = np.std(temps[bounds[i]:bounds[i+1]])
+    shape = (n_days, n_cycles)
+    return n.reshape(shape), mean.reshape(shape), std_dev.reshape(shape)
+
+def mouse_cycle_lists(arrays, day_indexes, cycle_index):
+    """Returns the list of CBTs of each of the given days' cycle (cycle_index into times), like
+    list_CBT does from master_tt_dic."""
+    in_cycle = arrays['cycle_index'] == cycle_index
+    return [list(arrays['temps'][in_cycle & (arrays['day_index'] == day)]) for day in day_indexes]
+
+def mouse_last_two_cycles_moving_stdev(arrays, day_indexes, dark_index, n_stdev):
+    """Per-mouse task: get_last_two_cycles_moving_stdev from the sample arrays (day_indexes of
+    the last three days)."""
+    dark_lists = mouse_cycle_lists(arrays, day_indexes, dark_index)
+    dark_cycle = n_moving_stdev(dark_lists[1], n_stdev) + n_moving_stdev(dark_lists[2], n_stdev)
+    light_cycle = n_moving_stdev(dark_lists[0], n_stdev) + n_moving_stdev(dark_lists[1], n_stdev)
+    return [str(np.mean(dark_cycle)), str(np.mean(light_cycle))]
+
+def cycle_segments(arrays, starts, stops, n_cycles):
+    """Returns a mouse's segments (starts, stops, see find_segments) split where the day or cycle
+    changes, so no segment runs across the end of a cycle."""
+    day_cycle = arrays['day_index'] * n_cycles + arrays['cycle_index']
+    return split_segments(starts, stops, day_cycle)
+
+def mouse_moving_stat_lists(arrays, starts, stops, n_cycles, n_points, statistic):
+    """Per-mouse task: returns a dictionary of (day index, cycle index) mapped to the list of the
+    moving statistic of that day's cycle, with windows stopping at the mouse's recording gaps
+    (segments starts, stops) and at the ends of each cycle. Samples outside every segment (missing
+    readings) have no value (see mouse_segment_hours for the times of the values)."""
+    starts, stops = cycle_segments(arrays, starts, stops, n_cycles)
+    stats = moving_stat_by_segment(arrays['temps'], starts, stops, n_points, statistic)
+    stat_lists = {}
+    for start, stop in zip(starts, stops):
+        key = (int(arrays['day_index'][start]), int(arrays['cycle_index'][start]))
+        stat_lists.setdefault(key, []).extend(stats[start:stop])
+    return stat_lists
+
+def mouse_segment_hours(arrays, starts, stops, n_cycles):
+    """Returns a dictionary of (day index, cycle index) mapped to the list of clock times (hours
+    after midnight) of the samples mouse_moving_stat_lists gives a value for, in the same order."""
+    hours = {}
+    for start, stop in zip(*cycle_segments(arrays, starts, stops, n_cycles)):
+        key = (int(arrays['day_index'][start]), int(arrays['cycle_index'][start]))
+        hours.setdefault(key, []).extend(arrays['clock'][start:stop] / 3600.0)
+    return hours
+
+#################
+#### COSINOR
+#### Fits CBT = MESOR + amplitude * cos(2 pi (t - acrophase) / period) to every mouse x day (and
+#### the pre/post treatment windows) with one batched least squares solve.
+#################
+
+def fit_cosinor(group_index, n_groups, hours, temps, period=24.0):
+    """Given an int array assigning each sample to a group (0 to n_groups-1), the sample clock
+    times in hours and the temperatures, fits a cosinor to every group at once. The normal
+    equations of all groups are summed with np.bincount and solved in one np.linalg.solve call.
+    Returns a dictionary of arrays (one value per group): 'n', 'mesor', 'amplitude', 'acrophase'
+    (hours after midnight of the peak), a '... ci' half width (95% confidence) for each of the
+    three parameters and 'p' (F test of zero amplitude). Groups with too few samples to fit are
+    NaN."""
+    from scipy import stats
+    omega = 2 * pi / period
+    c = np.cos(omega * hours)
+    s = np.sin(omega * hours)
+    def group_sums(values):
+        return np.bincount(group_index, weights=values, minlength=n_groups)
+    n = np.bincount(group_index, minlength=n_groups).astype(float)
+    sum_c, sum_s = group_sums(c), group_sums(s)
+    xtx = np.empty((n_groups, 3, 3))
+    xtx[:, 0] = np.column_stack([n, sum_c, sum_s])
+    xtx[:, 1] = np.column_stack([sum_c, group_sums(c*c), group_sums(c*s)])
+    xtx[:, 2] = np.column_stack([sum_s, group_sums(c*s), group_sums(s*s)])
+    xty = np.column_stack([group_sums(temps), group_sums(c*temps), group_sums(s*temps)])
+
+    #a fit needs more samples than parameters, spread over more than one time of day
+    fittable = (n > 3) & (np.abs(np.linalg.det(xtx)) > 1e-9 * np.maximum(n, 1)**3)
+    xtx[~fittable] = np.eye(3)
+    xty[~fittable] = 0
+    beta = np.linalg.solve(xtx, xty)
+    mesor, beta_c, beta_s = beta[:, 0], beta[:, 1], beta[:, 2]
+
+    residuals = temps - (mesor[group_index] + beta_c[group_index]*c + beta_s[group_index]*s)
+    rss = group_sums(residuals**2)
+    tss = group_sums(temps**2) - group_sums(temps)**2 / np.maximum(n, 1)
+    dof = np.where(fittable, n - 3, 1)
+    sigma2 = rss / dof
+    cov = np.linalg.inv(xtx) * sigma2[:, None, None]
+    var_c, var_s, cov_cs = cov[:, 1, 1], cov[:, 2, 2], cov[:, 1, 2]
+
+    amplitude = np.hypot(beta_c, beta_s)
+    safe_amp = np.where(amplitude > 0, amplitude, np.nan)
+    acrophase = (np.arctan2(beta_s, beta_c) / omega) % period
+    #delta method standard errors of the polar parameters
+    amp_se = np.sqrt(np.abs(beta_c**2*var_c + beta_s**2*var_s + 2*beta_c*beta_s*cov_cs)) / safe_amp
+    phase_se = np.sqrt(np.abs(beta_s**2*var_c + beta_c**2*var_s - 2*beta_c*beta_s*cov_cs)) / safe_amp**2
+    t_crit = stats.t.ppf(0.975, dof)
+    f_stat = ((tss - rss) / 2) / np.where(sigma2 > 0, sigma2, np.nan)
+
+    fit = {'n': n.astype(int),
+           'mesor': mesor, 'mesor ci': t_crit * np.sqrt(cov[:, 0, 0]),
+           'amplitude': amplitude, 'amplitude ci': t_crit * amp_se,
+           'acrophase': acrophase, 'acrophase ci': t_crit * phase_se / omega,
+           'p': stats.f.sf(f_stat, 2, dof)}
+    for key in fit:
+        if key != 'n':
+            fit[key] = np.where(fittable, fit[key], np.nan)
+    return fit
+
+def get_treatment_windows(day_labels, filename):
+    """Given the day labels and the user_modify file, returns a list of (window name, list of day
+    labels) tuples for the last n days pre and post treatment (see get_last_n_pre_days). Windows
+    with no days, or all of them if no treatment start date is given, are left out."""
+    tx_start_date = extract_treatment_start_date(filename)
+    windows = []
+    if tx_start_date:
+        calendar = make_calendar_index(day_labels)
+        windows.append(('last n days pre treatment',
+                        get_last_n_pre_days(tx_start_date, calendar, filename)))
+        windows.append(('last n days post treatment',
+                        get_last_n_post_days(tx_start_date, calendar, filename)))
+    return [(name, days) for name, days in windows if len(days) > 0]
+
+def cosinor_groups(sample_arrays, mouse_nums, day_labels, windows):
+    """Given the mouse sample arrays, mouse numbers, day labels and a list of (window name, list of
+    day labels) tuples, returns (labels, group_index, hours, temps): one (mouse, day or window
+    name) label per group and the concatenated samples with the group each belongs to. Samples in
+    a window are fitted again as part of that window's group."""
+    labels = []
+    group_index = []
+    hours = []
+    temps = []
+    for mouse in mouse_nums:
+        arrays = sample_arrays[mouse]
+        groupings = [(day, [i]) for i, day in enumerate(day_labels)]
+        groupings += [(name, [day_labels.index(day) for day in days if day in day_labels])
+                      for name, days in windows]
+        for name, day_indexes in groupings:
+            in_group = np.in1d(arrays['day_index'], day_indexes)
+            group_index.append(np.repeat(len(labels), np.count_nonzero(in_group)))
+            hours.append(arrays['clock'][in_group] / 3600.0)
+            temps.append(arrays['temps'][in_group])
+            labels.append((mouse, name))
+    return (labels, np.concatenate(group_index).astype(int), np.concatenate(hours),
+            np.concatenate(temps))
+
+def write_cosinor_table(sample_arrays, mouse_nums, day_labels, windows, mouse_treatments, filename):
+    """Fits a cosinor to every mouse x day and every mouse x window (see cosinor_groups) and writes
+    the parameters with their 95% confidence intervals to the given .csv file. Returns the fit
+    dictionary (see fit_cosinor)."""
+    labels, group_index, hours, temps = cosinor_groups(sample_arrays, mouse_nums, day_labels, windows)
+    fit = fit_cosinor(group_index, len(labels), hours, temps)
+    writer = csv.writer(open(filename, 'wb'))
+    writer.writerow(['Mouse', 'Treatment', 'Day', 'n', 'MESOR', 'MESOR CI low', 'MESOR CI high',
+                     'Amplitude', 'Amplitude CI low', 'Amplitude CI high', 'Acrophase (h)',
+                     'Acrophase CI low', 'Acrophase CI high', 'p (zero amplitude)'])
+    for i, (mouse, name) in enumerate(labels):
+        row = [mouse, mouse_treatments.get(mouse, ''), name, fit['n'][i]]
+        for parameter in ['mesor', 'amplitude', 'acrophase']:
+            value, ci = fit[parameter][i], fit[parameter + ' ci'][i]
+            row += ['%.4f' %value, '%.4f' %(value - ci), '%.4f' %(value + ci)]
+        row.append('%.4g' %fit['p'][i])
+        writer.writerow(row)
+    return fit
+
+#################
+#### TREATMENT TESTS
+#### Welch t-tests of treatment 1 vs treatment 2 (in each of the pre/post treatment windows) and
+#### of pre vs post treatment (in each group), at every aligned time slot and for each cycle. Each
+#### slot is one sampling interval of the window's circadian days, so slot k of every mouse (and
+#### of the pre and post windows) is the same time of day. All slots are tested at once along
+#### the mouse axis, and p-values are FDR corrected (Benjamini-Hochberg) within each comparison.
+#################
+
+def extract_group_comparison_tests(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Group comparison tests', returns a dictionary of 'fdr' (the false discovery rate, float, from the
+    cell to the right) and 'shade' (True if the next cell says yes: shade significant slots on the
+    pre/post treatment plots). Returns None (no tests) if the row is missing or empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Group comparison tests' in line[0] and line[1].strip():
+            shade = len(line) > 2 and line[2].strip().lower() in ('yes', 'y', 'true')
+            return {'fdr': float(line[1]), 'shade': shade}
+    return None
+
+def extract_slot_start_secs(filename, times):
+    """Given the user_modify file and the list of cycles, returns the start (seconds after
+    midnight) of the first cycle in times. The group plots put each day's cycles in times order,
+    so each day's time slots start there."""
+    return hms_to_secs(extract_light_cycle_times(filename)[times[0]][0])
+
+def make_slot_matrix(sample_arrays, mice, day_labels, days, start_secs, interval):
+    """Given the sample arrays, a list of mice, the day labels, the days of a window, the start of
+    each day's slots (see extract_slot_start_secs) and the sampling interval (seconds), returns a
+    (mice x slots) array of CBTs: slot k of each day is the k-th interval after start_secs, and the
+    day's samples before start_secs (clock time) come after the ones past it. Slots a mouse has no
+    sample in are NaN (if a slot has two samples, the later one is kept)."""
+    slots_per_day = int(round(86400.0 / interval))
+    first_date = label_to_date(days[0])
+    day_offsets = np.array([(label_to_date(day) - first_date).days for day in day_labels])
+    window_days = [day_labels.index(day) for day in days if day in day_labels]
+    matrix = np.full((len(mice), len(days) * slots_per_day), np.nan)
+    for row, mouse in enumerate(mice):
+        arrays = sample_arrays[mouse]
+        in_window = np.flatnonzero(np.in1d(arrays['day_index'], window_days))
+        secs = (arrays['clock'][in_window] - start_secs) % 86400
+        slots = day_offsets[arrays['day_index'][in_window]] * slots_per_day + (secs // interval).astype(int)
+        keep = (slots >= 0) & (slots < matrix.shape[1])
+        matrix[row, slots[keep]] = arrays['temps'][in_window][keep]
+    return matrix
+
+def make_group_slot_matrices(sample_arrays, groups, day_labels, days, start_secs, interval):
+    """Given the sample arrays, a list of (group name, list of mice) and the rest of the arguments
+    of make_slot_matrix, returns a dictionary of group name mapped to the group's slot matrix (rows
+    in the group's mouse order). Each mouse's row is only made once, however many groups it is in."""
+    mice = group_mice(groups)
+    matrix = make_slot_matrix(sample_arrays, mice, day_labels, days, start_secs, interval)
+    return dict((group, matrix[[mice.index(mouse) for mouse in group_mouse_nums]])
+                for group, group_mouse_nums in groups)
+
+def time_point_slots(stats, days, start_secs, interval):
+    """Given one group's statistics of a window (see group_time_point_stats), the window's days, the
+    start of each day's time slots (see extract_slot_start_secs) and the sampling interval
+    (seconds), returns the time slot (see make_slot_matrix) each of the group's time points falls
+    in. Time points and slots only line up while no mouse has a recording gap, so anything drawn
+    per slot on the group plots is placed with this."""
+    slots_per_day = int(round(86400.0 / interval))
+    first_date = label_to_date(days[0])
+    day_offsets = np.array([(label_to_date(day) - first_date).days for day in days])
+    return (day_offsets[stats['day']] * slots_per_day +
+            ((stats['clock'] - start_secs) % 86400 // interval).astype(int))
+
+def make_cycle_matrix(sample_arrays, mice, day_labels, days, times):
+    """Returns a (mice x cycles) array of each mouse's mean CBT in each cycle over the given days
+    (NaN where a mouse has no samples)."""
+    window_days = [day_labels.index(day) for day in days if day in day_labels]
+    matrix = np.full((len(mice), len(times)), np.nan)
+    for row, mouse in enumerate(mice):
+        arrays = sample_arrays[mouse]
+        in_window = np.in1d(arrays['day_index'], window_days)
+        sums = np.bincount(arrays['cycle_index'][in_window], arrays['temps'][in_window], len(times))
+        counts = np.bincount(arrays['cycle_index'][in_window], minlength=len(times))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            matrix[row] = sums / counts
+    return matrix
+
+def welch_tests(a, b):
+    """Given two (observations x tests) arrays (NaN for missing observations), returns a dictionary
+    of arrays with one value per test (column): 'n 1', 'n 2', 'mean 1', 'mean 2', 't', 'df'
+    (Welch-Satterthwaite), 'p' (two sided) and 'g' (Hedges' g, group 1 minus group 2). Tests with
+    fewer than two observations in either group are NaN."""
+    from scipy import stats
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n1 = np.sum(np.isfinite(a), axis=0).astype(float)
+        n2 = np.sum(np.isfinite(b), axis=0).astype(float)
+        n1[n1 < 2] = np.nan
+        n2[n2 < 2] = np.nan
+        mean1 = np.nansum(a, axis=0) / n1
+        mean2 = np.nansum(b, axis=0) / n2
+        var1 = np.nansum((a - mean1) ** 2, axis=0) / (n1 - 1)
+        var2 = np.nansum((b - mean2) ** 2, axis=0) / (n2 - 1)
+        se1, se2 = var1 / n1, var2 / n2
+        t = (mean1 - mean2) / np.sqrt(se1 + se2)
+        df = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+        p = 2 * stats.t.sf(np.abs(t), df)
+        pooled = np.sqrt(((n1 - 1) * var1 + (n2 - 1) * var2) / (n1 + n2 - 2))
+        g = (mean1 - mean2) / pooled * (1 - 3 / (4 * (n1 + n2) - 9))
+    return {'n 1': np.nan_to_num(n1).astype(int), 'n 2': np.nan_to_num(n2).astype(int),
+            'mean 1': mean1, 'mean 2': mean2, 't': t, 'df': df, 'p': p, 'g': g}
+
+def benjamini_hochberg(p):
+    """Given an array of p-values (NaN for tests that couldn't be run), returns the array of
+    Benjamini-Hochberg adjusted p-values (q-values). NaN p-values stay NaN and aren't counted."""
+    q = np.full(len(p), np.nan)
+    tested = np.flatnonzero(np.isfinite(p))
+    if len(tested) == 0:
+        return q
+    order = tested[np.argsort(p[tested], kind='mergesort')]
+    ranked = p[order] * len(tested) / np.arange(1, len(tested) + 1)
+    q[order] = np.minimum(1, np.minimum.accumulate(ranked[::-1])[::-1])
+    return q
+
+def slot_label(slot, slots_per_day, interval, start_secs):
+    """Returns 'Day n hh:mm' (n from 1) of a slot of make_slot_matrix."""
+    secs = int((start_secs + (slot % slots_per_day) * interval) % 86400)
+    return 'Day %d %02d:%02d' %(slot / slots_per_day + 1, secs / 3600, secs / 60 % 60)
+
+def run_treatment_tests(sample_arrays, day_labels, times, groups, windows, start_secs, interval,
+                        fdr):
+    """Given the sample arrays, day labels, cycles, the treatment groups (a list of (group name,
+    list of mice)), the pre and post treatment windows (see get_treatment_windows), the start of
+    each day's time slots (see extract_slot_start_secs), the sampling interval (seconds) and the
+    false discovery rate, runs every comparison and returns a list of dictionaries, one per
+    comparison: 'comparison', 'subset' (the window or group), 'kind' ('slot' or 'cycle'), 'labels'
+    (one per test), the welch_tests arrays, 'q' and 'significant' (q below fdr). Every pair of
+    groups is compared in each window, and each group pre vs post treatment. Each comparison is run
+    once over the time slots and once over the per-mouse cycle means."""
+    slots_per_day = int(round(86400.0 / interval))
+    slot_matrices = {}
+    cycle_matrices = {}
+    mice = group_mice(groups)
+    for window, days in windows:
+        window_slots = make_group_slot_matrices(sample_arrays, groups, day_labels, days, start_secs,
+                                                interval)
+        window_cycles = make_cycle_matrix(sample_arrays, mice, day_labels, days, times)
+        for group, group_mouse_nums in groups:
+            slot_matrices[(window, group)] = window_slots[group]
+            cycle_matrices[(window, group)] = window_cycles[[mice.index(mouse) for mouse in group_mouse_nums]]
+    comparisons = []
+    for window, days in windows:
+        for i, (group_1, mice_1) in enumerate(groups):
+            for group_2, mice_2 in groups[i + 1:]:
+                comparisons.append(('%s vs %s' %(group_1, group_2), window, (window, group_1),
+                                    (window, group_2)))
+    if len(windows) == 2:
+        for group, group_mouse_nums in groups:
+            comparisons.append(('Pre vs post treatment', group, (windows[0][0], group),
+                                (windows[1][0], group)))
+    results = []
+    for comparison, subset, key_1, key_2 in comparisons:
+        a, b = slot_matrices[key_1], slot_matrices[key_2]
+        n_slots = min(a.shape[1], b.shape[1])
+        for kind, matrices, labels in [('slot', (a[:, :n_slots], b[:, :n_slots]),
+                                        [slot_label(k, slots_per_day, interval, start_secs)
+                                         for k in range(n_slots)]),
+                                       ('cycle', (cycle_matrices[key_1], cycle_matrices[key_2]), list(times))]:
+            result = welch_tests(*matrices)
+            result.update({'comparison': comparison, 'subset': subset, 'kind': kind, 'labels': labels})
+            result['q'] = benjamini_hochberg(result['p'])
+            with np.errstate(invalid='ignore'):
+                result['significant'] = result['q'] < fdr
+            results.append(result)
+    return results
+
+def write_treatment_tests(results, filename):
+    """Writes the results of run_treatment_tests to the given .csv file, one row per test."""
+    writer = csv.writer(open(filename, 'wb'))
+    writer.writerow(['Comparison', 'Window or group', 'Time', 'n 1', 'n 2', 'Mean 1', 'Mean 2',
+                     'Difference', 't', 'df', 'p', 'q (FDR)', "Hedges' g", 'Significant'])
+    for result in results:
+        for i, label in enumerate(result['labels']):
+            writer.writerow([result['comparison'], result['subset'], label, result['n 1'][i],
+                             result['n 2'][i], '%.4f' %result['mean 1'][i], '%.4f' %result['mean 2'][i],
+                             '%.4f' %(result['mean 1'][i] - result['mean 2'][i]), '%.4f' %result['t'][i],
+                             '%.2f' %result['df'][i], '%.4g' %result['p'][i], '%.4g' %result['q'][i],
+                             '%.4f' %result['g'][i], 'yes' if result['significant'][i] else 'no'])
+
+def significant_slots(results, windows):
+    """Returns a list of the significant-slot arrays of each window, in window order (for shading
+    the pre/post treatment plots): a slot is significant if any two treatment groups differ there.
+    A window with no group comparisons is None."""
+    by_window = {}
+    for result in results:
+        if result['comparison'] != 'Pre vs post treatment' and result['kind'] == 'slot':
+            significant = result['significant']
+            if result['subset'] in by_window:
+                significant = significant | by_window[result['subset']]
+            by_window[result['subset']] = significant
+    return [by_window.get(window) for window, days in windows]
+
+def shading_at_time_points(significant, window_stats, days, start_secs, interval):
+    """Given one window's significant time slots (see significant_slots), its group statistics (see
+    group_time_point_stats), its days, the start of each day's time slots and the sampling interval
+    (seconds), returns a boolean array whose element k is True if any group's time point k + 1
+    falls in a significant slot (see time_point_slots), for shade_slots. None gives None."""
+    if significant is None:
+        return None
+    placed = [stats for stats in window_stats.values() if len(stats['time points']) > 0]
+    shaded = np.zeros(max([stats['time points'].max() for stats in placed] or [0]), dtype=bool)
+    for stats in placed:
+        slots = time_point_slots(stats, days, start_secs, interval)
+        inside = (slots >= 0) & (slots < len(significant))
+        shaded[stats['time points'][inside][significant[slots[inside]]] - 1] = True
+    return shaded
+
+def shade_slots(ax, significant):
+    """Shades every run of significant time points (element k is time point k + 1, see
+    shading_at_time_points) on an axes whose x values are the plots' time points."""
+    if significant is None or not significant.any():
+        return
+    edges = np.diff(np.concatenate([[0], significant.astype(int), [0]]))
+    for start, stop in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+        ax.axvspan(start + 0.5, stop + 0.5, color='0.85', zorder=0, linewidth=0)
+
+#################
+#### BOOTSTRAP BANDS
+#### Confidence bands for the treatment group mean curves. Mice are resampled with replacement:
+#### all resamples are drawn at once as a (resamples x mice) count matrix, so every resample's
+#### mean at every time slot is one matrix product, and the band is the percentiles of those
+#### means. Time slots are handled in chunks (optionally in the worker processes) to bound memory.
+#################
+
+BOOTSTRAP_CHUNK = 2**22    #resamples x time slots reduced at a time
+
+def extract_bootstrap_bands(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Bootstrap bands', returns a dictionary of 'resamples' (integer), 'confidence' (percent, float)
+    and 'seed' (integer, 0 if empty) from the three cells to the right, or None (no bands) if the
+    row is missing or empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 2 and 'Bootstrap bands' in line[0] and line[1].strip():
+            seed = int(line[3]) if len(line) > 3 and line[3].strip() else 0
+            return {'resamples': int(line[1]), 'confidence': float(line[2]), 'seed': seed}
+    return None
+
+def bootstrap_counts(n_items, n_resamples, seed):
+    """Returns a (n_resamples x n_items) array of how many times each item is drawn in each
+    resample of n_items drawn with replacement. The same seed always gives the same counts."""
+    rng = np.random.RandomState(seed)
+    draws = rng.randint(0, n_items, (n_resamples, n_items))
+    rows = np.repeat(np.arange(n_resamples), n_items)
+    return np.bincount(rows * n_items + draws.ravel(), minlength=n_resamples * n_items).reshape(n_resamples, n_items)
+
+def row_percentiles(values, percentiles):
+    """Given a 2D array and a list of percentiles, returns an array of (percentiles x rows): each
+    row's percentiles, interpolated like np.percentile. Only the needed order statistics are found
+    (np.partition), and rows with NaN use np.nanpercentile (all-NaN rows stay NaN)."""
+    n = values.shape[1]
+    positions = np.array(percentiles) / 100.0 * (n - 1)
+    below = np.floor(positions).astype(int)
+    above = np.ceil(positions).astype(int)
+    ordered = np.partition(values, sorted(set(below) | set(above)), axis=1)
+    fraction = positions - below
+    result = (ordered[:, below] * (1 - fraction) + ordered[:, above] * fraction).T
+    has_nan = np.flatnonzero(np.isnan(values).any(axis=1))
+    if len(has_nan) > 0:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            result[:, has_nan] = np.nanpercentile(values[has_nan], percentiles, axis=1)
+    return result
+
+def bootstrap_chunk(job):
+    """Given (counts, values, percentiles): a count matrix (see bootstrap_counts), an (items x
+    slots) array of values (NaN where missing) and the [low, high] percentiles, returns (low, high)
+    arrays of the percentiles of the resampled means at each slot. Resamples that drew no value for
+    a slot are left out of that slot's percentiles."""
+    counts, values, percentiles = job
+    valid = np.isfinite(values)
+    #slots x resamples, so each slot's resampled means are contiguous for the percentiles
+    means = np.dot(np.where(valid, values, 0.0).T, counts.T)
+    if valid.all():
+        means /= values.shape[0]    #every resample draws as many values as there are items
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means /= np.dot(valid.T.astype(float), counts.T)
+    low, high = row_percentiles(means, percentiles)
+    return low, high
+
+def bootstrap_mean_bands(values, settings, executor=None):
+    """Given an (items x slots) array of values (NaN where missing) and the bootstrap settings (see
+    extract_bootstrap_bands), returns (low, high) arrays of the confidence band of the mean at each
+    slot. Chunks of slots are split over the executor's worker processes if one is given (see
+    make_mouse_executor); the result doesn't depend on how many there are."""
+    n_items, n_slots = values.shape
+    counts = bootstrap_counts(n_items, settings['resamples'], settings['seed']).astype(float)
+    alpha = (100.0 - settings['confidence']) / 2
+    chunk = max(1, BOOTSTRAP_CHUNK / settings['resamples'])
+    jobs = [(counts, values[:, start:start + chunk], [alpha, 100.0 - alpha])
+            for start in range(0, n_slots, chunk)]
+    if executor is not None and executor['pool'] is not None:
+        bands = executor['pool'].map(bootstrap_chunk, jobs, chunksize=1)
+    else:
+        bands = [bootstrap_chunk(job) for job in jobs]
+    if len(bands) == 0:
+        return np.array([]), np.array([])
+    return np.concatenate([low for low, high in bands]), np.concatenate([high for low, high in bands])
+
+def make_bootstrap_bands(sample_arrays, groups, day_labels, days, start_secs, interval,
+                         settings, executor=None):
+    """Given the sample arrays, a list of (group name, list of mice), the day labels, the days to
+    use, the start of each day's time slots (see extract_slot_start_secs), the sampling interval
+    (seconds) and the bootstrap settings,
+    returns a dictionary of group name mapped to the (low, high) band of its mean CBT at every time
+    slot of the days (see make_slot_matrix). Groups with no mice are left out."""
+    groups = [(group, mice) for group, mice in groups if len(mice) > 0]
+    matrices = make_group_slot_matrices(sample_arrays, groups, day_labels, days, start_secs, interval)
+    bands = {}
+    for group, mice in groups:
+        bands[group] = bootstrap_mean_bands(matrices[group], settings, executor)
+    return bands
+
+def make_window_bootstrap_bands(sample_arrays, groups, day_labels, windows, start_secs, interval,
+                                settings, executor=None):
+    """Returns a list of the make_bootstrap_bands of each window's days, in window order (a list of
+    (window name, list of days), see get_treatment_windows)."""
+    return [make_bootstrap_bands(sample_arrays, groups, day_labels, days, start_secs, interval,
+                                 settings, executor)
+            for name, days in windows]
+
+def bands_at_time_points(bands, window_stats, days, start_secs, interval):
+    """Given one window's bootstrap bands (see make_bootstrap_bands), its group statistics (see
+    group_time_point_stats), its days, the start of each day's time slots and the sampling interval
+    (seconds), returns a dictionary of group name mapped to (time points, low, high): the band at
+    the time slot of every time point of the group's line (see time_point_slots), so the band stays
+    with the line across recording gaps. None gives None."""
+    if bands is None:
+        return None
+    placed = {}
+    for group, (low, high) in bands.items():
+        stats = window_stats.get(group)
+        if stats is None or len(stats['time points']) == 0:
+            continue
+        slots = time_point_slots(stats, days, start_secs, interval)
+        inside = (slots >= 0) & (slots < len(low))
+        placed[group] = (stats['time points'][inside], low[slots[inside]], high[slots[inside]])
+    return placed
+
+def draw_bands(ax, bands, colors):
+    """Draws each group's band (see bands_at_time_points) behind the lines of an axes whose x values
+    are the plots' time points. colors maps group name to color."""
+    if bands is None:
+        return
+    for group, (x, low, high) in sorted(bands.items()):
+        ax.fill_between(x, low, high, color=colors[group], alpha=0.25, linewidth=0, zorder=1)
+
+#################
+#### PHASE SHIFTS
+#### Each mouse's shift in circadian phase from the last n days pre treatment to the last n days
+#### post treatment. Each window is folded into the mouse's average day on the aligned time slots
+#### (see make_slot_matrix), and the shift is the lag at the peak of the circular
+#### cross-correlation of the pre and post days. The cross-correlations of all mice are found at
+#### once with FFTs, and the peak is placed between slots by fitting a parabola to it.
+#################
+
+PHASE_MIN_COVERAGE = 0.5    #fraction of the time slots of each window's average day that need readings
+
+def extract_phase_shift_smoothing(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Phase shift', returns the number of minutes (float) in the cell to the right: the width of the
+    moving average the average days are smoothed with before they are compared (0 for none).
+    Returns None (no phase shifts) if the row is missing or empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Phase shift' in line[0] and line[1].strip():
+            return float(line[1])
+    return None
+
+def daily_profiles(matrix, slots_per_day):
+    """Given a (mice x slots) slot matrix of whole days (see make_slot_matrix), returns (profiles,
+    coverage): a (mice x slots_per_day) array of each mouse's mean CBT at each time of day over
+    the days, and the fraction of the time slots with readings on at least one day. Slots without
+    readings are filled in by interpolating around the clock. Mice with no readings are all NaN."""
+    days = matrix.reshape(matrix.shape[0], -1, slots_per_day)
+    counts = np.sum(np.isfinite(days), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        profiles = np.nansum(days, axis=1) / counts
+    slots = np.arange(slots_per_day)
+    for profile in profiles:
+        have = np.isfinite(profile)
+        if have.any() and not have.all():
+            profile[~have] = np.interp(slots[~have], slots[have], profile[have], period=slots_per_day)
+    return profiles, np.mean(counts > 0, axis=1)
+
+def smooth_profiles(profiles, n_slots):
+    """Returns each row of profiles smoothed with a centred moving average of n_slots slots that
+    wraps around the end of the day (one FFT for every row). n_slots of 1 or less returns them
+    unchanged."""
+    if n_slots <= 1:
+        return profiles
+    n = profiles.shape[1]
+    kernel = np.zeros(n)
+    kernel[:n_slots] = 1.0 / n_slots
+    kernel = np.roll(kernel, -(n_slots // 2))
+    return np.fft.irfft(np.fft.rfft(profiles, axis=1) * np.fft.rfft(kernel), n, axis=1)
+
+def estimate_phase_shifts(pre, post, interval):
+    """Given (mice x slots per day) arrays of the pre and post treatment average days (no NaN, see
+    daily_profiles) and the width of a slot (seconds), returns a dictionary of arrays with one
+    value per mouse: 'shift' (hours, from -12 to 12, positive when the post treatment rhythm runs
+    later than the pre treatment one) and 'correlation' (the correlation of the two days once the
+    shift is taken out). Rows with NaN give NaN."""
+    n = pre.shape[1]
+    pre = pre - np.mean(pre, axis=1)[:, None]
+    post = post - np.mean(post, axis=1)[:, None]
+    #cross[i, k] is the sum over t of pre[i, t] * post[i, t + k], for every mouse and lag at once
+    cross = np.fft.irfft(np.conj(np.fft.rfft(pre, axis=1)) * np.fft.rfft(post, axis=1), n, axis=1)
+    rows = np.arange(len(cross))
+    usable = np.all(np.isfinite(cross), axis=1)
+    best = np.argmax(np.where(usable[:, None], cross, 0), axis=1)
+    before = cross[rows, (best - 1) % n]
+    peak = cross[rows, best]
+    after = cross[rows, (best + 1) % n]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        curvature = before - 2 * peak + after
+        offset = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0)
+        lag = (best + offset + n / 2.0) % n - n / 2.0
+        correlation = peak / np.sqrt(np.sum(pre * pre, axis=1) * np.sum(post * post, axis=1))
+    lag[~usable] = np.nan
+    return {'shift': lag * interval / 3600.0, 'correlation': correlation}
+
+def circular_hours_summary(shifts):
+    """Given an array of phase shifts (hours, NaN ignored), returns (n, mean, stdev) with the mean
+    and stdev (hours) taken around the 24 hour clock, so shifts of 11.5 and -11.5 hours average to
+    12 hours rather than 0."""
+    shifts = shifts[np.isfinite(shifts)]
+    if len(shifts) == 0:
+        return 0, np.nan, np.nan
+    angles = shifts * 2 * np.pi / 24
+    x, y = np.mean(np.cos(angles)), np.mean(np.sin(angles))
+    length = min(math.hypot(x, y), 1.0)
+    stdev = math.sqrt(-2 * math.log(length)) * 24 / (2 * np.pi) if length > 0 else np.nan
+    return len(shifts), math.atan2(y, x) * 24 / (2 * np.pi), stdev
+
+def make_phase_shift_table(sample_arrays, groups, day_labels, windows, start_secs, interval,
+                           smoothing_minutes):
+    """Given the sample arrays, the treatment groups (a list of (group name, list of mice)), the
+    day labels, the [pre, post] treatment windows (see get_treatment_windows), the start of each
+    day's time slots (see extract_slot_start_secs), the sampling interval (seconds) and the
+    smoothing (minutes, see extract_phase_shift_smoothing), returns a dictionary of 'mice' (every
+    group's mice), arrays 'shift', 'correlation', 'coverage pre' and 'coverage post' with one value
+    per mouse (see estimate_phase_shifts and daily_profiles; mice with too little coverage in
+    either window get a NaN shift), and 'groups', a list of (group name, n, mean shift, stdev) (see
+    circular_hours_summary)."""
+    mice = group_mice(groups)
+    slots_per_day = int(round(86400.0 / interval))
+    profiles = []
+    coverage = []
+    for name, days in windows:
+        matrix = make_slot_matrix(sample_arrays, mice, day_labels, days, start_secs, interval)
+        window_profiles, window_coverage = daily_profiles(matrix, slots_per_day)
+        profiles.append(smooth_profiles(window_profiles, int(round(smoothing_minutes * 60 / interval))))
+        coverage.append(window_coverage)
+    table = estimate_phase_shifts(profiles[0], profiles[1], interval)
+    table['shift'][(coverage[0] < PHASE_MIN_COVERAGE) | (coverage[1] < PHASE_MIN_COVERAGE)] = np.nan
+    table.update({'mice': mice, 'coverage pre': coverage[0], 'coverage post': coverage[1]})
+    table['groups'] = [(group,) + circular_hours_summary(table['shift'][[mice.index(mouse) for mouse in group_mouse_nums]])
+                       for group, group_mouse_nums in groups]
+    return table
+
+def write_phase_shifts(table, mouse_treatments, filename):
+    """Writes the phase shift of every mouse, then the summary of every treatment group (see
+    make_phase_shift_table), to the given .csv file."""
+    writer = csv.writer(open(filename, 'wb'))
+    writer.writerow(['Mouse', 'Treatment', 'Phase shift (h)', 'Correlation', 'Pre coverage',
+                     'Post coverage'])
+    for i, mouse in enumerate(table['mice']):
+        writer.writerow([mouse, mouse_treatments.get(mouse, ''), '%.3f' %table['shift'][i],
+                         '%.3f' %table['correlation'][i], '%.3f' %table['coverage pre'][i],
+                         '%.3f' %table['coverage post'][i]])
+    writer.writerow([])
+    writer.writerow(['Treatment', 'n', 'Mean phase shift (h)', 'Circular stdev (h)'])
+    for group, n, mean, stdev in table['groups']:
+        writer.writerow([group, n, '%.3f' %mean, '%.3f' %stdev])
+
+#################
+#### PERIODOGRAM
+#### Lomb-Scargle periodogram of each mouse's recording (or of consecutive n day windows of it) to
+#### find free-running periods. Works on the unevenly spaced samples directly, so recording gaps
+#### and dropped readings need no filling in.
+#################
+
+PERIODOGRAM_MIN_FREQUENCIES = 200
+PERIODOGRAM_CHUNK = 2**21  #frequencies x samples evaluated per step, bounds memory use
+
+def extract_periodogram_period_range(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Periodogram period range', returns a list of [shortest, longest] period to search in hours
+    (floats) from the two cells to the right. Returns [20.0, 28.0] if the row is missing."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 2 and 'Periodogram period range' in line[0] and line[1].strip():
+            return [float(line[1]), float(line[2])]
+    return [20.0, 28.0]
+
+def extract_periodogram_window(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Periodogram window', returns the integer to the right of that cell (the number of days in
+    each periodogram window), or None (one periodogram of the whole recording) if it is empty."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Periodogram window' in line[0] and line[1].strip():
+            return int(line[1])
+    return None
+
+def extract_periodogram_plots(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Periodogram plots', returns True if the cell to the right says yes."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Periodogram plots' in line[0]:
+            return line[1].strip().lower() in ['yes', 'y', 'true', '1']
+    return False
+
+def make_frequency_grid(period_range, longest_span):
+    """Given the [shortest, longest] period in hours and the longest recording (hours) that will
+    be searched, returns the shared grid of frequencies (cycles per hour), evenly spaced and fine
+    enough to resolve a peak in the longest recording."""
+    f_min = 1.0 / period_range[1]
+    f_max = 1.0 / period_range[0]
+    n_freq = max(PERIODOGRAM_MIN_FREQUENCIES, int(5 * (f_max - f_min) * longest_span) + 1)
+    return np.linspace(f_min, f_max, n_freq)
+
+def lomb_scargle(starts, hours, temps, frequencies):
+    """Given the start index of each series in the concatenated sample times (hours) and
+    temperatures (every series with at least 3 samples), returns an array of normalized
+    Lomb-Scargle power (0 to 1, the fraction of variance a sinusoid explains) with one row per
+    series and one column per frequency. All series are evaluated against the shared frequency
+    grid together, a chunk of frequencies at a time; np.add.reduceat sums each series' part of the
+    frequency x sample matrices."""
+    ends = np.append(starts[1:], len(temps))
+    means = np.add.reduceat(temps, starts) / (ends - starts)
+    centered = temps - np.repeat(means, ends - starts)
+    total_ss = np.add.reduceat(centered**2, starts)
+    power = np.empty((len(starts), len(frequencies)))
+    chunk = max(1, PERIODOGRAM_CHUNK // len(temps))
+    for first in range(0, len(frequencies), chunk):
+        phase = 2 * pi * np.outer(frequencies[first:first+chunk], hours)
+        c = np.cos(phase)
+        s = np.sin(phase)
+        yc = np.add.reduceat(centered * c, starts, axis=1)
+        ys = np.add.reduceat(centered * s, starts, axis=1)
+        cc = np.add.reduceat(c * c, starts, axis=1)
+        ss = np.add.reduceat(s * s, starts, axis=1)
+        cs = np.add.reduceat(c * s, starts, axis=1)
+        #variance explained by the least squares fit of a cos + b sin at each frequency
+        det = cc * ss - cs**2
+        explained = (yc**2 * ss - 2 * yc * ys * cs + ys**2 * cc) / np.where(det > 0, det, np.nan)
+        power[:, first:first+chunk] = (explained / total_ss[None, :]).T
+    return power
+
+def periodogram_windows(sample_arrays, mouse_nums, day_labels, window_days):
+    """Given the mouse sample arrays, mouse numbers, day labels (in date order) and the number of
+    calendar days in each window (None for the whole recording), returns (labels, starts, hours,
+    temps): one (mouse, first day, last day, n) label per window and the concatenated samples (see
+    lomb_scargle) of the windows that can be analysed. Windows with fewer than 3 samples have
+    n = 0 and no samples."""
+    calendar = make_calendar_index(day_labels)
+    if window_days is None:
+        day_ranges = [(0, len(day_labels))]
+    else:
+        first_date = calendar['dates'][0]
+        n_days = (calendar['dates'][-1] - first_date).days + 1
+        day_ranges = [find_day_range(calendar, first_date + datetime.timedelta(i),
+                                     first_date + datetime.timedelta(i + window_days - 1))
+                      for i in range(0, n_days, window_days)]
+    labels = []
+    starts = []
+    hours = []
+    temps = []
+    n_total = 0
+    for mouse in mouse_nums:
+        arrays = sample_arrays[mouse]
+        for start, stop in day_ranges:
+            if start == stop:
+                continue    #no recordings in this window
+            window = select_day_range(arrays, start, stop)
+            finite = np.isfinite(arrays['temps'][window])
+            n = np.count_nonzero(finite)
+            if n < 3:
+                n = 0
+            else:
+                starts.append(n_total)
+                hours.append(arrays['elapsed'][window][finite] / 3600.0)
+                temps.append(arrays['temps'][window][finite])
+                n_total += n
+            labels.append((mouse, calendar['labels'][start], calendar['labels'][stop-1], n))
+    if n_total == 0:
+        return labels, np.array([], dtype=int), np.array([]), np.array([])
+    return labels, np.array(starts), np.concatenate(hours), np.concatenate(temps)
+
+def setup_periodogram_axes(ax, period_range):
+    """Given a matplotlib axes and the [shortest, longest] period in hours, sets the labels, limits
+    and grid shared by every periodogram plot. Returns the empty line artist."""
+    artist, = ax.plot([], [], 'b-')
+    ax.set_ylabel("Normalized Lomb-Scargle power")
+    ax.set_xlabel("Period (hrs)")
+    ax.set_xlim(period_range[0], period_range[1])
+    ax.set_ylim(0, 1)
+    ax.grid()
+    return artist
+
+def write_periodogram_table(sample_arrays, mouse_nums, day_labels, mouse_treatments, filename,
+                            table_filename):
+    """Computes the periodogram of every mouse (over the windows set in the user_modify file) and
+    writes each window's dominant period and its power to the given .csv file. Plots every
+    periodogram into the 'periodogram graphs' directory if 'Periodogram plots' is yes."""
+    period_range = extract_periodogram_period_range(filename)
+    labels, starts, hours, temps = periodogram_windows(sample_arrays, mouse_nums, day_labels,
+                                                       extract_periodogram_window(filename))
+    ends = np.append(starts[1:], len(temps))
+    spans = [hours[end-1] - hours[start] for start, end in zip(starts, ends)]
+    frequencies = make_frequency_grid(period_range, max(spans + [24.0]))
+    power = lomb_scargle(starts, hours, temps, frequencies) if len(starts) > 0 else None
+
+    writer = csv.writer(open(table_filename, 'wb'))
+    writer.writerow(['Mouse', 'Treatment', 'First day', 'Last day', 'n', 'Period (h)', 'Power'])
+    analysed = []
+    for mouse, first_day, last_day, n in labels:
+        row = [mouse, mouse_treatments.get(mouse, ''), first_day, last_day, n]
+        if n > 0:
+            series = power[len(analysed)]
+            analysed.append((mouse, first_day, last_day, series))
+            if np.all(np.isnan(series)):
+                row += ['nan', 'nan']
+            else:
+                peak = np.nanargmax(series)
+                row += ['%.3f' %(1.0 / frequencies[peak]), '%.4f' %series[peak]]
+        else:
+            row += ['nan', 'nan']
+        writer.writerow(row)
+
+    if extract_periodogram_plots(filename) and len(analysed) > 0:
+        plt = load_pyplot()
+        directory = 'periodogram graphs'
+        make_a_directory(directory)
+        template = make_plot_template(setup_periodogram_axes, [period_range])
+        output = open_plot_output(extract_graph_output_format(filename),
+                                  os.path.join(directory, 'periodograms'))
+        for mouse, first_day, last_day, series in analysed:
+            write_plot(output, template, [(1.0 / frequencies, series)],
+                       ["Periodogram mouse %s, %s to %s" %(mouse, first_day, last_day)],
+                       os.path.join(directory, "periodogram_mouse_%s_%s.png" %(mouse, first_day)))
+        close_plot_output(output, template)
+        plt.close(template['fig'])
+    return power
+
+#################
+#### AGGREGATE PYRAMID
+#### Each mouse's (and each treatment group's) samples summed into time bins of several widths,
+#### for example 5 minutes, 30 minutes, 1 hour and 1 day. Every bin holds the count, sum, sum of
+#### squares, min and max of its samples, so the mean and stdev of any run of bins can be added up
+#### from them. The narrowest level is built from the samples in one pass and every wider level
+#### from the level below it, and the levels are saved with the experiment as an .npz file, so
+#### any time range can be summarised at any of the widths by reading a few hundred bins.
+#################
+
+PYRAMID_REDUCERS = [('count', np.add), ('sum', np.add), ('sum_sq', np.add), ('min', np.minimum),
+                    ('max', np.maximum)]
+PYRAMID_MAX_BINS = 500      #bins returned by query_aggregates when no width is asked for
+DEFAULT_PYRAMID_MINUTES = [5, 30, 60, 1440]
+
+def extract_aggregate_pyramid(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Aggregate pyramid', returns the list of bin widths in seconds from the bin widths in minutes
+    in the cells to the right (narrowest first), or None (no pyramid) if the row is missing or
+    empty. Raises ValueError unless every width is a whole multiple of the one before it."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Aggregate pyramid' in line[0] and line[1].strip():
+            widths = sorted(int(round(float(cell) * 60)) for cell in line[1:] if cell.strip())
+            return check_pyramid_widths(widths)
+    return None
+
+def check_pyramid_widths(widths):
+    """Returns the list of bin widths (seconds, narrowest first) if every width is a positive
+    whole multiple of the one before it, otherwise raises ValueError."""
+    if len(widths) == 0 or widths[0] <= 0:
+        raise ValueError('aggregate pyramid bin widths must be positive')
+    for narrow, wide in zip(widths[:-1], widths[1:]):
+        if wide % narrow != 0 or wide == narrow:
+            raise ValueError('aggregate pyramid bin width of %g minutes is not a multiple of %g minutes'
+                             %(wide / 60.0, narrow / 60.0))
+    return widths
+
+def empty_bins():
+    """Returns a level with no bins (see combine_bins)."""
+    level = {'bin': np.array([], dtype=np.int64)}
+    for field, reducer in PYRAMID_REDUCERS:
+        level[field] = np.array([], dtype=int if field == 'count' else float)
+    return level
+
+def sample_bins(elapsed, temps, width):
+    """Given sample times (seconds) and temps and a bin width (seconds), returns every finite
+    sample as a bin of one sample (see combine_bins), ready to be combined into bins of width."""
+    keep = np.isfinite(temps)
+    temps = temps[keep]
+    return {'bin': np.floor(elapsed[keep] / width).astype(np.int64),
+            'count': np.ones(len(temps), dtype=int), 'sum': temps, 'sum_sq': temps * temps,
+            'min': temps, 'max': temps}
+
+def combine_bins(levels, factor=1):
+    """Given a list of levels of the same bin width (dictionaries of arrays: 'bin', the bin number
+    (start time // width), and the 'count', 'sum', 'sum_sq', 'min' and 'max' of the samples in the
+    bin) and a whole number factor, returns one level of bins factor times as wide holding all of
+    their samples. Only bins with samples are kept, in bin order."""
+    bins = np.concatenate([level['bin'] for level in levels]) // factor
+    if len(bins) == 0:
+        return empty_bins()
+    order = np.argsort(bins, kind='mergesort')
+    bins = bins[order]
+    starts = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+    combined = {'bin': bins[starts]}
+    for field, reducer in PYRAMID_REDUCERS:
+        values = np.concatenate([level[field] for level in levels])[order]
+        combined[field] = reducer.reduceat(values, starts)
+    return combined
+
+def build_levels(elapsed, temps, widths):
+    """Given sample times (seconds), temps and the pyramid's bin widths, returns a dictionary of
+    width mapped to the level of that width (see combine_bins)."""
+    levels = {widths[0]: combine_bins([sample_bins(elapsed, temps, widths[0])])}
+    for narrow, wide in zip(widths[:-1], widths[1:]):
+        levels[wide] = combine_bins([levels[narrow]], wide // narrow)
+    return levels
+
+def make_aggregate_pyramid(sample_arrays, groups, day_labels, widths):
+    """Given the sample arrays, a list of (group name, list of mice), the day labels and the bin
+    widths (seconds, see extract_aggregate_pyramid), returns the aggregate pyramid: a dictionary
+    of 'widths', 'first day' (bin times are seconds since midnight of this day, as the sample
+    arrays' 'elapsed'), 'mice' (mouse mapped to its levels, see build_levels) and 'groups' (group
+    name mapped to the levels of all of its mice's samples pooled). Groups with no mice are left
+    out."""
+    pyramid = {'widths': list(widths), 'first day': day_labels[0], 'mice': {}, 'groups': {}}
+    for mouse in sorted(sample_arrays):
+        arrays = sample_arrays[mouse]
+        pyramid['mice'][mouse] = build_levels(arrays['elapsed'], arrays['temps'], widths)
+    for group, mice in groups:
+        mice = [mouse for mouse in mice if mouse in pyramid['mice']]
+        if len(mice) > 0:
+            pyramid['groups'][group] = dict((width, combine_bins([pyramid['mice'][mouse][width]
+                                                                  for mouse in mice]))
+                                            for width in widths)
+    return pyramid
+
+def experiment_inputs_key(experiment):
+    """Given an experiment (see load_experiment), returns a key (hex string) of everything its
+    samples come from: the contents of its user_modify file and the name, size and modification
+    time of each of its data files (the sources, so writing clean_ copies of .csv exports doesn't
+    change it). Results saved with the key are current while it is unchanged."""
+    digest = hashlib.md5()
+    hash_figure_input(digest, open(experiment['user_input'], 'rb').read())
+    for f in sorted(experiment['data_files']):
+        info = os.stat(f)
+        hash_figure_input(digest, (f, info.st_size, int(info.st_mtime)))
+    return digest.hexdigest()
+
+def save_aggregate_pyramid(pyramid, path, inputs_key=''):
+    """Saves an aggregate pyramid (see make_aggregate_pyramid) as an .npz file with one array per
+    mouse or group, width and field, named like 'mouse|0|300|sum' or 'group|2|300|sum' (the number
+    is the index into the 'mouse names' or 'group names' array, so names can hold any character).
+    inputs_key (see experiment_inputs_key) is saved with it."""
+    arrays = {'widths': np.array(pyramid['widths']), 'first day': np.array(pyramid['first day']),
+              'inputs key': np.array(inputs_key)}
+    for kind, entries in [('mouse', pyramid['mice']), ('group', pyramid['groups'])]:
+        names = sorted(entries)
+        arrays[kind + ' names'] = np.array(names, dtype=str)
+        for i, name in enumerate(names):
+            for width, level in entries[name].items():
+                for field in level:
+                    arrays['%s|%d|%d|%s' %(kind, i, width, field)] = level[field]
+    np.savez(path, **arrays)
+
+def load_aggregate_pyramid(path):
+    """Returns the aggregate pyramid saved in the given .npz file (see save_aggregate_pyramid),
+    with its 'inputs key'."""
+    saved = np.load(path)
+    pyramid = {'widths': [int(width) for width in saved['widths']],
+               'first day': str(saved['first day']), 'inputs key': str(saved['inputs key']),
+               'mice': {}, 'groups': {}}
+    names = {'mouse': [str(name) for name in saved['mouse names']],
+             'group': [str(name) for name in saved['group names']]}
+    for key in saved.files:
+        if '|' in key:
+            kind, index, width, field = key.split('|')
+            entries = pyramid['mice' if kind == 'mouse' else 'groups']
+            entries.setdefault(names[kind][int(index)], {}).setdefault(int(width), {})[field] = saved[key]
+    saved.close()
+    return pyramid
+
+def load_current_aggregate_pyramid(path, experiment, widths):
+    """Returns the aggregate pyramid saved in the given .npz file if it has the given widths and was
+    saved from the experiment's current inputs (see experiment_inputs_key), or None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        pyramid = load_aggregate_pyramid(path)
+    except (IOError, KeyError, ValueError, IndexError):
+        return None
+    if pyramid['widths'] != list(widths) or pyramid['inputs key'] != experiment_inputs_key(experiment):
+        return None
+    return pyramid
+
+def query_aggregates(levels, widths, start, stop, width=None, max_bins=PYRAMID_MAX_BINS):
+    """Given the levels of one mouse or group (see make_aggregate_pyramid), the pyramid's widths,
+    a time range (seconds since midnight of the first day, start included, stop not) and a bin
+    width in seconds, returns a dictionary of the width and of arrays 'start' (bin start times),
+    'count', 'mean', 'stdev' (population), 'min' and 'max' of every bin with samples that overlaps
+    the range. The width can be any multiple of the narrowest stored width (other widths are added
+    up from the widest stored width that divides them). Without a width, the narrowest stored
+    width that gives at most max_bins bins over the range is used."""
+    if width is None:
+        fitting = [w for w in widths if (stop - start) / float(w) <= max_bins]
+        width = fitting[0] if len(fitting) > 0 else widths[-1]
+    divisors = [w for w in widths if width % w == 0]
+    if width <= 0 or len(divisors) == 0:
+        raise ValueError('bin width must be a multiple of %d seconds' %widths[0])
+    base = divisors[-1]
+    level = levels[base]
+    first = int(math.floor(start / float(width))) * (width // base)
+    last = int(math.ceil(stop / float(width))) * (width // base)
+    lo, hi = np.searchsorted(level['bin'], [first, last])
+    selected = combine_bins([dict((field, values[lo:hi]) for field, values in level.items())],
+                            width // base)
+    count = selected['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = selected['sum'] / count
+        variance = np.maximum(selected['sum_sq'] / count - mean * mean, 0)
+    return {'width': width, 'start': selected['bin'] * width, 'count': count, 'mean': mean,
+            'stdev': np.sqrt(variance), 'min': selected['min'], 'max': selected['max']}
+
+#################
+#### RESULTS DATABASE
+#### An optional sqlite file that collects the calibrated samples and per day/mouse/cycle summary
+#### statistics of every experiment analysed, so cohorts can be compared without re-running them.
+#################
+
+def extract_results_database(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Results database', returns the path in the cell to the right (or '' if there is none)."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Results database' in line[0]:
+            return line[1].strip()
+    return ''
+
+def extract_experiment_id(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Experiment ID', returns the string in the cell to the right. If there is none, returns the
+    name of the directory the code is running in."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Experiment ID' in line[0]:
+            if line[1].strip():
+                return line[1].strip()
+    return os.path.basename(os.getcwd())
+
+def make_mouse_treatments(groups):
+    """Given a list of (group name, list of mice), returns a dictionary of mouse mapped to its
+    treatment group name."""
+    mouse_treatments = {}
+    for group, mice in groups:
+        for mouse in mice:
+            mouse_treatments[mouse] = group
+    return mouse_treatments
+
+def open_results_database(db_path):
+    """Given the path of an sqlite file, opens it (creating it if needed) and makes sure the
+    experiments, samples and cycle_stats tables and their indexes exist. Queries by mouse, cycle
+    and treatment together (see query_cycle_stats) use the (mouse, cycle, treatment) indexes, which
+    replace the single column mouse indexes. Returns the connection."""
+    connection = sqlite3.connect(db_path)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS experiments (
+            experiment_id TEXT PRIMARY KEY, folder TEXT, analyzed TEXT);
+        CREATE TABLE IF NOT EXISTS samples (
+            experiment_id TEXT, day TEXT, mouse TEXT, cycle TEXT, treatment TEXT,
+            time TEXT, hours REAL, temp REAL);
+        CREATE TABLE IF NOT EXISTS cycle_stats (
+            experiment_id TEXT, day TEXT, mouse TEXT, cycle TEXT, treatment TEXT,
+            n INTEGER, mean REAL, stder REAL, stdev REAL);
+        CREATE INDEX IF NOT EXISTS samples_experiment ON samples (experiment_id);
+        DROP INDEX IF EXISTS samples_mouse;
+        CREATE INDEX IF NOT EXISTS samples_mouse_cycle_treatment ON samples (mouse, cycle, treatment);
+        CREATE INDEX IF NOT EXISTS samples_day ON samples (day);
+        CREATE INDEX IF NOT EXISTS samples_cycle ON samples (cycle);
+        CREATE INDEX IF NOT EXISTS samples_treatment ON samples (treatment);
+        CREATE INDEX IF NOT EXISTS cycle_stats_experiment ON cycle_stats (experiment_id);
+        DROP INDEX IF EXISTS cycle_stats_mouse;
+        CREATE INDEX IF NOT EXISTS cycle_stats_mouse_cycle_treatment ON cycle_stats (mouse, cycle, treatment);
+        CREATE INDEX IF NOT EXISTS cycle_stats_day ON cycle_stats (day);
+        CREATE INDEX IF NOT EXISTS cycle_stats_cycle ON cycle_stats (cycle);
+        CREATE INDEX IF NOT EXISTS cycle_stats_treatment ON cycle_stats (treatment);
+        """)
+    return connection
+
+def store_results(db_path, experiment_id, day_labels, mouse_nums, times, master_tt_dic,
+                  mouse_treatments):
+    """Bulk inserts every calibrated (time, temp) sample and the mean, standard error and standard
+    deviation of each day, mouse and cycle into the results database under the experiment ID.
+    Any rows already stored for that experiment ID are replaced."""
+    connection = open_results_database(db_path)
+    sample_rows = []
+    stat_rows = []
+    for day in day_labels:
+        for mouse in mouse_nums:
+            if mouse not in master_tt_dic[day]:
+                continue
+            treatment = mouse_treatments.get(mouse, '')
+            for cycle in times:
+                tt_list = master_tt_dic[day][mouse][cycle]
+                for tt in tt_list:
+                    sample_rows.append((experiment_id, day, mouse, cycle, treatment, tt[0],
+                                        hms_to_secs(tt[0]) / 3600.0, tt[1]))
+                if len(tt_list) > 0:
+                    CBT_lst = list_CBT(day, mouse, cycle, master_tt_dic)
+                    stat_rows.append((experiment_id, day, mouse, cycle, treatment, len(CBT_lst),
+                                      float(np.mean(CBT_lst)), float(stder(CBT_lst)),
+                                      float(stdev(CBT_lst))))
+    with connection:    #one transaction, so a failed run never leaves half an experiment behind
+        connection.execute("DELETE FROM samples WHERE experiment_id = ?", (experiment_id,))
+        connection.execute("DELETE FROM cycle_stats WHERE experiment_id = ?", (experiment_id,))
+        connection.execute("INSERT OR REPLACE INTO experiments VALUES (?, ?, datetime('now'))",
+                           (experiment_id, os.getcwd()))
+        connection.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)", sample_rows)
+        connection.executemany("INSERT INTO cycle_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", stat_rows)
+    connection.close()
+
+def query_cycle_stats(db_path, experiment_id=None, day=None, mouse=None, cycle=None,
+                      treatment=None):
+    """Returns a list of (experiment_id, day, mouse, cycle, treatment, n, mean, stder, stdev)
+    rows from the results database matching every argument that is given, for example all
+    Treatment 1 dark cycle means for mouse 14 across every stored experiment:
+    query_cycle_stats('results.sqlite', mouse='14', cycle='Dark Cycle', treatment='Treatment 1')
+    Rows come in experiment, date (day labels are 'mm-dd-yyyy', so they are ordered by year
+    first), mouse number and cycle order."""
+    conditions = []
+    params = []
+    for column, value in [('experiment_id', experiment_id), ('day', day), ('mouse', mouse),
+                          ('cycle', cycle), ('treatment', treatment)]:
+        if value is not None:
+            conditions.append(column + " = ?")
+            params.append(value)
+    sql = "SELECT * FROM cycle_stats"
+    if len(conditions) > 0:
+        sql += " WHERE " + " AND ".join(conditions)
+    connection = open_results_database(db_path)
+    order = " ORDER BY experiment_id, substr(day, 7, 4), substr(day, 1, 5), CAST(mouse AS REAL), mouse, cycle"
+    rows = connection.execute(sql + order, params).fetchall()
+    connection.close()
+    return rows
+
+#################
+#### PROFILING
+#################
+
+def extract_profile_stages(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Profile pipeline stages', returns True if the cell to the right says yes."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Profile pipeline stages' in line[0]:
+            return line[1].strip().lower() in ('yes', 'y', 'true', '1')
+    return False
+
+def extract_cprofile_stage(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Profile stage with cProfile', returns the stage name in the cell to the right (or '')."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Profile stage with cProfile' in line[0]:
+            return line[1].strip()
+    return ''
+
+def extract_track_memory(filename):
+    """Given a .csv file where the first cell in one of the rows contains the phrase
+    'Track memory use', returns True if the cell to the right says yes."""
+    data = csv.reader(open(filename, 'rU'), quotechar='"', delimiter = ',')
+    for line in data:
+        if len(line) > 1 and 'Track memory use' in line[0]:
+            return line[1].strip().lower() in ('yes', 'y', 'true', '1')
+    return False
+
+def make_stage_profile(filename):
+    """Given the user_modify file, returns the dictionary run_stage records each stage in."""
+    return {'enabled': extract_profile_stages(filename),
+            'memory': extract_track_memory(filename),
+            'cprofile_stage': extract_cprofile_stage(filename),
+            'stages': [],
+            'structures': []}
+
+def cpu_seconds():
+    """Returns the user + system CPU time used by this process so far, in seconds."""
+    cpu_times = os.times()
+    return cpu_times[0] + cpu_times[1]
+
+def run_stage(profile, stage_name, n_rows, function, *args):
+    """Runs function(*args) as one pipeline stage and returns its result. If profiling is enabled,
+    records the stage's wall time, CPU time and number of samples processed (n_rows, which can be
+    None and filled in later with set_stage_rows). If stage_name is the stage chosen for cProfile,
+    also dumps a cProfile file named 'cprofile_<stage_name>.prof'."""
+    if not (profile['enabled'] or profile['memory']) and stage_name != profile['cprofile_stage']:
+        return function(*args)
+    profiler = None
+    if stage_name == profile['cprofile_stage']:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    sampler = None
+    if profile['memory']:
+        sampler = start_rss_sampler()
+    wall_start = time.time()
+    cpu_start = cpu_seconds()
+    try:
+        result = function(*args)
+    finally:
+        #a stage that fails is still recorded, and the sampler thread is always stopped
+        wall = time.time() - wall_start
+        cpu = cpu_seconds() - cpu_start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats('cprofile_%s.prof' %stage_name.replace(' ', '_'))
+        record = {'stage': stage_name, 'wall': wall, 'cpu': cpu, 'rows': n_rows}
+        if sampler is not None:
+            record.update(stop_rss_sampler(sampler))
+        profile['stages'].append(record)
+    return result
+
+def set_stage_rows(profile, stage_name, n_rows):
+    """Sets the number of samples processed by the most recent run of the given stage."""
+    for stage in reversed(profile['stages']):
+        if stage['stage'] == stage_name:
+            stage['rows'] = n_rows
+            return
+
+def count_samples(tt_dic, mouse_nums=None):
+    """Given a day: {mouse: {cycle: [tt, tt...]}} dictionary, returns the total number of (time,
+    temp) tuples in it, only counting the given mice if mouse_nums is given."""
+    n_samples = 0
+    for day in tt_dic:
+        for mouse in tt_dic[day]:
+            if mouse_nums is None or mouse in mouse_nums:
+                for cycle in tt_dic[day][mouse]:
+                    n_samples += len(tt_dic[day][mouse][cycle])
+    return n_samples
+
+def current_rss():
+    """Returns the resident memory of this process in bytes, or None where /proc is unavailable."""
+    try:
+        return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+def peak_rss():
+    """Returns the largest resident memory this process has used so far, in bytes."""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak     #macs report bytes, linux reports kilobytes
+    return peak * 1024
+
+def start_rss_sampler(interval=0.01):
+    """Starts a background thread that samples this process's resident memory every interval
+    seconds and keeps the largest value seen. Returns the sampler dict for stop_rss_sampler."""
+    sampler = {'start_rss': current_rss(), 'start_peak': peak_rss(), 'max_rss': current_rss(),
+               'stop': threading.Event()}
+    def sample():
+        while not sampler['stop'].wait(interval):
+            rss = current_rss()
+            if rss is not None and rss > sampler['max_rss']:
+                sampler['max_rss'] = rss
+    sampler['thread'] = threading.Thread(target=sample)
+    sampler['thread'].daemon = True
+    sampler['thread'].start()
+    return sampler
+
+def stop_rss_sampler(sampler):
+    """Stops an RSS sampler and returns a dict of the stage's starting, ending and peak resident
+    memory (bytes), plus how much it raised the process's all-time peak. Where /proc is missing
+    (not linux) only the all-time peak is known, so the stage peak is taken from it."""
+    sampler['stop'].set()
+    sampler['thread'].join()
+    end_rss = current_rss()
+    end_peak = peak_rss()
+    if sampler['max_rss'] is None:
+        stage_peak = end_peak
+    else:
+        stage_peak = max(sampler['max_rss'], end_rss)
+    return {'start_rss': sampler['start_rss'], 'end_rss': end_rss, 'peak_rss': stage_peak,
+            'process_peak_increase': end_peak - sampler['start_peak']}
+
+def structure_size(structure):
+    """Given a nested structure of dicts, lists and tuples (such as master_tt_dic), returns a dict
+    with its total size in bytes (every object counted once, as sys.getsizeof reports it) and the
+    number of dicts, lists, tuples, strings and floats it holds."""
+    counts = {'bytes': 0, 'dicts': 0, 'lists': 0, 'tuples': 0, 'strings': 0, 'floats': 0,
+              'other': 0}
+    seen = set()
+    stack = [structure]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        counts['bytes'] += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            counts['dicts'] += 1
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, list):
+            counts['lists'] += 1
+            stack.extend(obj)
+        elif isinstance(obj, tuple):
+            counts['tuples'] += 1
+            stack.extend(obj)
+        elif isinstance(obj, basestring):
+            counts['strings'] += 1
+        elif isinstance(obj, float):
+            counts['floats'] += 1
+        else:
+            counts['other'] += 1
+    return counts
+
+def record_structure_size(profile, name, structure):
+    """If memory tracking is on, records the size of the given intermediate structure."""
+    if profile['memory']:
+        sizes = structure_size(structure)
+        sizes['structure'] = name
+        profile['structures'].append(sizes)
+
+def write_memory_report(profile, filename):
+    """Prints the per-stage resident memory and the size of each recorded structure, and writes
+    the same information as json to the given file."""
+    megabyte = 1024.0 * 1024.0
+    print
+    print "%-32s %12s %12s %12s" %('Stage', 'Start (MB)', 'Peak (MB)', 'End (MB)')
+    for stage in profile['stages']:
+        if 'peak_rss' in stage:
+            print "%-32s %12s %12.1f %12s" %(stage['stage'],
+                '-' if stage['start_rss'] is None else '%.1f' %(stage['start_rss'] / megabyte),
+                stage['peak_rss'] / megabyte,
+                '-' if stage['end_rss'] is None else '%.1f' %(stage['end_rss'] / megabyte))
+    print
+    print "%-32s %10s %10s %10s %10s %10s %10s" %('Structure', 'MB', 'Dicts', 'Lists', 'Tuples',
+                                                  'Strings', 'Floats')
+    for sizes in profile['structures']:
+        print "%-32s %10.2f %10d %10d %10d %10d %10d" %(sizes['structure'], sizes['bytes'] / megabyte,
+            sizes['dicts'], sizes['lists'], sizes['tuples'], sizes['strings'], sizes['floats'])
+    print "Process peak resident memory: %.1f MB" %(peak_rss() / megabyte)
+    report = {'process_peak_rss': peak_rss(),
+              'stages': [stage for stage in profile['stages'] if 'peak_rss' in stage],
+              'structures': profile['structures']}
+    json.dump(report, open(filename, 'w'), indent=2, sort_keys=True)
+
+def write_stage_report(profile, filename):
+    """Writes (and prints) a table of every recorded stage's wall time, CPU time, samples processed
+    and throughput in samples per second."""
+    lines = ["%-32s %10s %10s %12s %16s" %('Stage', 'Wall (s)', 'CPU (s)', 'Samples', 'Samples/sec')]
+    total_wall = 0.0
+    total_cpu = 0.0
+    for stage in profile['stages']:
+        total_wall += stage['wall']
+        total_cpu += stage['cpu']
+        if stage['rows'] is None:
+            rows = throughput = '-'
+        else:
+            rows = str(stage['rows'])
+            throughput = '%.0f' %(stage['rows'] / stage['wall']) if stage['wall'] > 0 else '-'
+        lines.append("%-32s %10.3f %10.3f %12s %16s" %(stage['stage'], stage['wall'], stage['cpu'],
+                                                       rows, throughput))
+    lines.append("%-32s %10.3f %10.3f" %('Total', total_wall, total_cpu))
+    file = open(filename, "w")
+    for line in lines:
+        file.write(line + "\n")
+    file.close()
+    print
+    for line in lines:
+        print line
+
 #################
 #### MAIN
 #################
     
     
-def main():
-    """This is the main python code that is run in this program."""
+def main(calibration_dict=None):
+    """This is the main python code that is run in this program. calibration_dict is only given
+    when a parsed Calibration Document is shared between experiments (see batch_core_body_temp)."""
     
     user_input = 'user_modify.csv'
-    
+    profile = make_stage_profile(user_input)
+    try:
+        analyze_experiment(user_input, profile, calibration_dict)
+    finally:
+        #written even if a stage fails, so a slow or broken run still shows where time went
+        if profile['enabled']:
+            write_stage_report(profile, 'stage_timing_report.txt')
+        if profile['memory']:
+            write_memory_report(profile, 'memory_report.json')
+
+def load_experiment(user_input, profile, calibration_dict=None):
+    """Runs the stages that read the data files in the current directory into memory, as set up by
+    the given user_modify file: ingest, calibration, day reassignment, sample arrays, the outlier
+    filter and the gap index. Each stage is timed in the given profile (see run_stage). If no
+    calibration_dict is given, the Calibration Document in the directory is used. Returns a
+    dictionary of everything the later stages work from. The only files written are the clean_
+    copies of .csv exports that don't have a current one yet (see clean_all_csv_files)."""
+
     filenames = get_data_file_names()
     # gets all .csv files in the directory without the words 'test' or 'user' in the file name,
     # also returns files with the term "Proper" or "CSV " as long as they don't have 'test'/'user'
@@ -1259,94 +3945,269 @@ def main():
     #mouse_nums is a sorted list of strings of all mouse numbers to be used in analysis
     #as dictated by user
 
-    tx1_mice = extract_tx1_mice(user_input)
-    tx2_mice = extract_tx2_mice(user_input)
-    #list of strings of mouse numbers in the treatment group
-
-    n_ints_in_mavg = extract_ints_in_mavg(user_input)
-    #this defines how many points to be used in calculating moving averages
-    
-    n_stdev = extract_ints_in_moving_stdev(user_input)
-    #this defines how many points to be used in calculating moving standard deviation 
+    groups = extract_treatment_groups(user_input)
+    #list of (group name, list of strings of mouse numbers in the group), one per 'Treatment ' row
+    mouse_treatments = make_mouse_treatments(groups)
 
     times = ["Dark Cycle", "Light Cycle"]
 
 
     ########
     ######## This determines how to get data & certain variables dependant on data format
+    ######## (a folder can hold both SubCue .TXT downloads and .csv exports)
     ########
+    discovered = discover_data_files(filenames)
+    txt_files = [info['filename'] for info in discovered['subcue txt']]
+    csv_files = [info['filename'] for info in discovered['csv export']]
+    calibration_files = [info['filename'] for info in discovered['calibration']]
+    master_tt_dic = {}
+    txt_tt_dic = {}
+    clean_csv_data_files = []
+    source_csv_files = []   #the .csv files the samples come from (not clean_ copies of them)
+    raw_csv_mouse_ids = []
     print
-    if '.TXT' in filenames[0]:
+    if len(txt_files) > 0:
         print "This program is expecting .txt data"
         print
         print "Analyzing the following files for experiment data:"
-        for data_file in filenames:
-            print data_file
-        mouse_ids = extract_txt_mouse_ids(filenames)
-        raw_master_tt_dic = make_raw_master_tt_dic_txt(filenames, user_input)
-        calibrated_tt_dict = calibrate_data(filenames, raw_master_tt_dic)
-        master_tt_dic = refit_to_master_tt_dic(calibrated_tt_dict, mouse_ids, user_input)
-##        day_labels = sort_day_labels(master_tt_dic.keys()) ##change to properly order
-        day_labels = sorted(master_tt_dic.keys())
-        
-        
-        ##NOTE that function to create last_four_days has not been created yet, so not plotted
-        
-    elif '.csv' in filenames[0]:
+        for info in discovered['subcue txt'] + discovered['calibration']:
+            print info['filename'], "(%s to %s)" %(info['first_date'], info['last_date']) if info['first_date'] else ''
+        mouse_ids = extract_txt_mouse_ids(txt_files)
+        raw_master_tt_dic = run_stage(profile, 'ingest', None, make_raw_master_tt_dic_txt,
+                                      txt_files, user_input)
+        n_samples = count_samples(raw_master_tt_dic)
+        set_stage_rows(profile, 'ingest', n_samples)
+        calibrated_tt_dict = run_stage(profile, 'calibration', n_samples, calibrate_data,
+                                       calibration_files, raw_master_tt_dic, calibration_dict)
+        record_structure_size(profile, 'raw_master_tt_dic', raw_master_tt_dic)
+        record_structure_size(profile, 'calibrated_tt_dict', calibrated_tt_dict)
+        txt_tt_dic = run_stage(profile, 'day reassignment', n_samples, refit_to_master_tt_dic,
+                               calibrated_tt_dict, mouse_ids, user_input)
+        master_tt_dic = merge_tt_dics(master_tt_dic, txt_tt_dic)
+
+    if len(csv_files) > 0:
         print "This program is expecting .csv data"
         print
         print "Analyzing the following files for experiment data:"
-        clean_all_csv_files(filenames)
-        clean_csv_data_files = get_clean_data_file_names()
+        raw_csv_files = [f for f in csv_files if not f.startswith('clean_')]
+        clean_all_csv_files(raw_csv_files)
+        clean_csv_data_files = ['clean_' + f for f in raw_csv_files]
+        source_csv_files = list(raw_csv_files)
+        #files that were already cleaned are used as they are, if their original isn't here
+        for f in csv_files:
+            if f.startswith('clean_') and f not in clean_csv_data_files:
+                clean_csv_data_files.append(f)
+                source_csv_files.append(f)
         for clean_file in clean_csv_data_files:
             print clean_file
             
         mouse_ids = get_all_mouse_ids_csv(clean_csv_data_files)
         #mouse ids is a list of strings (that are digits) from the csv files with data
+        raw_csv_mouse_ids = list(mouse_ids)
         
-        raw_days_tt_dic = make_master_tt_dic(clean_csv_data_files, mouse_ids)
+        raw_days_tt_dic = run_stage(profile, 'ingest', None, make_master_tt_dic,
+                                    clean_csv_data_files, mouse_ids)
+        n_samples = count_samples(raw_days_tt_dic)
+        set_stage_rows(profile, 'ingest', n_samples)
+        record_structure_size(profile, 'raw_days_tt_dic', raw_days_tt_dic)
         mouse_ids = clean_mouse_ids(mouse_ids)
-        master_tt_dic = refit_to_master_tt_dic(raw_days_tt_dic, mouse_ids, user_input)
-        day_labels = sorted(master_tt_dic.keys())
+        csv_tt_dic = run_stage(profile, 'day reassignment', n_samples, refit_to_master_tt_dic,
+                               raw_days_tt_dic, mouse_ids, user_input)
+        master_tt_dic = merge_tt_dics(master_tt_dic, csv_tt_dic)
+##        day_labels = sort_day_labels(master_tt_dic.keys()) ##change to properly order
+    day_labels = sort_day_labels_by_date(master_tt_dic.keys())
 
     ########
     ######## The rest of the code is not perturbed by different data formats
     ########
-    last_two_cycles = day_labels[-3:len(day_labels)] #this makes a list of the last three days
+    n_samples = count_samples(master_tt_dic, mouse_nums) #samples each later stage works through
+    record_structure_size(profile, 'master_tt_dic', master_tt_dic)
     
-    find_all_avgs_ers(day_labels, mouse_nums, times, master_tt_dic) #modify to make excel doc, NOT print
-    mav_master_dic = make_mav_master_dic(day_labels, mouse_nums, times, master_tt_dic, n_ints_in_mavg)
+    sample_arrays = run_stage(profile, 'sample arrays', n_samples, make_mouse_sample_arrays,
+                              day_labels, mouse_nums, times, master_tt_dic,
+                              extract_light_start_secs(user_input))
+    record_structure_size(profile, 'sample_arrays', sample_arrays)
+    #every later stage only sees the samples the outlier filter keeps
+    outlier_masks = run_stage(profile, 'outlier filter', n_samples, make_outlier_masks,
+                              sample_arrays, mouse_nums, extract_outlier_settings(user_input))
+    outlier_rejections = find_outlier_rejections(sample_arrays, outlier_masks, day_labels, times)
+    sample_arrays, master_tt_dic = apply_outlier_masks(sample_arrays, master_tt_dic, outlier_masks,
+                                                       day_labels, times)
+    n_samples = count_samples(master_tt_dic, mouse_nums)
+    interval_secs = extract_data_collection_interval(user_input) or typical_interval(sample_arrays)
+    gap_index = run_stage(profile, 'gap index', n_samples, make_gap_index, sample_arrays, interval_secs)
+    return {'user_input': user_input, 'mouse_nums': mouse_nums, 'groups': groups,
+            'mouse_treatments': mouse_treatments, 'times': times,
+            'day_labels': day_labels, 'master_tt_dic': master_tt_dic, 'n_samples': n_samples,
+            'sample_arrays': sample_arrays, 'outlier_masks': outlier_masks,
+            'outlier_rejections': outlier_rejections,
+            'interval_secs': interval_secs, 'gap_index': gap_index, 'txt_tt_dic': txt_tt_dic,
+            'clean_csv_data_files': clean_csv_data_files, 'raw_csv_mouse_ids': raw_csv_mouse_ids,
+            'data_files': txt_files + source_csv_files + calibration_files}
+
+def analyze_experiment(user_input, profile, calibration_dict=None):
+    """Runs every stage of the analysis on the data files in the current directory, as set up by
+    the given user_modify file. Each stage is timed in the given profile (see run_stage). If no
+    calibration_dict is given, the Calibration Document in the directory is used."""
+    experiment = load_experiment(user_input, profile, calibration_dict)
+    mouse_nums = experiment['mouse_nums']
+    groups = experiment['groups']
+    mouse_treatments = experiment['mouse_treatments']
+    times = experiment['times']
+    day_labels = experiment['day_labels']
+    master_tt_dic = experiment['master_tt_dic']
+    n_samples = experiment['n_samples']
+    sample_arrays = experiment['sample_arrays']
+    interval_secs = experiment['interval_secs']
+    gap_index = experiment['gap_index']
+
+    n_ints_in_mavg = extract_ints_in_mavg(user_input)
+    #this defines how many points to be used in calculating moving averages
     
-    #makes avg_plot graphs directory and all_avg_plots places generated graphs in there
-    make_a_directory('avg_plot graphs')
-    all_avg_plots(master_tt_dic, user_input)
+    n_stdev = extract_ints_in_moving_stdev(user_input)
+    #this defines how many points to be used in calculating moving standard deviation 
 
-    #makes n_moving_stdev graphs directory and plot_n_moving_stdv places generated graphs in there
-    make_a_directory(str(n_stdev)+'_moving stdv graphs')
-    plot_n_moving_stdv(day_labels, mouse_nums, times, master_tt_dic, n_stdev, user_input)
+    last_two_cycles = day_labels[-3:len(day_labels)] #this makes a list of the last three days
+
+    write_outlier_report(experiment['outlier_masks'], mouse_nums, mouse_treatments,
+                         'outlier_rejections.csv')
+    pyramid_widths = extract_aggregate_pyramid(user_input)
+    if pyramid_widths:
+        pyramid = run_stage(profile, 'aggregate pyramid', n_samples, make_aggregate_pyramid,
+                            sample_arrays, groups + [('All mice', mouse_nums)], day_labels,
+                            pyramid_widths)
+        save_aggregate_pyramid(pyramid, 'aggregate_pyramid.npz', experiment_inputs_key(experiment))
+    results_database = extract_results_database(user_input)
+    if results_database:
+        run_stage(profile, 'results database', n_samples, store_results, results_database,
+                  extract_experiment_id(user_input), day_labels, mouse_nums, times, master_tt_dic,
+                  mouse_treatments)
+    event_rules = extract_event_rules(user_input)
+    if len(event_rules) > 0:
+        events = run_stage(profile, 'events', n_samples, make_event_table, sample_arrays, gap_index,
+                           mouse_nums, event_rules, day_labels, times)
+        write_event_tables(events, event_rules, day_labels, mouse_nums, mouse_treatments,
+                           'cbt_events.csv', 'cbt_event_counts.csv')
+    #the per-mouse stages are split over 'Worker processes' processes
+    executor = make_mouse_executor(sample_arrays, mouse_nums, extract_worker_processes(user_input))
+    try:
+        run_stage(profile, 'statistics', n_samples, find_all_avgs_ers,
+                  day_labels, mouse_nums, times, master_tt_dic, executor) #modify to make excel doc, NOT print
+        run_stage(profile, 'completeness report', None, write_completeness_report, sample_arrays,
+                  gap_index, day_labels, mouse_nums, mouse_treatments, 'data_completeness.csv')
+        run_stage(profile, 'cosinor', n_samples, write_cosinor_table, sample_arrays, mouse_nums,
+                  day_labels, get_treatment_windows(day_labels, user_input),
+                  mouse_treatments, 'cosinor_parameters.csv')
+        run_stage(profile, 'periodogram', n_samples, write_periodogram_table, sample_arrays,
+                  mouse_nums, day_labels, mouse_treatments, user_input,
+                  'periodogram_periods.csv')
+        #moving windows stop at recording gaps
+        mav_master_dic = run_stage(profile, 'moving averages', n_samples, make_gap_aware_stat_master_dic,
+                                   day_labels, mouse_nums, times, sample_arrays, gap_index,
+                                   n_ints_in_mavg, 'mean', executor)
+        record_structure_size(profile, 'mav_master_dic', mav_master_dic)
+        if profile['memory']:
+            #only built to be measured: the group plots build one of these per group and window
+            record_structure_size(profile, 'time_to_temps_dict (all mice)',
+                                  make_time_to_temps_dict(day_labels, times, mouse_nums, master_tt_dic))
+    
+        #makes avg_plot graphs directory and all_avg_plots places generated graphs in there
+        make_a_directory('avg_plot graphs')
+        run_stage(profile, 'avg plots', count_samples(master_tt_dic), all_avg_plots,
+                  master_tt_dic, user_input)
+
+        #makes n_moving_stdev graphs directory and plot_n_moving_stdv places generated graphs in there
+        make_a_directory(str(n_stdev)+'_moving stdv graphs')
+        stdev_master_dic = run_stage(profile, 'moving stdevs', n_samples, make_gap_aware_stat_master_dic,
+                                     day_labels, mouse_nums, times, sample_arrays, gap_index, n_stdev,
+                                     'stdev', executor)
+        stdev_hours_dic = make_gap_aware_hours_master_dic(day_labels, mouse_nums, times, sample_arrays,
+                                                          gap_index)
+        run_stage(profile, 'moving stdev plots', n_samples, plot_n_moving_stdv,
+                  day_labels, mouse_nums, times, master_tt_dic, n_stdev, user_input, stdev_master_dic,
+                  stdev_hours_dic)
     
-    get_all_last_2_cycles_moving_stdev(master_tt_dic, tx1_mice, tx2_mice, n_stdev, last_two_cycles)
+        run_stage(profile, 'moving envelope plots', n_samples, plot_moving_envelopes,
+                  day_labels, mouse_nums, master_tt_dic, user_input)
+    
+        run_stage(profile, 'last 2 cycles moving stdev', None, get_all_last_2_cycles_moving_stdev,
+                  master_tt_dic, groups, n_stdev, last_two_cycles, executor, day_labels, times)
+
+        #confidence bands drawn on the group plots below
+        bootstrap_settings = extract_bootstrap_bands(user_input)
+        overall_bands = None
+        window_bands = None
+        if bootstrap_settings is not None and interval_secs > 0:
+            slot_start_secs = extract_slot_start_secs(user_input, times)
+            overall_bands = run_stage(profile, 'bootstrap bands', n_samples, make_bootstrap_bands,
+                                      sample_arrays, groups, day_labels, day_labels, slot_start_secs,
+                                      interval_secs, bootstrap_settings, executor)
+            windows = get_treatment_windows(day_labels, user_input)
+            if len(windows) == 2:
+                window_bands = run_stage(profile, 'pre/post bootstrap bands', n_samples,
+                                         make_window_bootstrap_bands, sample_arrays, groups,
+                                         day_labels, windows, slot_start_secs, interval_secs,
+                                         bootstrap_settings, executor)
+    finally:
+        close_mouse_executor(executor)
     
     ##################################################################################################
-    #broken beyond here
-    all_times_dic = make_all_times_dic(filenames, mouse_nums)
-    overall_expt_plot(day_labels, times, tx2_mice, tx1_mice, 1, all_times_dic) #modify for flexibility!!
-    overall_expt_plot_stdev(day_labels, times, tx2_mice, tx1_mice, 1, all_times_dic) #modify for flexibility!!
+    #the group plots need every sample, including 'NaN' readings, at the same position for every mouse
+    all_times_dic = run_stage(profile, 'all times ingest', None, make_all_times_dic_for_experiment,
+                              experiment['txt_tt_dic'], experiment['clean_csv_data_files'],
+                              experiment['raw_csv_mouse_ids'], user_input)
+    #the outlier filter's rejections become NaN readings, so every mouse keeps its time points
+    all_times_dic = drop_rejected_samples(all_times_dic, experiment['outlier_rejections'], True)
+    record_structure_size(profile, 'all_times_dic', all_times_dic)
+    #every group's mean and stdev at every time point of each window, in one grouped pass
+    treatment_windows = get_treatment_windows(day_labels, user_input)
+    group_stats = run_stage(profile, 'group statistics', None, make_group_window_stats, all_times_dic,
+                            [('entire experiment', day_labels)] + treatment_windows, times, groups)
+    #bands and shading are per time slot; each is drawn at the time points of the slots' readings
+    slot_start_secs = extract_slot_start_secs(user_input, times)
+    overall_bands = bands_at_time_points(overall_bands, group_stats['entire experiment'], day_labels,
+                                         slot_start_secs, interval_secs)
+    run_stage(profile, 'overall expt plot', None, overall_expt_plot,
+              group_stats['entire experiment'], groups, 1, overall_bands) #modify for flexibility!!
+    run_stage(profile, 'overall expt stdev plot', None, overall_expt_plot_stdev,
+              group_stats['entire experiment'], groups, 1) #modify for flexibility!!
 ##
 ##
 ##
     tx_start_date = extract_treatment_start_date(user_input)
     #execute the following if given a treatment start date
-    if len(tx_start_date) > 0:
-        last_n_pre_days = get_last_n_pre_days(tx_start_date, day_labels, user_input)
-        last_n_post_days = get_last_n_post_days(tx_start_date, day_labels, user_input)
-        plot_each_treatment_last_days(last_n_pre_days, last_n_post_days, times, tx2_mice,
-                                      tx1_mice, 1, all_times_dic)
-
-        plot_each_treatment_last_days(last_four_pre_days, last_four_post_days, times, tx2_mice,
-                                     tx1_mice, 1, all_times_dic)
-        plot_stdev_each_treatment_last_days(last_four_pre_days, last_four_post_days, times, tx2_mice,
-                                            tx1_mice, 1, all_times_dic)
+    if tx_start_date:
+        treatment_tests = extract_group_comparison_tests(user_input)
+        shading = None
+        if treatment_tests is not None and interval_secs > 0:
+            test_results = run_stage(profile, 'treatment tests', n_samples, run_treatment_tests,
+                                     sample_arrays, day_labels, times, groups, treatment_windows,
+                                     extract_slot_start_secs(user_input, times), interval_secs,
+                                     treatment_tests['fdr'])
+            write_treatment_tests(test_results, 'treatment_tests.csv')
+            if treatment_tests['shade'] and len(treatment_windows) == 2:
+                shading = [shading_at_time_points(significant, group_stats[name], days,
+                                                  slot_start_secs, interval_secs)
+                           for significant, (name, days) in zip(significant_slots(test_results,
+                                                                                   treatment_windows),
+                                                                 treatment_windows)]
+        phase_shift_smoothing = extract_phase_shift_smoothing(user_input)
+        if phase_shift_smoothing is not None and len(treatment_windows) == 2 and interval_secs > 0:
+            phase_shifts = run_stage(profile, 'phase shifts', n_samples, make_phase_shift_table,
+                                     sample_arrays, groups, day_labels, treatment_windows,
+                                     extract_slot_start_secs(user_input, times), interval_secs,
+                                     phase_shift_smoothing)
+            write_phase_shifts(phase_shifts, mouse_treatments, 'phase_shifts.csv')
+        if len(treatment_windows) == 2:     #both the last n days pre and post treatment
+            window_stats = [group_stats[name] for name, days in treatment_windows]
+            if window_bands is not None:
+                window_bands = [bands_at_time_points(bands, group_stats[name], days, slot_start_secs,
+                                                     interval_secs)
+                                for bands, (name, days) in zip(window_bands, treatment_windows)]
+            run_stage(profile, 'pre/post treatment plots', None, plot_each_treatment_last_days,
+                      window_stats, groups, 1, shading, window_bands)
+            run_stage(profile, 'pre/post treatment stdev plots', None, plot_stdev_each_treatment_last_days,
+                      window_stats, groups, 1)
     #Make sample frequency a variable
     #Make another function that does moving avg/stdev
     
@@ -1354,10 +4215,3 @@ if __name__ == "__main__":
     main()
     print
     print "All done! Your data awaits you."
-
-##pr.disable()
-##s = StringIO.StringIO()
-##sortby = 'percall'
-##ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-##ps.print_stats()
-##print s.getvalue()
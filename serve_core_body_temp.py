@@ -0,0 +1,336 @@
+# Mouse CBT analysis - local analysis server
+#
+# Keeps experiments parsed, calibrated and filtered in memory and answers questions about them
+# over HTTP on localhost, so figures and statistics can be asked for again and again without
+# running core_body_temp from cold each time. Every experiment folder needs its own
+# user_modify.csv next to its data files. Run from the directory core_body_temp.py is in:
+#
+#   python serve_core_body_temp.py "expt 1" "expt 2"             (loads both, serves on port 8765)
+#   python serve_core_body_temp.py --port 9000 --cache-mb 512 "expt 1"
+#
+# then ask (from a browser, curl or a script; other folders are loaded the first time they are
+# asked about):
+#
+#   /experiments                                       loaded experiments, their mice and days
+#   /group-mean?experiment=expt 1&group=Treatment 1&days=02-11-2015,02-12-2015
+#                                                      group mean CBT at every time slot
+#   /moving-stdev?experiment=expt 1&mouse=7&points=21  gap-aware moving stdev of each day and cycle
+#   /cycle-stats?experiment=expt 1&mouse=7             n, mean and stdev of each day and cycle
+#   /avg-plot.png?experiment=expt 1&day=02-11-2015     the daily average plot
+#   /aggregates?experiment=expt 1&group=Treatment 1&start=86400&stop=172800&bins=200
+#                                                      count, mean, stdev, min and max of time bins
+#                                                      (mouse= for one mouse, width= in seconds)
+#   /reload?experiment=expt 1                          reads the folder again (after new data)
+#   /cache                                             cache size, hits and misses
+#
+# Loading an experiment reads its folder the way core_body_temp does, so .csv exports get their
+# clean_ copies written beside them the first time (see core_body_temp.clean_all_csv_files).
+# Answers are JSON, or png for plots. Every answer is kept in a least recently used cache of at
+# most --cache-mb megabytes, so asking the same question again comes straight from memory.
+
+import os
+import sys
+import json
+import time
+import urllib
+import urlparse
+import argparse
+import traceback
+import collections
+import BaseHTTPServer
+from cStringIO import StringIO
+
+import matplotlib
+matplotlib.use('Agg')   #the server never opens windows
+
+import numpy as np
+import core_body_temp
+
+#################
+#### Result cache
+#################
+
+def make_result_cache(max_bytes):
+    """Returns an empty least recently used cache that holds at most max_bytes of answers."""
+    return {'entries': collections.OrderedDict(), 'bytes': 0, 'max_bytes': max_bytes,
+            'hits': 0, 'misses': 0}
+
+def cache_get(cache, key):
+    """Returns the (content type, body) stored under key and marks it as most recently used, or
+    None if it isn't in the cache."""
+    if key not in cache['entries']:
+        cache['misses'] += 1
+        return None
+    cache['hits'] += 1
+    value = cache['entries'].pop(key)
+    cache['entries'][key] = value
+    return value
+
+def cache_put(cache, key, value):
+    """Stores a (content type, body) answer under key, dropping the least recently used answers
+    until the cache fits in its memory cap. Answers bigger than the whole cap aren't stored."""
+    size = len(value[1])
+    if size > cache['max_bytes']:
+        return
+    if key in cache['entries']:
+        cache['bytes'] -= len(cache['entries'].pop(key)[1])
+    cache['entries'][key] = value
+    cache['bytes'] += size
+    while cache['bytes'] > cache['max_bytes']:
+        old_key, old_value = cache['entries'].popitem(last=False)
+        cache['bytes'] -= len(old_value[1])
+
+def cache_drop_experiment(cache, name):
+    """Removes every answer about the named experiment from the cache."""
+    for key in [key for key in cache['entries'] if key[0] == name]:
+        cache['bytes'] -= len(cache['entries'].pop(key)[1])
+
+#################
+#### Experiments
+#################
+
+def load_experiment_directory(directory):
+    """Reads the experiment in the given directory into memory (see core_body_temp.load_experiment)
+    and adds the settings the queries use from its user_modify file. Returns the experiment."""
+    start_dir = os.getcwd()
+    os.chdir(directory)
+    try:
+        user_input = 'user_modify.csv'
+        experiment = core_body_temp.load_experiment(user_input,
+                                                    core_body_temp.make_stage_profile(user_input))
+        experiment['n_stdev'] = core_body_temp.extract_ints_in_moving_stdev(user_input)
+        experiment['avg_plot_ylims'] = core_body_temp.extract_avg_plot_axis(user_input)
+        experiment['slot_start_secs'] = core_body_temp.extract_slot_start_secs(user_input,
+                                                                               experiment['times'])
+        widths = (core_body_temp.extract_aggregate_pyramid(user_input) or
+                  [minutes * 60 for minutes in core_body_temp.DEFAULT_PYRAMID_MINUTES])
+        #the pyramid saved by the last analysis is used while the data and settings are unchanged
+        experiment['pyramid'] = core_body_temp.load_current_aggregate_pyramid(
+            'aggregate_pyramid.npz', experiment, widths)
+        if experiment['pyramid'] is None:
+            experiment['pyramid'] = core_body_temp.make_aggregate_pyramid(
+                experiment['sample_arrays'], experiment['groups'] + [('All mice', experiment['mouse_nums'])],
+                experiment['day_labels'], widths)
+        experiment['loaded'] = time.time()
+    finally:
+        os.chdir(start_dir)
+    return experiment
+
+def get_experiment(experiments, name):
+    """Returns the named experiment (the folder as given), loading it the first time."""
+    if name not in experiments:
+        if not os.path.exists(os.path.join(name, 'user_modify.csv')):
+            raise LookupError('no user_modify.csv in ' + name)
+        experiments[name] = load_experiment_directory(name)
+    return experiments[name]
+
+def get_mouse(experiment, params):
+    """Returns the mouse number asked for, if the experiment has that mouse."""
+    mouse = params.get('mouse', '')
+    if mouse not in experiment['sample_arrays']:
+        raise LookupError('no mouse %r in this experiment' %mouse)
+    return mouse
+
+def json_answer(data):
+    """Returns a (content type, body) JSON answer, with NaN written as null."""
+    def clean(value):
+        if isinstance(value, dict):
+            return dict((key, clean(item)) for key, item in value.items())
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [clean(item) for item in value]
+        if isinstance(value, (float, np.floating)):
+            return None if np.isnan(value) else float(value)
+        if isinstance(value, np.integer):
+            return int(value)
+        return value
+    return 'application/json', json.dumps(clean(data), sort_keys=True)
+
+#################
+#### Queries
+#################
+
+def experiments_query(experiments, params):
+    """Lists every loaded experiment with its mice, treatment groups and days."""
+    return json_answer(dict((name, {'mice': experiment['mouse_nums'],
+                                    'groups': [group for group, mice in experiment['groups']],
+                                    'treatments': experiment['mouse_treatments'],
+                                    'days': experiment['day_labels'],
+                                    'samples': experiment['n_samples']})
+                            for name, experiment in experiments.items()))
+
+def group_mean_query(experiment, params):
+    """The mean CBT and number of mice at every time slot (see core_body_temp.make_slot_matrix) of
+    the given days (all days if none are given) for one treatment group or 'all' mice."""
+    group = params.get('group', 'all')
+    mice = dict(experiment['groups'] + [('all', experiment['mouse_nums'])]).get(group)
+    if mice is None:
+        raise LookupError('no group %r in this experiment' %group)
+    days = params['days'].split(',') if params.get('days') else experiment['day_labels']
+    for day in days:
+        if day not in experiment['day_labels']:
+            raise LookupError('no day %r in this experiment' %day)
+    mice = [mouse for mouse in mice if mouse in experiment['sample_arrays']]
+    interval = experiment['interval_secs']
+    matrix = core_body_temp.make_slot_matrix(experiment['sample_arrays'], mice,
+                                             experiment['day_labels'], days,
+                                             experiment['slot_start_secs'], interval)
+    n = np.sum(np.isfinite(matrix), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(matrix, axis=0) / n
+    slots_per_day = int(round(86400.0 / interval))
+    return json_answer({'group': group, 'days': days, 'mice': mice,
+                        'times': [core_body_temp.slot_label(k, slots_per_day, interval,
+                                                            experiment['slot_start_secs'])
+                                  for k in range(matrix.shape[1])],
+                        'mean': mean, 'n': n})
+
+def moving_stdev_query(experiment, params):
+    """The moving standard deviation of each day and cycle of one mouse, with windows stopping at
+    recording gaps (points defaults to the user_modify file's moving stdev number of points)."""
+    mouse = get_mouse(experiment, params)
+    n_points = int(params.get('points', experiment['n_stdev']))
+    gaps = experiment['gap_index'][mouse]
+    stat_lists = core_body_temp.mouse_moving_stat_lists(experiment['sample_arrays'][mouse],
+                                                        gaps['starts'], gaps['stops'],
+                                                        len(experiment['times']), n_points, 'stdev')
+    result = {}
+    for (day_index, cycle_index), values in stat_lists.items():
+        day = experiment['day_labels'][day_index]
+        result.setdefault(day, {})[experiment['times'][cycle_index]] = values
+    return json_answer({'mouse': mouse, 'points': n_points, 'moving stdev': result})
+
+def cycle_stats_query(experiment, params):
+    """The number of samples, mean and population standard deviation of each day and cycle of one
+    mouse."""
+    mouse = get_mouse(experiment, params)
+    day_labels = experiment['day_labels']
+    times = experiment['times']
+    n, mean, std_dev = core_body_temp.mouse_cycle_stats(experiment['sample_arrays'][mouse],
+                                                        len(day_labels), len(times))
+    result = {}
+    for i, day in enumerate(day_labels):
+        for j, cycle in enumerate(times):
+            if n[i, j] > 0:
+                result.setdefault(day, {})[cycle] = {'n': int(n[i, j]), 'mean': mean[i, j],
+                                                     'stdev': std_dev[i, j]}
+    return json_answer({'mouse': mouse, 'cycles': result})
+
+def avg_plot_query(experiment, params):
+    """The daily average plot of one day (see core_body_temp.avg_plot) as a png."""
+    day = params.get('day', '')
+    if day not in experiment['day_labels']:
+        raise LookupError('no day %r in this experiment' %day)
+    if 'daily_avgs' not in experiment:
+        experiment['daily_avgs'] = core_body_temp.daily_temps_dic(experiment['master_tt_dic'])
+    daily_avgs = experiment['daily_avgs']
+    template = core_body_temp.make_avg_plot_template(experiment['avg_plot_ylims'])
+    core_body_temp.update_plot_template(template, [(core_body_temp.x_times(daily_avgs, day),
+                                                    core_body_temp.y_avgs(daily_avgs, day))],
+                                        ["Mouse CBT averaged for " + day])
+    image = StringIO()
+    template['fig'].savefig(image, format='png')
+    core_body_temp.load_pyplot().close(template['fig'])
+    return 'image/png', image.getvalue()
+
+def aggregates_query(experiment, params):
+    """The count, mean, stdev, min and max CBT of the time bins of one mouse (mouse=) or treatment
+    group (group= a treatment group or 'All mice') from start to stop (seconds since
+    midnight of the first day, the whole recording if not given), read from the aggregate pyramid
+    (see core_body_temp.query_aggregates). width= gives the bin width in seconds, otherwise the
+    narrowest stored width giving at most bins= bins is used."""
+    pyramid = experiment['pyramid']
+    if params.get('group'):
+        if params['group'] not in pyramid['groups']:
+            raise LookupError('no group %r in this experiment' %params['group'])
+        levels = pyramid['groups'][params['group']]
+    else:
+        levels = pyramid['mice'][get_mouse(experiment, params)]
+    start = float(params.get('start', 0))
+    stop = float(params.get('stop', (len(experiment['day_labels']) + 1) * 86400))
+    width = int(params['width']) if params.get('width') else None
+    result = core_body_temp.query_aggregates(levels, pyramid['widths'], start, stop, width,
+                                             int(params.get('bins', core_body_temp.PYRAMID_MAX_BINS)))
+    result['first day'] = pyramid['first day']
+    return json_answer(result)
+
+QUERIES = {'/group-mean': group_mean_query,
+           '/moving-stdev': moving_stdev_query,
+           '/cycle-stats': cycle_stats_query,
+           '/avg-plot.png': avg_plot_query,
+           '/aggregates': aggregates_query}
+
+def answer_request(server_state, path, params):
+    """Answers one request and returns (status, content type, body). Query answers come from the
+    cache when they have been asked for before."""
+    experiments = server_state['experiments']
+    cache = server_state['cache']
+    if path == '/experiments':
+        return (200,) + experiments_query(experiments, params)
+    if path == '/cache':
+        return (200,) + json_answer({'answers': len(cache['entries']), 'bytes': cache['bytes'],
+                                     'max bytes': cache['max_bytes'], 'hits': cache['hits'],
+                                     'misses': cache['misses']})
+    name = params.get('experiment')
+    if path == '/reload' and name:
+        experiments.pop(name, None)
+        cache_drop_experiment(cache, name)
+        get_experiment(experiments, name)
+        return (200,) + json_answer({'reloaded': name})
+    if path not in QUERIES or not name:
+        return 404, 'application/json', json.dumps({'error': 'unknown request'})
+    key = (name, path, tuple(sorted(params.items())))
+    answer = cache_get(cache, key)
+    if answer is None:
+        answer = QUERIES[path](get_experiment(experiments, name), params)
+        cache_put(cache, key, answer)
+    return (200,) + answer
+
+def make_request_handler(server_state):
+    """Returns the request handler class for a server answering from server_state. Requests are
+    handled one at a time (the plots share matplotlib, which isn't thread safe)."""
+    class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = time.time()
+            url = urlparse.urlparse(self.path)
+            params = dict((key, values[-1]) for key, values in urlparse.parse_qs(url.query).items())
+            try:
+                status, content_type, body = answer_request(server_state, urllib.unquote(url.path),
+                                                            params)
+            except LookupError as error:
+                status, content_type, body = 404, 'application/json', json.dumps({'error': str(error)})
+            except ValueError as error:
+                status, content_type, body = 400, 'application/json', json.dumps({'error': str(error)})
+            except Exception as error:
+                traceback.print_exc()
+                status, content_type, body = 500, 'application/json', json.dumps({'error': repr(error)})
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Seconds', '%.4f' %(time.time() - start))
+            self.end_headers()
+            self.wfile.write(body)
+    return RequestHandler
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves core_body_temp results for experiments kept in memory.')
+    parser.add_argument('directories', nargs='*', help='experiment folders to load at start up')
+    parser.add_argument('--port', type=int, default=8765, help='port on localhost (default 8765)')
+    parser.add_argument('--cache-mb', type=float, default=256, help='memory cap of the answer cache')
+    args = parser.parse_args()
+
+    server_state = {'experiments': {}, 'cache': make_result_cache(int(args.cache_mb * 2**20))}
+    for directory in args.directories:
+        start = time.time()
+        get_experiment(server_state['experiments'], directory)
+        print "loaded %s in %.1f s" %(directory, time.time() - start)
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', args.port), make_request_handler(server_state))
+    print "serving on http://localhost:%d/ (ctrl-c to stop)" %args.port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
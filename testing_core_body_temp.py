@@ -1,4 +1,8 @@
 from core_body_temp import *
+import shutil
+import tempfile
+from benchmark_core_body_temp import make_synthetic_txt_experiment, make_synthetic_csv_experiment, time_module_import
+from serve_core_body_temp import make_result_cache, cache_get, cache_put, cache_drop_experiment
 
 CBT_list = [36.6,36.64,36.67,36.7,36.75,36.79,36.82,36.83,36.84,36.88,36.95,37.03,37.07,37.1,37.12,
             37.14,37.16,37.18,37.2, 37.25,37.29,37.34,37.39,37.42,37.43,37.45,37.45,37.45,37.45,37.44,
@@ -159,6 +163,625 @@ def test_refit_to_master_tt_dic(master_tt_dic):
     assert feb['4']['Dark Cycle'] == []
 
 
+def test_synthetic_txt_experiment():
+    """Generates a small synthetic .TXT experiment and checks it survives ingest, calibration and
+    day reassignment with every mouse and every day present."""
+    directory = tempfile.mkdtemp()
+    start_dir = os.getcwd()
+    try:
+        mouse_nums = make_synthetic_txt_experiment(directory, 3, 2, 300)
+        os.chdir(directory)
+        filenames = get_data_file_names()
+        mouse_ids = extract_txt_mouse_ids(filenames)
+        raw_master_tt_dic = make_raw_master_tt_dic_txt(filenames, 'user_modify.csv')
+        calibrated_tt_dict = calibrate_data(filenames, raw_master_tt_dic)
+        master_tt_dic = refit_to_master_tt_dic(calibrated_tt_dict, mouse_ids, 'user_modify.csv')
+    finally:
+        os.chdir(start_dir)
+        shutil.rmtree(directory)
+    assert sorted(mouse_ids) == mouse_nums
+    assert sorted(master_tt_dic.keys()) == ['02-10-2015', '02-11-2015', '02-12-2015']
+    for mouse in mouse_nums:
+        temps = list_CBT('02-11-2015', mouse, 'Light Cycle', master_tt_dic)
+        assert len(temps) > 0
+        assert 33 < np.mean(temps) < 40
+
+def test_discover_data_files():
+    """Sniffs the files of a small synthetic .TXT experiment and checks each is classified with
+    the right mouse, serial, date range and sample rate without parsing the samples."""
+    directory = tempfile.mkdtemp()
+    start_dir = os.getcwd()
+    try:
+        mouse_nums = make_synthetic_txt_experiment(directory, 2, 2, 300)
+        os.chdir(directory)
+        discovered = discover_data_files(get_data_file_names())
+    finally:
+        os.chdir(start_dir)
+        shutil.rmtree(directory)
+    assert discovered['csv export'] == []
+    assert len(discovered['calibration']) == 1
+    assert len(discovered['calibration'][0]['serials']) == 2
+    txt_files = discovered['subcue txt']
+    assert [info['mouse_ids'] for info in txt_files] == [['1'], ['2']]
+    for info in txt_files:
+        assert LOGGER_SERIAL.match(info['serials'][0])
+        assert (info['first_date'], info['last_date']) == ('02-10-2015', '02-12-2015')
+        assert info['sample_rate'] == '5 minute(s)'
+
+def test_import_defers_plotting():
+    """Imports core_body_temp in a fresh interpreter and checks neither pyplot nor scipy were
+    loaded, so numeric-only uses and the tests start quickly (see IMPORT_BUDGET_SECS in
+    benchmark_core_body_temp.py for the time budget)."""
+    seconds, loaded = time_module_import(repeat=1)
+    assert loaded == []
+
+def test_fit_cosinor():
+    """Fits two groups of noiseless cosinor samples and a group too small to fit in one batch."""
+    hours = np.concatenate([np.arange(0, 24, 0.5), np.arange(0, 24, 0.25), [1.0, 2.0]])
+    group_index = np.concatenate([np.zeros(48), np.ones(96), [2, 2]]).astype(int)
+    temps = np.where(group_index == 0, 36.5 + 1.2*np.cos(2*pi*(hours - 20)/24),
+                     37.0 + 0.5*np.cos(2*pi*(hours - 3)/24))
+    fit = fit_cosinor(group_index, 3, hours, temps)
+    assert list(fit['n']) == [48, 96, 2]
+    assert np.allclose(fit['mesor'][:2], [36.5, 37.0])
+    assert np.allclose(fit['amplitude'][:2], [1.2, 0.5])
+    assert np.allclose(fit['acrophase'][:2], [20, 3])
+    assert np.isnan(fit['mesor'][2])
+
+def test_lomb_scargle():
+    """Finds the period of two unevenly sampled series of different lengths in one batch."""
+    rng = np.random.RandomState(0)
+    hours = [np.sort(rng.uniform(0, 240, 500)), np.sort(rng.uniform(0, 120, 300))]
+    temps = [36.5 + np.cos(2*pi*hours[0]/23.0), 37.0 + 0.5*np.sin(2*pi*hours[1]/25.0)]
+    frequencies = make_frequency_grid([20, 28], 240)
+    power = lomb_scargle(np.array([0, 500]), np.concatenate(hours), np.concatenate(temps), frequencies)
+    assert power.shape == (2, len(frequencies))
+    assert np.allclose(1.0 / frequencies[np.argmax(power, axis=1)], [23.0, 25.0], atol=0.1)
+    assert np.all(np.max(power, axis=1) > 0.99)
+
+def test_n_moving_order_statistics():
+    """Checks the moving min, max, median and percentile against the same windows n_pt_mavg uses,
+    with a single sample spike like the loggers record, and that the heap and sorted list windows
+    give the same percentiles."""
+    CBT_list = [36.1, 36.2, 36.0, 34.5, 34.9, 36.3, 36.4, 36.2, 36.5]
+    assert n_moving_min(CBT_list, 3) == [36.1, 36.0, 34.5, 34.5, 34.5, 34.9, 36.2, 36.2, 36.2]
+    assert n_moving_max(CBT_list, 4) == [36.2, 36.2, 36.2, 36.3, 36.4, 36.4, 36.5, 36.5, 36.5]
+    assert np.allclose(n_moving_median(CBT_list, 5), [36.1, 36.05, 36.0, 36.0, 36.0, 36.2, 36.3, 36.35, 36.4])
+    for n in [1, 2, 3, 6]:
+        windows = [CBT_list[start:end] for start, end in window_bounds(len(CBT_list), n)]
+        assert np.allclose(n_pt_mavg(CBT_list, n), [np.mean(window) for window in windows])
+        assert np.allclose(n_moving_percentile(CBT_list, n, 90), [np.percentile(window, 90) for window in windows])
+    rng = np.random.RandomState(5)
+    CBT_list = list(np.round(rng.normal(37, 0.5, 300), 1))     #repeated values
+    for n, percentile in [(1, 50), (4, 0), (25, 37.5), (60, 100), (301, 90)]:
+        assert heap_window_percentile(CBT_list, n, percentile) == sorted_window_percentile(CBT_list, n, percentile)
+
+def test_gap_index():
+    """Splits samples into segments at a long step and a NaN, and keeps moving averages from
+    reaching across either."""
+    elapsed = np.array([0, 300, 600, 5000, 5300, 5600, 5900, 6200], dtype=float)
+    temps = np.array([36.0, 36.2, 36.4, 37.0, 37.2, np.nan, 37.6, 37.8])
+    starts, stops = find_segments(elapsed, temps, 1.5*300)
+    assert list(starts) == [0, 3, 6] and list(stops) == [3, 5, 8]
+    day_index = np.array([0, 0, 1, 1, 1, 1, 1, 1])
+    assert [list(bounds) for bounds in split_segments(starts, stops, day_index)] == [[0, 2, 3, 6], [2, 3, 5, 8]]
+    means = moving_stat_by_segment(temps, starts, stops, 3, 'mean')
+    assert np.allclose(means[:5], [36.1, 36.2, 36.3, 37.1, 37.1])
+    assert np.isnan(means[5])
+    assert np.allclose(means[6:], [37.7, 37.7])
+
+def test_worker_pool_matches_serial():
+    """Checks the per-mouse stages give the same results split over two worker processes as in one
+    process: the mean/stder/stdev file, gap-aware moving statistics and the last two cycles'
+    moving stdev report."""
+    rng = np.random.RandomState(4)
+    times = ["Dark Cycle", "Light Cycle"]
+    days = ['02-10-2015', '02-11-2015', '02-12-2015', '02-13-2015']
+    mice = ['1', '2', '3', '4']
+    tt_dic = {}
+    for day in days:
+        tt_dic[day] = {}
+        for mouse in mice:
+            light = [('%d:%02d:00' %(h, m), 37 + rng.normal(0, 0.3)) for h in range(6, 18) for m in range(0, 60, 5)]
+            dark = [('%d:%02d:00' %(h % 24, m), 36 + rng.normal(0, 0.3)) for h in range(18, 30) for m in range(0, 60, 5)]
+            if mouse == '2':
+                light = light[:40] + light[52:]    #a recording gap
+            tt_dic[day][mouse] = {'Light Cycle': light, 'Dark Cycle': dark}
+    sample_arrays = make_mouse_sample_arrays(days, mice, times, tt_dic, 6 * 3600)
+    gap_index = make_gap_index(sample_arrays, 300)
+    groups = [('Treatment 1', ['1', '2']), ('Treatment 2', ['3', '4'])]
+    start_dir = os.getcwd()
+    directory = tempfile.mkdtemp()
+    outputs = []
+    try:
+        os.chdir(directory)
+        for processes in [1, 2]:
+            executor = make_mouse_executor(sample_arrays, mice, processes)
+            try:
+                assert (executor['pool'] is not None) == (processes > 1)
+                find_all_avgs_ers(days, mice, times, tt_dic, executor)
+                get_all_last_2_cycles_moving_stdev(tt_dic, groups, 5, days[-3:], executor, days, times)
+                stats = [make_gap_aware_stat_master_dic(days, mice, times, sample_arrays, gap_index, 5,
+                                                        statistic, executor)
+                         for statistic in ['mean', 'stdev', 'median']]
+            finally:
+                close_mouse_executor(executor)
+            outputs.append((open('mean_stder_stdev.txt').read(),
+                            open('all_last_2_cycles_moving_stdev.txt').read(), stats))
+    finally:
+        os.chdir(start_dir)
+        shutil.rmtree(directory)
+    serial, pooled = outputs
+    assert serial[0] == pooled[0] and serial[1] == pooled[1]
+    for serial_stats, pooled_stats in zip(serial[2], pooled[2]):
+        for day in days:
+            for mouse in mice:
+                for cycle in times:
+                    assert np.array_equal(serial_stats[day][mouse][cycle], pooled_stats[day][mouse][cycle])
+
+def test_moving_stat_hours():
+    """Checks the times the moving stdev plots use come from the sample arrays, in the order of the
+    gap-aware moving statistics, when master_tt_dic's list is out of time order and has a missing
+    reading."""
+    times = ["Dark Cycle", "Light Cycle"]
+    light = [('%d:00:00' %h, 37.0 + 0.1 * h) for h in range(6, 18)]
+    light[4] = ('10:00:00', float('nan'))
+    tt_dic = {'02-10-2015': {'1': {'Light Cycle': light[6:] + light[:6], 'Dark Cycle': []}}}
+    sample_arrays = make_mouse_sample_arrays(['02-10-2015'], ['1'], times, tt_dic, 6 * 3600)
+    gap_index = make_gap_index(sample_arrays, 3600)
+    stats = make_gap_aware_stat_master_dic(['02-10-2015'], ['1'], times, sample_arrays, gap_index, 3, 'stdev')
+    hours = make_gap_aware_hours_master_dic(['02-10-2015'], ['1'], times, sample_arrays, gap_index)
+    assert hours['02-10-2015']['1']['Light Cycle'] == [h for h in range(6, 18) if h != 10]
+    assert len(stats['02-10-2015']['1']['Light Cycle']) == 11
+    assert hours['02-10-2015']['1']['Dark Cycle'] == []
+
+def test_flag_outliers():
+    """Checks each outlier check flags its own kind of bad sample in a smooth synthetic series:
+    an impossible value, a single-sample spike and a run of logger-out-of-mouse readings."""
+    elapsed = np.arange(2000) * 30.0
+    temps = 37 + 0.8 * np.cos(2 * pi * elapsed / 86400) + 0.02 * np.sin(elapsed / 70.0)
+    temps[100] = 45.0
+    temps[500] = temps[499] + 2.5
+    temps[1200:1210] = 24.0
+    settings = {'range': [30, 42], 'rate': 1.0, 'robust z': [21, 6]}
+    flags = flag_outliers(elapsed, temps, settings)
+    assert list(np.flatnonzero(flags['range'])) == [100] + range(1200, 1210)
+    assert list(np.flatnonzero(flags['rate'])) == [500]
+    assert list(np.flatnonzero(~flags['keep'])) == [100, 500] + range(1200, 1210)
+    off = flag_outliers(elapsed, temps, {'range': None, 'rate': None, 'robust z': None})
+    assert off['keep'].all()
+
+def test_outlier_rejections_reach_group_stats():
+    """Checks a sample the outlier filter rejects is dropped from master_tt_dic and becomes a NaN
+    reading in the all_times dictionary, so it is gone from the group statistics while every
+    mouse keeps its time points."""
+    times = ["Dark Cycle", "Light Cycle"]
+    days = ['02-10-2015', '02-11-2015']
+    tt_dic = dict((day, dict((mouse, {'Light Cycle': [('%d:00:00' %h, 37.0 + 0.1 * h) for h in range(6, 18)],
+                                      'Dark Cycle': [('%d:00:00' %h, 36.5) for h in range(18, 24)]})
+                             for mouse in ['1', '2']))
+                  for day in days)
+    tt_dic['02-11-2015']['2']['Light Cycle'][3] = ('9:00:00', 45.0)
+    sample_arrays = make_mouse_sample_arrays(days, ['1', '2'], times, tt_dic, 6 * 3600)
+    masks = make_outlier_masks(sample_arrays, ['1', '2'], {'range': [30, 42], 'rate': None, 'robust z': None})
+    rejected = find_outlier_rejections(sample_arrays, masks, days, times)
+    assert rejected == {('02-11-2015', '2', 'Light Cycle'): set([9 * 3600])}
+    filtered_arrays, filtered_tt_dic = apply_outlier_masks(sample_arrays, tt_dic, masks, days, times)
+    assert ('9:00:00', 45.0) not in filtered_tt_dic['02-11-2015']['2']['Light Cycle']
+    assert ('9:00:00', 45.0) in tt_dic['02-11-2015']['2']['Light Cycle']
+    all_times_dic = drop_rejected_samples(tt_dic, rejected, True)
+    stats = make_group_window_stats(all_times_dic, [('all', days)], times, [('Treatment 1', ['1', '2'])])
+    means = stats['all']['Treatment 1']['mean']
+    assert len(means) == 2 * 18 and np.nanmax(means) < 42
+    assert np.sum(np.isnan(means)) == 1
+
+def test_find_bouts():
+    """Checks hysteresis keeps a bout going while CBT wanders between the enter and leave
+    thresholds, that short dips are dropped and that bouts are split at recording gaps."""
+    elapsed = np.arange(40) * 60.0
+    temps = np.full(40, 37.0)
+    temps[5:11] = [33.9, 34.2, 33.5, 34.4, 33.8, 34.6]
+    temps[12:14] = 33.0
+    temps[20:30] = 33.0
+    starts, stops = np.array([0, 25]), np.array([25, 40])
+    firsts, lasts = find_bouts(elapsed, temps, starts, stops, 34, 34.5, 180, 60)
+    assert list(firsts) == [5, 20, 25]
+    assert list(lasts) == [9, 24, 29]
+    firsts, lasts = find_bouts(elapsed, -temps, starts, stops, -36.9, -36.5, 180, 60)
+    assert list(firsts) == [0, 14, 30]
+
+def test_welch_tests():
+    """Checks the batched Welch t-tests against scipy's one column at a time (with a missing
+    observation) and the Benjamini-Hochberg adjustment against a hand-worked example."""
+    from scipy import stats
+    rng = np.random.RandomState(1)
+    a = rng.normal(37.0, 0.3, (5, 20))
+    b = rng.normal(37.4, 0.6, (7, 20))
+    a[0, 3] = np.nan
+    result = welch_tests(a, b)
+    for i in range(20):
+        column = a[:, i][np.isfinite(a[:, i])]
+        t, p = stats.ttest_ind(column, b[:, i], equal_var=False)
+        assert abs(result['t'][i] - t) < 1e-9
+        assert abs(result['p'][i] - p) < 1e-9
+    assert result['n 1'][3] == 4
+    q = benjamini_hochberg(np.array([0.01, 0.04, 0.03, np.nan, 0.2]))
+    assert np.allclose(q[[0, 1, 2, 4]], [0.04, 0.04 * 4 / 3, 0.04 * 4 / 3, 0.2])
+    assert np.isnan(q[3])
+
+def test_treatment_test_slots_start_with_dark_cycle():
+    """Checks the group tests' time slots start at the first cycle in times (the dark cycle), as the
+    group plots' time points do, so a difference in the first hour of the dark cycle is found in
+    the first slots and not half a day later."""
+    times = ["Dark Cycle", "Light Cycle"]
+    days = ['02-10-2015', '02-11-2015']
+    rng = np.random.RandomState(3)
+    tt_dic = {}
+    for day in days:
+        tt_dic[day] = {}
+        for mouse in ['1', '2', '3', '4', '5', '6']:
+            shift = 2.0 if mouse in ['4', '5', '6'] else 0.0
+            tt_dic[day][mouse] = {
+                'Light Cycle': [('%d:%02d:00' %(h, m), 37 + rng.normal(0, 0.05)) for h in range(6, 18) for m in range(0, 60, 5)],
+                'Dark Cycle': [('%d:%02d:00' %(h % 24, m), 36.5 + (shift if h == 18 else 0) + rng.normal(0, 0.05))
+                               for h in range(18, 30) for m in range(0, 60, 5)]}
+    sample_arrays = make_mouse_sample_arrays(days, ['1', '2', '3', '4', '5', '6'], times, tt_dic, 6 * 3600)
+    directory = tempfile.mkdtemp()
+    try:
+        user_input = os.path.join(directory, 'user_modify.csv')
+        writer = csv.writer(open(user_input, 'wb'))
+        writer.writerow(['Light Cycle', '6:00:00', '17:59:59'])
+        writer.writerow(['Dark Cycle', '18:00:00', '5:59:59'])
+        del writer
+        start_secs = extract_slot_start_secs(user_input, times)
+    finally:
+        shutil.rmtree(directory)
+    assert start_secs == 18 * 3600
+    results = run_treatment_tests(sample_arrays, days, times,
+                                  [('Treatment 1', ['1', '2', '3']), ('Treatment 2', ['4', '5', '6'])],
+                                  [('all', days)], start_secs, 300, 0.05)
+    slots = [result for result in results if result['kind'] == 'slot'][0]
+    assert slots['labels'][0] == 'Day 1 18:00'
+    assert slots['significant'][:12].all() and slots['significant'][288:300].all()
+    assert not slots['significant'][144:156].any() and not slots['significant'][432:444].any()
+
+def test_bootstrap_mean_bands():
+    """Checks the count-matrix bootstrap against resampling each mouse one draw at a time, with a
+    missing value, and that the same seed gives the same band."""
+    rng = np.random.RandomState(2)
+    values = rng.normal(37.0, 0.5, (4, 30))
+    values[1, 7] = np.nan
+    settings = {'resamples': 500, 'confidence': 90.0, 'seed': 3}
+    low, high = bootstrap_mean_bands(values, settings)
+    counts = bootstrap_counts(4, 500, 3)
+    assert (counts.sum(axis=1) == 4).all()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)     #resamples that drew only the NaN
+        means = np.array([np.nanmean(np.repeat(values, row, axis=0), axis=0) for row in counts])
+    assert np.allclose(low, np.nanpercentile(means, 5, axis=0))
+    assert np.allclose(high, np.nanpercentile(means, 95, axis=0))
+    assert np.array_equal(low, bootstrap_mean_bands(values, settings)[0])
+
+def test_group_time_point_stats():
+    """Checks the grouped pass gives every group the same time points, means and stdevs as
+    making each group's list on its own, with a mouse missing a day and NaN readings, and that
+    any number of 'Treatment ' rows are read as groups."""
+    rng = np.random.RandomState(1)
+    times = ["Dark Cycle", "Light Cycle"]
+    days = ['02-10-2015', '02-11-2015', '02-12-2015']
+    all_times_dic = {}
+    for day in days:
+        all_times_dic[day] = {}
+        for mouse in ['1', '2', '3', '4', '5']:
+            if day == '02-11-2015' and mouse == '3':
+                continue    #no recordings that day
+            all_times_dic[day][mouse] = dict((cycle, [('%d:00:00' %i, 37 + rng.normal(0, 0.4))
+                                                      for i in range(rng.randint(3, 6))])
+                                             for cycle in times)
+    all_times_dic['02-12-2015']['2']['Light Cycle'][1] = ('1:00:00', float('nan'))
+    groups = [('Treatment 1', ['1', '3']), ('Treatment 2', ['2', '4']), ('Treatment 3', ['5', '1'])]
+    stats = make_group_window_stats(all_times_dic, [('all', days), ('last two', days[1:])], times,
+                                    groups)
+    for window, window_days in [('all', days), ('last two', days[1:])]:
+        for group, mice in groups:
+            means = make_organized_time_temp_list(window_days, times, mice, all_times_dic)
+            stdevs = make_stdev_organized_time_temp_list(window_days, times, mice, all_times_dic)
+            assert list(stats[window][group]['time points']) == [t for t, value in means]
+            assert np.allclose(stats[window][group]['mean'], [value for t, value in means],
+                               equal_nan=True)
+            assert np.allclose(stats[window][group]['stdev'], [value for t, value in stdevs],
+                               equal_nan=True)
+
+    directory = tempfile.mkdtemp()
+    try:
+        user_input = os.path.join(directory, 'user_modify.csv')
+        writer = csv.writer(open(user_input, 'wb'))
+        writer.writerow(['Treatment 1', '4', '12', '6'])
+        writer.writerow(['Treatment 12', '7'])
+        writer.writerow(['Treatment 3', ''])
+        writer.writerow(['Treatment high dose', '9', '10'])
+        writer.writerow(['Date treatment started', '1/2/16'])
+        del writer
+        assert extract_treatment_groups(user_input) == [('Treatment 1', ['4', '6', '12']),
+                                                        ('Treatment 12', ['7']),
+                                                        ('Treatment high dose', ['9', '10'])]
+    finally:
+        shutil.rmtree(directory)
+
+def test_phase_shifts():
+    """Checks the phase shift of mice whose post treatment rhythm is moved by a known number of
+    hours (including across the +-12 hour wrap) is found to within a few minutes, that the group
+    summary averages around the clock, and that a mouse without post treatment data gets NaN."""
+    rng = np.random.RandomState(2)
+    interval = 300
+    day_labels = ['02-%02d-2015' %day for day in range(10, 16)]
+    clock = np.tile(np.arange(0, 86400, interval), len(day_labels))
+    day_index = np.repeat(np.arange(len(day_labels)), 86400 / interval)
+    shifts = {'1': 0.0, '2': 2.25, '3': -3.6, '4': 11.8, '5': -11.9}
+    sample_arrays = {}
+    for mouse, shift in sorted(shifts.items()):
+        post = day_index >= 3
+        hours = clock / 3600.0 - np.where(post, shift, 0)
+        temps = 37 + np.cos(2 * np.pi * (hours - 20) / 24) + 0.3 * np.cos(4 * np.pi * hours / 24)
+        temps = temps + rng.normal(0, 0.2, len(temps))
+        temps[rng.rand(len(temps)) < 0.1] = np.nan
+        sample_arrays[mouse] = {'clock': clock, 'day_index': day_index, 'temps': temps}
+    sample_arrays['6'] = dict((key, value[day_index < 3]) for key, value in sample_arrays['1'].items())
+    groups = [('Treatment 1', ['1', '2', '3']), ('Treatment 2', ['4', '5', '6'])]
+    windows = [('last n days pre treatment', day_labels[:3]), ('last n days post treatment', day_labels[3:])]
+    table = make_phase_shift_table(sample_arrays, groups, day_labels, windows, 6 * 3600, interval, 60)
+    assert table['mice'] == ['1', '2', '3', '4', '5', '6']
+    for i, mouse in enumerate(table['mice'][:5]):
+        assert abs(table['shift'][i] - shifts[mouse]) < 0.1
+        assert table['correlation'][i] > 0.9
+    assert np.isnan(table['shift'][5]) and table['coverage post'][5] == 0
+    name, n, mean, stdev = table['groups'][1]
+    assert name == 'Treatment 2' and n == 2
+    assert abs(abs(mean) - 11.95) < 0.1 and stdev < 0.5
+
+def test_bands_follow_time_points():
+    """Checks bands and shading made per time slot are drawn at the time points of the readings in
+    those slots when a mouse has a recording gap (its later readings move to earlier time points)."""
+    times = ["Dark Cycle", "Light Cycle"]
+    interval = 300
+    start_secs = 18 * 3600
+    clocks = [(start_secs + k * interval) % 86400 for k in range(288)]
+    readings = [('%d:%02d:00' %(c // 3600, c % 3600 // 60), 37.0) for c in clocks]
+    kept = readings[:100] + readings[112:]    #an hour with no readings
+    all_times_dic = {'02-10-2015': {'1': {'Dark Cycle': kept[:144 - 12], 'Light Cycle': kept[144 - 12:]}}}
+    groups = [('Treatment 1', ['1'])]
+    stats = make_group_window_stats(all_times_dic, [('all', ['02-10-2015'])], times, groups)['all']
+    slots = time_point_slots(stats['Treatment 1'], ['02-10-2015'], start_secs, interval)
+    assert list(slots) == range(100) + range(112, 288)
+    low = np.arange(288.0)
+    bands = bands_at_time_points({'Treatment 1': (low, low + 1)}, stats, ['02-10-2015'], start_secs, interval)
+    x, band_low, band_high = bands['Treatment 1']
+    assert list(x) == range(1, 277) and list(band_low) == list(slots)
+    significant = np.zeros(288, dtype=bool)
+    significant[150:160] = True
+    shaded = shading_at_time_points(significant, stats, ['02-10-2015'], start_secs, interval)
+    assert list(np.flatnonzero(shaded)) == range(138, 148)
+
+def test_aggregate_pyramid():
+    """Checks every level of the aggregate pyramid (and widths built from them when asked for)
+    matches statistics computed straight from the samples, and survives saving and loading."""
+    rng = np.random.RandomState(0)
+    elapsed = np.arange(0, 3 * 86400, 60.0) + 25000
+    temps = 37 + rng.normal(0, 0.5, len(elapsed))
+    temps[rng.rand(len(temps)) < 0.05] = np.nan
+    keep = elapsed % 7200 < 3600   #a gap every other hour
+    sample_arrays = {'1': {'elapsed': elapsed[keep], 'temps': temps[keep]},
+                     '2': {'elapsed': elapsed, 'temps': temps - 1}}
+    widths = check_pyramid_widths([300, 1800, 3600, 86400])
+    pyramid = make_aggregate_pyramid(sample_arrays, [('Treatment 1', ['1', '2']), ('Treatment 2', [])],
+                                     ['02-10-2015', '02-11-2015', '02-12-2015'], widths)
+    assert sorted(pyramid['groups']) == ['Treatment 1']
+    for width in widths + [7200, 600]:
+        result = query_aggregates(pyramid['mice']['2'], widths, 30000, 200000, width)
+        bins = np.floor(elapsed / width)
+        for k in [0, len(result['start']) / 2, -1]:
+            in_bin = (bins == result['start'][k] / width) & np.isfinite(temps)
+            assert result['count'][k] == np.sum(in_bin)
+            assert abs(result['mean'][k] - np.mean(temps[in_bin] - 1)) < 1e-9
+            assert abs(result['stdev'][k] - np.std(temps[in_bin])) < 1e-9
+            assert result['min'][k] == np.min(temps[in_bin] - 1)
+        assert result['start'][0] <= 30000 < result['start'][0] + width
+        assert result['start'][-1] < 200000
+    pooled = query_aggregates(pyramid['groups']['Treatment 1'], widths, 0, 4 * 86400, 86400)
+    assert np.all(pooled['count'] == query_aggregates(pyramid['mice']['1'], widths, 0, 4 * 86400, 86400)['count'] +
+                  query_aggregates(pyramid['mice']['2'], widths, 0, 4 * 86400, 86400)['count'])
+    assert query_aggregates(pyramid['mice']['1'], widths, 0, 86400)['width'] == 300
+    assert query_aggregates(pyramid['mice']['1'], widths, 0, 86400, max_bins=30)['width'] == 3600
+
+    pyramid['groups']['Treatment 2|high dose'] = pyramid['groups']['Treatment 1']
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'aggregate_pyramid.npz')
+        experiment = {'user_input': os.path.join(directory, 'user_modify.csv'),
+                      'data_files': [os.path.join(directory, 'CBT 1.TXT')]}
+        for f in [experiment['user_input']] + experiment['data_files']:
+            open(f, 'w').write('settings or data')
+        save_aggregate_pyramid(pyramid, path, experiment_inputs_key(experiment))
+        loaded = load_aggregate_pyramid(path)
+        assert load_current_aggregate_pyramid(path, experiment, widths) is not None
+        assert load_current_aggregate_pyramid(path, experiment, widths[1:]) is None
+        open(experiment['data_files'][0], 'a').write(' and more data')
+        assert load_current_aggregate_pyramid(path, experiment, widths) is None
+    finally:
+        shutil.rmtree(directory)
+    assert loaded['widths'] == widths and loaded['first day'] == '02-10-2015'
+    assert sorted(loaded['groups']) == ['Treatment 1', 'Treatment 2|high dose']
+    for field in ['bin', 'count', 'sum', 'sum_sq', 'min', 'max']:
+        assert np.array_equal(loaded['groups']['Treatment 2|high dose'][1800][field],
+                              pyramid['groups']['Treatment 1'][1800][field])
+        assert np.array_equal(loaded['mice']['2'][300][field], pyramid['mice']['2'][300][field])
+
+def test_inputs_key_after_cleaning():
+    """Saves an aggregate pyramid after the first load of a .csv experiment (which writes the
+    clean_ copies) and checks a later load still finds it current."""
+    directory = tempfile.mkdtemp()
+    start_dir = os.getcwd()
+    try:
+        make_synthetic_csv_experiment(directory, 2, 2, 300)
+        os.chdir(directory)
+        experiment = load_experiment('user_modify.csv', make_stage_profile('user_modify.csv'))
+        assert not any(f.startswith('clean_') for f in experiment['data_files'])
+        widths = check_pyramid_widths([300, 3600])
+        pyramid = make_aggregate_pyramid(experiment['sample_arrays'], experiment['groups'],
+                                         experiment['day_labels'], widths)
+        save_aggregate_pyramid(pyramid, 'aggregate_pyramid.npz', experiment_inputs_key(experiment))
+        reloaded = load_experiment('user_modify.csv', make_stage_profile('user_modify.csv'))
+        assert sorted(get_clean_data_file_names()) == sorted('clean_' + f for f in experiment['data_files'])
+        assert reloaded['data_files'] == experiment['data_files']
+        assert load_current_aggregate_pyramid('aggregate_pyramid.npz', reloaded, widths) is not None
+    finally:
+        os.chdir(start_dir)
+        shutil.rmtree(directory)
+
+def test_result_cache():
+    """Checks the server's answer cache drops the least recently used answers to stay under its
+    memory cap, and drops every answer of an experiment that is reloaded."""
+    cache = make_result_cache(10)
+    cache_put(cache, ('a', '/x', ()), ('text/plain', '1234'))
+    cache_put(cache, ('a', '/y', ()), ('text/plain', '1234'))
+    assert cache_get(cache, ('a', '/x', ())) == ('text/plain', '1234')
+    cache_put(cache, ('b', '/x', ()), ('text/plain', '1234'))    #over the cap, /y is oldest
+    assert cache_get(cache, ('a', '/y', ())) is None
+    assert cache['bytes'] == 8
+    cache_put(cache, ('b', '/z', ()), ('text/plain', '12345678901'))    #bigger than the cap
+    assert cache_get(cache, ('b', '/z', ())) is None
+    cache_drop_experiment(cache, 'a')
+    assert cache['entries'].keys() == [('b', '/x', ())]
+    assert cache['bytes'] == 4
+
+def test_figure_cache():
+    """Checks a png is only drawn again when its data or axis settings change, and that the figure
+    manifest remembers what each png was drawn from."""
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'day_mouse_avgs.png')
+        template = make_avg_plot_template([35, 39])
+        data = [([0, 1, 2], [36.0, 36.5, 37.0])]
+        output = open_plot_output('png', None)
+        write_plot(output, template, data, ['day'], path)
+        close_plot_output(output, template)
+        os.utime(path, (1000000000, 1000000000))
+
+        output = open_plot_output('png', None)
+        write_plot(output, template, [([0, 1, 2], [36.0, 36.5, 37.0])], ['day'], path)
+        close_plot_output(output, template)
+        assert output['skipped'] == 1
+        assert os.path.getmtime(path) == 1000000000
+
+        manifest = load_figure_manifest(directory)
+        assert manifest.keys() == ['day_mouse_avgs.png']
+        other_axes = make_avg_plot_template([34, 39])
+        assert template_figure_key(other_axes, data, ['day']) != manifest['day_mouse_avgs.png']
+        assert figure_key([1.0, 2.0]) == figure_key(np.array([1.0, 2.0]))
+        output = open_plot_output('png', None)
+        write_plot(output, template, [([0, 1, 2], [36.0, 36.5, 37.5])], ['day'], path)
+        close_plot_output(output, template)
+        assert output['skipped'] == 0
+        assert load_figure_manifest(directory)['day_mouse_avgs.png'] != manifest['day_mouse_avgs.png']
+    finally:
+        shutil.rmtree(directory)
+
+def test_extract_graph_output_format():
+    """Reads each graph output format, defaults to png and refuses a mistyped one."""
+    directory = tempfile.mkdtemp()
+    try:
+        user_input = os.path.join(directory, 'user_modify.csv')
+        formats = []
+        for value in ['', 'PDF', ' Contact  Sheet ', 'pfd']:
+            writer = csv.writer(open(user_input, 'wb'))
+            writer.writerow(['Graph output format', value])
+            del writer
+            try:
+                formats.append(extract_graph_output_format(user_input))
+            except ValueError as error:
+                formats.append(str(error))
+    finally:
+        shutil.rmtree(directory)
+    assert formats[:3] == ['png', 'pdf', 'contact sheet']
+    assert "'pfd'" in formats[3]
+
+def test_calendar_index():
+    """Orders days across new year by date and selects pre/post treatment days and day ranges by
+    binary search, and reassigns .txt samples after midnight to the previous calendar day."""
+    day_labels = ['01-02-2016', '12-30-2015', '01-01-2016', '12-31-2015', '01-03-2016', '12-29-2015']
+    calendar = make_calendar_index(day_labels)
+    assert calendar['labels'] == ['12-29-2015', '12-30-2015', '12-31-2015', '01-01-2016',
+                                  '01-02-2016', '01-03-2016']
+    assert calendar['ordinals']['01-03-2016'] == 5
+    assert find_day_range(calendar, '12-31-2015', '01-02-2016') == (2, 5)
+    assert find_day_range(calendar, datetime.date(2016, 1, 5)) == (6, 6)
+    arrays = {'day_index': np.array([0, 0, 1, 2, 2, 2, 4, 5])}
+    assert select_day_range(arrays, 2, 5) == slice(3, 7)
+
+    directory = tempfile.mkdtemp()
+    try:
+        user_input = os.path.join(directory, 'user_modify.csv')
+        writer = csv.writer(open(user_input, 'wb'))
+        writer.writerow(['Date treatment started', '1/2/16'])
+        writer.writerow(['Analyze last n days pre treatment', '2'])
+        writer.writerow(['Analyze last n days post treatment', '1'])
+        writer.writerow(['Light Cycle', '6:00:00', '17:59:59'])
+        writer.writerow(['Dark Cycle', '18:00:00', '5:59:59'])
+        del writer
+        tx_start_date = extract_treatment_start_date(user_input)
+        pre_days = get_last_n_pre_days(tx_start_date, calendar, user_input)
+        post_days = get_last_n_post_days(tx_start_date, calendar, user_input)
+        #each raw .txt day's samples after midnight belong to the previous calendar day's dark cycle
+        txt_days = ['12-30-2015', '12-31-2015', '01-01-2016', '01-02-2016']
+        calibrated_tt_dic = {}
+        for index, day in enumerate(txt_days):
+            calibrated_tt_dic[day] = {'1': {'Light Cycle': [('12:00:00', 37.0 + index)],
+                                            'Dark Cycle': [('02:00:00', 35.0 + index),
+                                                           ('20:00:00', 36.0 + index)]}}
+        master_tt_dic = refit_to_master_tt_dic(calibrated_tt_dic, ['1'], user_input)
+    finally:
+        shutil.rmtree(directory)
+    assert tx_start_date == '01-02-2016'
+    assert pre_days == ['12-31-2015', '01-01-2016']
+    assert post_days == ['01-02-2016']
+    assert sorted(master_tt_dic.keys()) == sorted(txt_days)
+    for index, day in enumerate(txt_days):
+        assert master_tt_dic[day]['1']['Light Cycle'] == [('12:00:00', 37.0 + index)]
+        after_midnight = [('02:00:00', 35.0 + index + 1)] if index < 3 else []
+        if index == 0:      #the first day also keeps its own early morning sample
+            after_midnight = [('02:00:00', 35.0)] + after_midnight
+        assert master_tt_dic[day]['1']['Dark Cycle'] == [('20:00:00', 36.0 + index)] + after_midnight
+
+def test_store_results():
+    """Stores a tiny experiment in an sqlite results database twice and queries it back."""
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'results.sqlite')
+    tt_dic = {'02-10-2015': {'1': {'Light Cycle': [('06:01:00', 36.0), ('06:06:00', 37.0)],
+                                   'Dark Cycle': []},
+                             '2': {'Light Cycle': [('06:01:00', 35.0)], 'Dark Cycle': [('18:01:00', 38.0)]}}}
+    try:
+        for repeat in range(2):     #storing an experiment ID again replaces its rows
+            store_results(db_path, 'expt A', ['02-10-2015'], ['1', '2'], ["Dark Cycle", "Light Cycle"],
+                          tt_dic, make_mouse_treatments([('Treatment 1', ['1']), ('Treatment 2', ['2'])]))
+        rows = query_cycle_stats(db_path, mouse='1', treatment='Treatment 1')
+        dark_rows = query_cycle_stats(db_path, cycle='Dark Cycle')
+        days = ['12-31-2014', '01-02-2015']    #rows come back in date and mouse number order
+        later = dict((day, {'10': tt_dic['02-10-2015']['2'], '2': tt_dic['02-10-2015']['2']}) for day in days)
+        store_results(db_path, 'expt B', days, ['10', '2'], ["Dark Cycle", "Light Cycle"], later, {})
+        ordered = query_cycle_stats(db_path, experiment_id='expt B', cycle='Light Cycle')
+        connection = open_results_database(db_path)
+        plan = connection.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM cycle_stats WHERE mouse = ? AND cycle = ? AND treatment = ?",
+            ('1', 'Dark Cycle', 'Treatment 1')).fetchall()
+        connection.close()
+    finally:
+        shutil.rmtree(directory)
+    assert rows == [('expt A', '02-10-2015', '1', 'Light Cycle', 'Treatment 1', 2, 36.5, 0.5/math.sqrt(2), 0.5)]
+    assert [(row[2], row[6]) for row in dark_rows] == [('2', 38.0)]
+    assert [(row[1], row[2]) for row in ordered] == [('12-31-2014', '2'), ('12-31-2014', '10'),
+                                                     ('01-02-2015', '2'), ('01-02-2015', '10')]
+    assert 'cycle_stats_mouse_cycle_treatment' in str(plan)
+
     
 if __name__ == "__main__":
     print "*******************************************************"
@@ -167,6 +790,14 @@ if __name__ == "__main__":
     print
     test_n_pt_mavg()
     test_n_moving_stdev()
+    test_synthetic_txt_experiment()
+    test_discover_data_files()
+    test_fit_cosinor()
+    test_lomb_scargle()
+    test_n_moving_order_statistics()
+    test_gap_index()
+    test_calendar_index()
+    test_store_results()
     
     ##
     #Sets up variables